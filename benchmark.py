@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the image averaging and rendering hot paths of imagesort
+
+Generates a synthetic corpus of JPEG images for each requested image size and count, then times each stage
+of the pipeline with each requested number of threads, and writes the timings to a JSON file.
+A new run can be compared against a stored baseline to flag stages that got slower.
+
+Stages
+---------------
+scan: list the image files in the corpus dir with find_files
+decode: open each image and convert it to RGB pixels
+average: calculate the average RGB and HSV values of each image with Avg.get_avg_rgb_hsv (includes decode)
+resize: make the resized tile of each image with load_tile (includes decode)
+encode: save a thumbnail canvas for each image as a JPEG file in memory (no decode)
+compose: make a collage of the whole corpus with make_collage
+gif: make a gif of the whole corpus with make_gif
+
+Usage
+---------------
+$ ./benchmark.py run --output baseline.json
+$ ./benchmark.py run --output current.json --baseline baseline.json
+$ ./benchmark.py compare baseline.json current.json --threshold 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import platform
+import statistics
+import tempfile
+import argparse
+from io import BytesIO
+from typing import Callable, Dict, List, Tuple
+import PIL
+from PIL import Image, ImageDraw
+import imagesort
+from imagesort import Avg, DEFAULT_ENGINE, ENGINE_CHOICES, find_files, imap_ordered
+from imagesort import load_tile, make_thumbnail_canvas, make_collage, make_gif
+
+# format version of the results file
+RESULTS_VERSION = 1
+
+STAGES = ['scan', 'decode', 'average', 'resize', 'encode', 'compose', 'gif']
+
+# size of the tiles used by the resize, encode, compose, and gif stages
+TILE_SIZE = 100
+BAR_HEIGHT = 20
+
+def parse_size(size: str) -> Tuple[int, int]:
+    """
+    Parse an image size like 640x480
+    """
+    try:
+        width, height = [ int(v) for v in size.lower().split('x') ]
+    except ValueError:
+        print(">>> ERROR: image size must be given as WIDTHxHEIGHT: {}".format(size))
+        raise
+    return(width, height)
+
+def parse_list(values: str, type: Callable = str) -> List:
+    """
+    Parse a comma separated list of values
+    """
+    return([ type(v) for v in values.split(',') if v ])
+
+def make_image(width: int, height: int, seed: str) -> Image:
+    """
+    Draw a synthetic image of random colored shapes on a gradient; the same seed always gives the same image
+    """
+    rand = random.Random(seed)
+    color = lambda: (rand.randrange(256), rand.randrange(256), rand.randrange(256))
+    image = Image.new('RGB', (width, height), color())
+    # fade to a second color from top to bottom, so the image is not made only of flat areas
+    gradient = Image.linear_gradient('L').resize((width, height))
+    image = Image.composite(Image.new('RGB', (width, height), color()), image, gradient)
+    draw = ImageDraw.Draw(image)
+    for i in range(rand.randint(4, 12)):
+        x = sorted([ rand.randrange(width), rand.randrange(width) ])
+        y = sorted([ rand.randrange(height), rand.randrange(height) ])
+        shape = draw.ellipse if rand.random() < 0.5 else draw.rectangle
+        shape([x[0], y[0], x[1], y[1]], fill = color())
+    return(image)
+
+def make_corpus(dir: str, count: int, width: int, height: int, seed: int = 0) -> List[str]:
+    """
+    Make a dir of count synthetic JPEG images of the given size and return their paths
+    Images that are already in the dir are kept, so a corpus can be re-used between runs
+    """
+    os.makedirs(dir, exist_ok = True)
+    paths = []
+    for i in range(count):
+        path = os.path.join(dir, "{:06d}.jpg".format(i))
+        if not os.path.exists(path):
+            make_image(width, height, seed = "{}-{}x{}-{}".format(seed, width, height, i)).save(path, format = 'JPEG', quality = 90)
+        paths.append(path)
+    return(paths)
+
+def decode_task(path: str) -> int:
+    """
+    Decode an image to RGB pixels
+    """
+    image = Image.open(path).convert('RGB')
+    return(image.size[0] * image.size[1])
+
+def average_task(item: Tuple[str, str]) -> Dict:
+    """
+    Calculate the average values of an image with the given engine
+    """
+    path, engine = item
+    return(Avg.get_avg_rgb_hsv(path, engine = engine))
+
+def resize_task(path: str) -> Tuple[int, int]:
+    """
+    Decode an image and resize it to a tile
+    """
+    return(load_tile(path, img_width = TILE_SIZE, img_height = TILE_SIZE).size)
+
+def encode_task(path: str) -> int:
+    """
+    Encode a thumbnail canvas as a JPEG file in memory; the tile is a flat color, so no image is decoded
+    """
+    tile = Image.new('RGB', (TILE_SIZE, TILE_SIZE), (len(path) % 256, 128, 64))
+    canvas = make_thumbnail_canvas(red = 64, blue = 128, green = 192, input_path = path,
+        img_width = TILE_SIZE, img_height = TILE_SIZE, bar_height = BAR_HEIGHT, tile = tile)
+    buf = BytesIO()
+    canvas.save(buf, format = 'JPEG')
+    return(buf.tell())
+
+def run_stage(stage: str, dir: str, paths: List[str], threads: int, engine: str = DEFAULT_ENGINE, tmpdir: str = None):
+    """
+    Run one stage of the pipeline over the corpus once
+    """
+    if stage == 'scan':
+        found = list(find_files(dir, threads = threads))
+        assert len(found) == len(paths)
+    elif stage == 'decode':
+        list(imap_ordered(decode_task, paths, threads = threads))
+    elif stage == 'average':
+        list(imap_ordered(average_task, [ (path, engine) for path in paths ], threads = threads))
+    elif stage == 'resize':
+        list(imap_ordered(resize_task, paths, threads = threads))
+    elif stage == 'encode':
+        list(imap_ordered(encode_task, paths, threads = threads))
+    elif stage == 'compose':
+        make_collage(input_path = dir, output_file = os.path.join(tmpdir, "collage.jpg"), threads = threads,
+            x = TILE_SIZE, y = TILE_SIZE, bar_height = BAR_HEIGHT, cache_file = None, engine = engine)
+    elif stage == 'gif':
+        make_gif(input_path = dir, output_file = os.path.join(tmpdir, "image.gif"), threads = threads,
+            x = TILE_SIZE, y = TILE_SIZE, bar_height = BAR_HEIGHT, cache_file = None, engine = engine)
+    else:
+        print(">>> ERROR: unknown stage: {}".format(stage))
+        raise ValueError("stage must be one of {}".format(STAGES))
+
+def time_stage(repeat: int = 3, *args, **kwargs) -> List[float]:
+    """
+    Time a stage repeat times, after one untimed warm up run that loads the files into the OS page cache
+    """
+    run_stage(*args, **kwargs)
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        run_stage(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    return(times)
+
+def environment() -> Dict:
+    """
+    Describe the machine and package versions the benchmarks ran with
+    """
+    np = imagesort.np
+    return({
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__ if np is not None else None,
+        })
+
+def run_benchmarks(
+        sizes: List[Tuple[int, int]] = ((320, 240), (1280, 960)),
+        counts: List[int] = (32,),
+        threads: List[int] = (1, 2, 4),
+        stages: List[str] = STAGES,
+        repeat: int = 3,
+        engine: str = DEFAULT_ENGINE,
+        corpus_dir: str = None,
+        seed: int = 0,
+        _verbose: bool = True) -> Dict:
+    """
+    Time each stage for each image size, image count, and number of threads, and return the results
+
+    The corpus is made in corpus_dir and kept there for later runs, or in a temporary dir that is removed afterwards
+    Each result has the times of all the repeats, and the best and median times and throughputs
+    """
+    for stage in stages:
+        if stage not in STAGES:
+            print(">>> ERROR: unknown stage: {}".format(stage))
+            raise ValueError("stage must be one of {}".format(STAGES))
+    tmpdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for (width, height), count in [ (size, count) for size in sizes for count in counts ]:
+            dir = os.path.join(corpus_dir or tmpdir, "{}x{}-{}-{}".format(width, height, count, seed))
+            paths = make_corpus(dir, count, width, height, seed = seed)
+            for stage in stages:
+                for num_threads in threads:
+                    times = time_stage(repeat, stage, dir, paths, num_threads, engine = engine, tmpdir = tmpdir)
+                    median = statistics.median(times)
+                    result = {
+                        'stage': stage,
+                        'width': width,
+                        'height': height,
+                        'images': count,
+                        'threads': num_threads,
+                        'times': times,
+                        'best': min(times),
+                        'median': median,
+                        'images_per_s': count / median if median else None,
+                        'megapixels_per_s': count * width * height / 1e6 / median if median else None,
+                        }
+                    results.append(result)
+                    if _verbose:
+                        print("{stage:>8} {width}x{height} images={images} threads={threads}: median {median:.4f}s, {images_per_s:.1f} images/s".format(**result),
+                            file = sys.stderr)
+    finally:
+        shutil.rmtree(tmpdir)
+    return({
+        'version': RESULTS_VERSION,
+        'engine': engine,
+        'repeat': repeat,
+        'seed': seed,
+        'environment': environment(),
+        'results': results,
+        })
+
+def result_key(result: Dict) -> Tuple:
+    """
+    The settings that identify a result, used to match up results from two runs
+    """
+    return(result['stage'], result['width'], result['height'], result['images'], result['threads'])
+
+def compare_results(baseline: Dict, current: Dict, threshold: float = 0.1, metric: str = 'median') -> List[Dict]:
+    """
+    Compare the results of two runs; a stage that takes more than (1 + threshold) times as long as in the baseline
+    is a regression, and one that takes less than 1 / (1 + threshold) times as long is an improvement
+    Only results with the same settings in both runs are compared
+    """
+    baseline_results = { result_key(result): result for result in baseline['results'] }
+    comparisons = []
+    for result in current['results']:
+        base = baseline_results.get(result_key(result))
+        if base is None:
+            continue
+        ratio = result[metric] / base[metric] if base[metric] else float('inf')
+        if ratio > 1 + threshold:
+            status = 'regression'
+        elif ratio < 1 / (1 + threshold):
+            status = 'improvement'
+        else:
+            status = 'ok'
+        comparisons.append({
+            'stage': result['stage'],
+            'width': result['width'],
+            'height': result['height'],
+            'images': result['images'],
+            'threads': result['threads'],
+            'baseline': base[metric],
+            'current': result[metric],
+            'ratio': ratio,
+            'status': status,
+            })
+    return(comparisons)
+
+def print_comparisons(comparisons: List[Dict], output = sys.stdout):
+    """
+    Print a table of compared results
+    """
+    print("{:>8} {:>11} {:>6} {:>7} {:>10} {:>10} {:>7}  {}".format(
+        'stage', 'size', 'images', 'threads', 'baseline', 'current', 'ratio', 'status'), file = output)
+    for c in comparisons:
+        print("{stage:>8} {size:>11} {images:>6} {threads:>7} {baseline:>10.4f} {current:>10.4f} {ratio:>7.2f}  {status}".format(
+            size = "{}x{}".format(c['width'], c['height']), **c), file = output)
+
+def load_results(path: str) -> Dict:
+    """
+    Load the results of a run from a JSON file
+    """
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('version') != RESULTS_VERSION:
+        print(">>> ERROR: unsupported benchmark results version in {}: {}".format(path, results.get('version')))
+        raise ValueError("results file is not a version {} benchmark results file".format(RESULTS_VERSION))
+    return(results)
+
+def compare(baseline_file: str, current_file: str, threshold: float = 0.1, metric: str = 'median', *args, **kwargs) -> bool:
+    """
+    Compare the results in two files and print the table; returns True if there were no regressions
+    """
+    comparisons = compare_results(load_results(baseline_file), load_results(current_file), threshold = threshold, metric = metric)
+    print_comparisons(comparisons)
+    return(not any( c['status'] == 'regression' for c in comparisons ))
+
+def run(
+        output_file: str = 'benchmark.json',
+        sizes: str = '320x240,1280x960',
+        counts: str = '32',
+        threads: str = '1,2,4',
+        stages: str = ','.join(STAGES),
+        repeat: int = 3,
+        engine: str = DEFAULT_ENGINE,
+        corpus_dir: str = None,
+        seed: int = 0,
+        baseline_file: str = None,
+        threshold: float = 0.1,
+        metric: str = 'median',
+        *args, **kwargs) -> bool:
+    """
+    Run the benchmarks from the command line and save the results; with a baseline file, also compare against it
+    Returns True if there were no regressions
+    """
+    results = run_benchmarks(
+        sizes = [ parse_size(size) for size in parse_list(sizes) ],
+        counts = parse_list(counts, int),
+        threads = parse_list(threads, int),
+        stages = parse_list(stages),
+        repeat = repeat,
+        engine = engine,
+        corpus_dir = corpus_dir,
+        seed = seed)
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent = 2)
+    if baseline_file:
+        return(compare(baseline_file, output_file, threshold = threshold, metric = metric))
+    return(True)
+
+def main():
+    """
+    Main control function for running the benchmarks from command line
+    """
+    parser = argparse.ArgumentParser(description = 'Benchmarks for the imagesort hot paths')
+    subparsers = parser.add_subparsers(help ='Sub-commands available')
+
+    def add_compare_args(subparser):
+        """
+        Add the args for comparing results to a sub-command parser
+        """
+        subparser.add_argument('--threshold', dest = 'threshold', default = 0.1, type = float,
+            help = 'Fraction a stage can get slower by before it is flagged as a regression')
+        subparser.add_argument('--metric', dest = 'metric', default = 'median', choices = ['median', 'best'],
+            help = 'Time of the repeats to compare')
+
+    _run = subparsers.add_parser('run', help = 'Run the benchmarks and save the results')
+    _run.add_argument('--output', dest = 'output_file', default = 'benchmark.json', help = 'JSON file to save the results to')
+    _run.add_argument('--sizes', dest = 'sizes', default = '320x240,1280x960', help = 'Comma separated image sizes of the corpus')
+    _run.add_argument('--counts', dest = 'counts', default = '32', help = 'Comma separated numbers of images in the corpus')
+    _run.add_argument('--threads', dest = 'threads', default = '1,2,4', help = 'Comma separated numbers of threads to run each stage with')
+    _run.add_argument('--stages', dest = 'stages', default = ','.join(STAGES), help = 'Comma separated stages to run')
+    _run.add_argument('--repeat', dest = 'repeat', default = 3, type = int, help = 'Number of timed runs of each stage')
+    _run.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE, choices = ENGINE_CHOICES,
+        help = 'Backend to use for calculating image averages')
+    _run.add_argument('--corpus', dest = 'corpus_dir', default = None,
+        help = 'Dir to make the synthetic images in and keep them for later runs (default: a temporary dir)')
+    _run.add_argument('--seed', dest = 'seed', default = 0, type = int, help = 'Seed for the synthetic images')
+    _run.add_argument('--baseline', dest = 'baseline_file', default = None, help = 'Results file to compare the new results against')
+    add_compare_args(_run)
+    _run.set_defaults(func = run)
+
+    _compare = subparsers.add_parser('compare', help = 'Compare two results files and flag regressions')
+    _compare.add_argument(dest = 'baseline_file', help = 'Baseline results file')
+    _compare.add_argument(dest = 'current_file', help = 'New results file')
+    add_compare_args(_compare)
+    _compare.set_defaults(func = compare)
+
+    args = parser.parse_args()
+    if not args.func(**vars(args)):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
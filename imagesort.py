@@ -15,18 +15,82 @@ from __future__ import annotations # python 3.7+
 import os
 import sys
 import csv
+import json
+import math
+import time
+import hashlib
+import sqlite3
+import heapq
+import collections
+import itertools
+import operator
+import queue
+import tempfile
+import functools
+import contextlib
+import fnmatch
+import concurrent.futures
+import pickle
+import struct
+import zlib
+import base64
+import mmap
+import array
+import signal
+import threading
 from io import BytesIO
 from PIL import Image
 import colorsys
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 from pathlib import Path
 import argparse
-from typing import Generator, Tuple, List, Dict
+from typing import Any, Callable, Generator, Iterable, Tuple, List, Dict
+try:
+    import numpy as np
+except ImportError: # numpy is optional; the 'python' engine works without it
+    np = None
+try:
+    import resource
+except ImportError: # not on Windows; the memory use of the workers is then not checked
+    resource = None
+
+# backends available for summing up the pixel values of an image
+ENGINE_CHOICES = ['numpy', 'python']
+DEFAULT_ENGINE = 'numpy' if np is not None else 'python'
+
+# number of pixels visited per image by the approximate averaging mode
+APPROX_SAMPLE_PIXELS = 65536
+
+# default location of the persistent cache of image average results used by the CLI
+DEFAULT_CACHE_FILE = os.environ.get('IMAGESORT_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'imagesort', 'results.sqlite'))
+
+# default location and size limit in MB of the persistent cache of resized tiles shared by thumbnails, collage, and gif
+DEFAULT_TILE_CACHE_FILE = os.environ.get('IMAGESORT_TILE_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'imagesort', 'tiles.sqlite'))
+DEFAULT_TILE_CACHE_MB = 1024
+
+# filters for resizing images to tiles, see --resample; from fastest to best looking
+RESAMPLE_FILTERS = collections.OrderedDict([
+    ('nearest', Image.NEAREST),
+    ('bilinear', Image.BILINEAR),
+    ('bicubic', Image.BICUBIC),
+    ('lanczos', Image.LANCZOS),
+    ])
+DEFAULT_RESAMPLE = 'lanczos'
+# tiles are first reduced by a whole factor, averaging blocks of pixels, to no less than this many times their size,
+# and only then resized with the filter; from 3 up the result looks the same as filtering the whole image
+TILE_REDUCING_GAP = 3.0
 
 class Avg(object):
     """
     Holds the attributes of image's average RGB HSV values
     """
+    # fixed attributes instead of a __dict__ for each of the (possibly millions of) instances
+    __slots__ = ('path', 'red', 'green', 'blue', 'hue', 'saturation', 'value',
+        'pixels_total', 'pixels_counted', 'pixels_pcnt', 'error', 'histogram')
+
     def __init__(self,
             path: str = None,
             _verbose: bool = False,
@@ -45,6 +109,8 @@ class Avg(object):
             self.pixels_total = avg['pixels_total']
             self.pixels_counted = avg['pixels_counted']
             self.pixels_pcnt = avg['pixels_pcnt']
+            self.error = avg.get('error')
+            self.histogram = avg.get('histogram')
 
         # initialize empty attributes if using from_dict method
         else:
@@ -58,272 +124,4100 @@ class Avg(object):
             self.pixels_total = None
             self.pixels_counted = None
             self.pixels_pcnt = None
+            self.error = None
+            self.histogram = None
+
+    @staticmethod
+    def get_avg_rgb_hsv(
+            path: str,
+            _verbose: bool = False,
+            ignore_vals: List[Tuple[int, int, int]] = None,
+            engine: str = DEFAULT_ENGINE,
+            approx: bool = False,
+            tolerance: float = None,
+            sample_pixels: int = APPROX_SAMPLE_PIXELS,
+            image: Image = None,
+            data: bytes = None,
+            histogram_bins: int = 0,
+            max_pixels: int = None,
+            max_file_mb: float = None,
+            _profile: bool = False,
+            *args, **kwargs) -> Dict:
+        """
+        Get the average RGB and HSV values from an image file path
+        If image is supplied, it is used as the already opened image for path instead of opening the file again
+        (except when approx falls back to the full image, since the image may have been decoded at a reduced scale)
+        If data is supplied, it is the contents of the file at path, already read into memory (see Prefetcher)
+
+        engine selects the backend used to sum up the pixels; 'numpy' works on the whole pixel array at once,
+        'python' walks each pixel in a loop. Both return the same values.
+
+        With approx = True, only about sample_pixels pixels are decoded and visited (see approx_sum_pixels)
+        and the result includes an 'error' estimate for the averages, in RGB units.
+        If tolerance is given and the estimated error is larger than it, the full image is used instead (error = 0.0)
+
+        With histogram_bins, the result also includes a 'histogram' of all the pixels (ignored or not)
+        with that many bins per channel, encoded as a string, see ColorHistogram. It cannot be used with approx
+
+        Images with more than max_pixels pixels, or files larger than max_file_mb MB, are turned down before they are decoded,
+        see check_image_limits
+
+        With _profile = True the result includes a 'profile' record of the time spent on each step, see StageTimer
+
+        TODO: Need to check that we are really ignoring all the input ignore pixels, its not entirely clear that its working on the asset images
+        """
+        if engine == 'numpy' and np is None:
+            print(">>> ERROR: the 'numpy' engine requires the numpy package to be installed")
+            raise ImportError("numpy is not installed")
+        if engine not in ENGINE_CHOICES:
+            print(">>> ERROR: unknown engine: {}".format(engine))
+            raise ValueError("engine must be one of {}".format(ENGINE_CHOICES))
+        if histogram_bins and approx:
+            print(">>> ERROR: histograms are made from every pixel and cannot be used with approx")
+            raise ValueError("histogram_bins cannot be used with approx")
+
+        # look up ignored pixels in a table instead of checking each one against a list
+        ignore = IgnoreTable.coerce(ignore_vals)
+
+        timer = StageTimer() if _profile else None
+        source = BytesIO(data) if data is not None else path
+        img = image if image is not None else Image.open(source)
+        check_image_limits(path, img, data = data, max_pixels = max_pixels, max_file_mb = max_file_mb)
+        if timer:
+            timer.lap('open')
+        size_x = img.size[0]
+        size_y = img.size[1]
+        avg = {
+            'red': 0,
+            'green': 0,
+            'blue': 0,
+            'pixels_total' : size_x * size_y,
+            'pixels_counted' : 0,
+            'path': path
+            }
+
+        if _verbose:
+            print("Loaded image: {0} total pixels".format(avg['pixels_total']))
+
+        error = None
+        full = not approx
+        if approx:
+            red, green, blue, counted, sampled, error = approx_sum_pixels(
+                img, ignore = ignore, engine = engine, sample_pixels = sample_pixels)
+            if timer:
+                timer.lap('sample')
+            if tolerance is not None and error > tolerance:
+                # estimate is not good enough, fall back to the full image;
+                # open it again since the reduced scale set by approx_sum_pixels stays on a supplied image
+                img = Image.open(BytesIO(data) if data is not None else path)
+                error = 0.0
+                full = True
+            else:
+                # scale the sampled pixel count up to the full size image
+                avg['red'], avg['green'], avg['blue'] = red, green, blue
+                avg['pixels_counted'] = int(round(counted * avg['pixels_total'] / float(sampled)))
+
+        # add up the RGB values for all pixels
+        if full:
+            if timer:
+                # decode separately from the conversion so they are timed on their own
+                img.load()
+                timer.lap('decode')
+            img = img.convert('RGB')
+            if timer:
+                timer.lap('convert')
+            if histogram_bins:
+                avg['histogram'] = ColorHistogram.from_image(img, bins = histogram_bins, engine = engine).encode()
+                if timer:
+                    timer.lap('histogram')
+            if engine == 'numpy':
+                sums = sum_pixels_numpy(img, ignore = ignore)
+            else:
+                sums = sum_pixels_python(img, ignore = ignore)
+            avg['red'], avg['green'], avg['blue'], avg['pixels_counted'] = sums
+            counted = avg['pixels_counted']
+            if timer:
+                timer.lap('sum')
+
+        # calculate averages
+        avg['red'] = avg['red'] // counted
+        avg['green'] = avg['green'] // counted
+        avg['blue'] = avg['blue'] // counted
+
+        # convert to HSV
+        hue, saturation, value = colorsys.rgb_to_hsv(avg['red'], avg['green'], avg['blue'])
+        avg['hue'] = hue
+        avg['saturation'] = saturation
+        avg['value'] = value
+
+        # calculate percent
+        avg['pixels_pcnt'] = round((float(avg['pixels_counted']) / float(avg['pixels_total'])) * 100, 1)
+
+        if error is not None:
+            avg['error'] = error
+
+        if timer:
+            avg['profile'] = timer.record(path, pixels = avg['pixels_total'])
+
+        return(avg)
+
+    def to_dict(self):
+        d = {
+        'red': self.red,
+        'green': self.green,
+        'blue': self.blue,
+        'hue': self.hue,
+        'saturation': self.saturation,
+        'value': self.value,
+        'pixels_total': self.pixels_total,
+        'pixels_counted': self.pixels_counted,
+        'pixels_pcnt': self.pixels_pcnt,
+        'path': self.path
+        }
+        # only present for averages from the approximate mode
+        if self.error is not None:
+            d['error'] = self.error
+        # only present when the histograms were saved, see ColorHistogram
+        if self.histogram is not None:
+            d['histogram'] = self.histogram
+        return(d)
+
+    def __repr__(self):
+        r = 'Avg(' + 'path=' + self.path.__repr__()
+        r += ')'
+        return(r)
+
+    @classmethod
+    def from_dict(cls, d: Dict) -> Avg:
+        """
+        Return an Avg instance from a pre-made dict of values
+        """
+        avg = cls()
+        attrs = ['path', 'red', 'green', 'blue', 'hue', 'saturation', 'value', 'pixels_total', 'pixels_counted', 'pixels_pcnt']
+        for a in attrs:
+            setattr(avg, a, d[a])
+        avg.error = d.get('error')
+        avg.histogram = d.get('histogram') or None
+        return(avg)
+
+    @classmethod
+    def from_list(cls,
+        paths: List[str],
+        sort_key: str = "hue",
+        threads: int = 2,
+        _verbose: bool = False,
+        engine: str = DEFAULT_ENGINE,
+        cache: ResultCache = None,
+        *args, **kwargs) -> List[Avg]:
+        """
+        Return a list of Avg objects by evaluating a list of paths in parallel
+
+        If a ResultCache is supplied, paths with a saved result for the same file and ignore pixels are
+        loaded from it instead of being evaluated again, and new results are added to it
+        """
+        avgs = list(cls.iter_from_list(paths = paths, threads = threads, ordered = True,
+            engine = engine, cache = cache, *args, **kwargs))
+
+        if sort_key:
+            # sort the values as typed arrays instead of calling a key function on each object
+            order = AvgTable.from_avgs(avgs).argsort(sort_key)
+            avgs = [ avgs[i] for i in order ]
+
+        return(avgs)
+
+    @classmethod
+    def iter_from_list(cls,
+        paths: Iterable[str],
+        threads: int = 2,
+        chunksize: int = None,
+        max_in_flight: int = None,
+        ordered: bool = False,
+        engine: str = DEFAULT_ENGINE,
+        cache: ResultCache = None,
+        profiler: Profiler = None,
+        executor: Any = None,
+        prefetcher: Prefetcher = None,
+        on_error: str = 'fail',
+        timeout: float = None,
+        failures: FailureReport = None,
+        *args, **kwargs) -> Generator[Avg, None, None]:
+        """
+        Yield Avg objects for an iterable of paths as they are evaluated in parallel
+
+        The paths are evaluated by executor, an Executor or the name of a backend, see Executor.coerce;
+        without one, a process pool with threads workers is used for this call.
+        Paths are consumed lazily and sent to the workers in chunks of chunksize paths (default: tuned by the executor),
+        with at most max_in_flight chunks (default: 4 per worker) submitted at a time, so memory use does not grow with the number of paths.
+        Results are yielded in the order they finish unless ordered = True, which yields them in the input order
+        If a Profiler is supplied, the workers time each image and the timings are passed to it
+        If a Prefetcher is supplied, the files that are not in the cache are read ahead of the workers,
+        which then decode them from memory
+
+        on_error is what happens when an image can not be evaluated: 'fail' stops with the error, 'skip' leaves the image out,
+        and 'retry' sends it to the workers again, by itself, up to RETRY_ATTEMPTS times before leaving it out.
+        The images that are left out are passed to failures, a FailureReport (default: one that only warns about them).
+        Each image is given up to timeout seconds, see time_limit; with max_pixels and max_file_mb in the args,
+        images that are too big are turned down before they are decoded, see check_image_limits
+        """
+        if on_error not in ON_ERROR_CHOICES:
+            print(">>> ERROR: unknown on_error: {}".format(on_error))
+            raise ValueError("on_error must be one of {}".format(ON_ERROR_CHOICES))
+        kwargs['engine'] = engine
+        if profiler:
+            kwargs['_profile'] = True
+        own_failures = False
+        if on_error != 'fail':
+            kwargs['on_error'] = on_error
+            if failures is None:
+                failures, own_failures = FailureReport(), True
+        if timeout:
+            kwargs['timeout'] = timeout
+        params = cache.params_key(*args, **kwargs) if cache else None
+        executor, owned = Executor.coerce(executor, threads)
+        if max_in_flight is None:
+            max_in_flight = 4 * executor.workers
+
+        done = queue.Queue() # (chunk number, positions in the chunk's paths to evaluate, results, exception) for each finished task
+        pending = {} # chunk number: state of the chunks that are being evaluated, see submit
+        finished = {} # chunk number: results for chunks that finished ahead of their turn, in ordered mode
+        next_num = 0 # next chunk number to yield in ordered mode
+
+        def submit(num: int, positions: List[int]):
+            """
+            Send the paths at some positions of a chunk's paths to evaluate to the workers
+            """
+            todo = pending[num]['todo']
+            # the args are the same for every image, so they are installed in the workers once and only the paths are sent
+            executor.apply_async(avg_chunk, ([ todo[p] for p in positions ],), size = len(positions),
+                callback = lambda computed, num = num, positions = positions: done.put((num, positions, computed, None)),
+                error_callback = lambda error, num = num, positions = positions: done.put((num, positions, None, error)),
+                initializer = init_avg_worker, initargs = (args, kwargs))
+
+        def collect():
+            """
+            Wait for the next chunk to finish and return its chunk number and merged results;
+            images that failed are sent to the workers again, or left out, depending on on_error
+            """
+            while True:
+                num, positions, computed, error = done.get()
+                if error is not None:
+                    raise error
+                state = pending[num]
+                for p, avg in zip(positions, computed):
+                    if avg is not None and 'failed' in avg:
+                        attempts = state['attempts'].get(p, 0) + 1
+                        if on_error == 'retry' and attempts <= RETRY_ATTEMPTS:
+                            state['attempts'][p] = attempts
+                            submit(num, [p])
+                            continue
+                        failures.add(avg['path'], avg['failed'], attempts = attempts)
+                        avg = None
+                    state['results'][p] = avg
+                    state['waiting'] -= 1
+                if state['waiting'] == 0:
+                    del pending[num]
+                    return(num, merge_chunk(state['chunk'], state['cached'], state['results'], cache, params, profiler))
+
+        def release(num, avgs):
+            """
+            Return the result dicts that can be yielded now that a chunk has finished
+            """
+            nonlocal next_num
+            if not ordered:
+                return(avgs)
+            finished[num] = avgs
+            ready = []
+            while next_num in finished:
+                ready.extend(finished.pop(next_num))
+                next_num += 1
+            return(ready)
+
+        def iter_lookups():
+            """
+            Yield the chunk number, paths, cached results, and paths that still need to be evaluated for each chunk
+            """
+            chunks = iter(paths)
+            for num in itertools.count():
+                chunk = list(itertools.islice(chunks, chunksize or executor.chunk_size()))
+                if not chunk:
+                    return
+                # look up any results that were already saved in the cache; only the misses need to be evaluated
+                cached = cache.get_many(chunk, params) if cache else {}
+                todo = [ path for i, path in enumerate(chunk) if i not in cached ]
+                yield(num, chunk, cached, todo)
+
+        lookups = iter_lookups()
+        if prefetcher:
+            # the workers get each path along with the file contents
+            lookups = ( (num, chunk, cached, list(zip(todo, data)))
+                for (num, chunk, cached, todo), data in prefetcher.prefetch(lookups, paths = operator.itemgetter(3)) )
+
+        try:
+            for num, chunk, cached, todo in lookups:
+                # results are filled in at the positions of todo as they come back; attempts counts the retries of each position
+                pending[num] = {'chunk': chunk, 'cached': cached, 'todo': todo, 'results': [None] * len(todo),
+                    'waiting': len(todo), 'attempts': {}}
+                if todo:
+                    submit(num, list(range(len(todo))))
+                else:
+                    done.put((num, [], [], None))
+
+                # wait for some chunks to finish before submitting more
+                while pending and len(pending) + len(finished) >= max_in_flight:
+                    for avg in release(*collect()):
+                        yield(cls.from_dict(avg))
+
+            while pending:
+                for avg in release(*collect()):
+                    yield(cls.from_dict(avg))
+        finally:
+            if owned:
+                executor.terminate()
+            if own_failures:
+                failures.close()
+
+    @classmethod
+    def from_dir(cls, dir: str, walk_args: Dict = None, *args, **kwargs) -> List[Avg]:
+        """
+        Get Avg objects for all the image files in a dir; walk_args are passed to find_files
+        """
+        paths = list(find_files(dir, **(walk_args or {})))
+        avgs = Avg().from_list(paths = paths, *args, **kwargs)
+        return(avgs)
+
+    @classmethod
+    def iter_from_dir(cls, dir: str, walk_args: Dict = None, *args, **kwargs) -> Generator[Avg, None, None]:
+        """
+        Yield Avg objects for all the image files in a dir as they are evaluated; walk_args are passed to find_files
+        The paths are sent to the workers as they are found, so processing starts before the whole dir has been searched
+        """
+        paths = profile_items(kwargs.get('profiler'), 'scan', find_files(dir, **(walk_args or {})))
+        for avg in cls.iter_from_list(paths = paths, *args, **kwargs):
+            yield(avg)
+
+    @classmethod
+    def iter_with_tiles(cls,
+        paths: Iterable[str],
+        img_width: int = 300,
+        img_height: int = 300,
+        threads: int = 2,
+        engine: str = DEFAULT_ENGINE,
+        cache: ResultCache = None,
+        profiler: Profiler = None,
+        executor: Any = None,
+        prefetcher: Prefetcher = None,
+        resample: str = DEFAULT_RESAMPLE,
+        tile_cache: TileCache = None,
+        *args, **kwargs) -> Generator[Tuple[Avg, Image], None, None]:
+        """
+        Yield an Avg object and the resized tile image (see load_tile) for each path, in order,
+        decoding each image only once for both
+        Paths with a result in the cache only need to be decoded for their tile, and paths with a tile in the tile_cache
+        only for their result; new tiles are saved to the tile_cache
+        The images are evaluated by executor, or a process pool with threads workers, see imap_ordered
+        If a Prefetcher is supplied, the files are read ahead of the workers, which then decode them from memory
+        If a Profiler is supplied, the workers time each image and the timings are passed to it
+        """
+        kwargs['engine'] = engine
+        if profiler:
+            kwargs['_profile'] = True
+        params = cache.params_key(*args, **kwargs) if cache else None
+        tile_params = tile_cache.params_key(img_width, img_height, resample) if tile_cache else None
+        sources = collections.deque() # (path, source key of its saved tile or None) for the items sent to the workers
+
+        def iter_items():
+            # look up the cached results a chunk at a time, so the paths can be an iterable that is still being filled
+            for chunk in iter_chunks(paths, 256):
+                cached = cache.get_many(chunk, params) if cache else {}
+                cached_tiles = tile_cache.find_many(chunk, tile_params) if tile_cache else {}
+                for i, path in enumerate(chunk):
+                    sources.append((path, cached_tiles.get(i)))
+                    yield((path, cached.get(i), i not in cached_tiles))
+
+        items = iter_items()
+        if prefetcher:
+            # files with both a cached result and a cached tile do not need to be read
+            items = ( item + (data[0] if data else None,) for item, data in prefetcher.prefetch(items,
+                paths = lambda item: [item[0]] if item[1] is None or item[2] else []) )
+        # the args are installed in the workers once, see init_avg_worker
+        task = functools.partial(avg_tile_task, img_width = img_width, img_height = img_height, resample = resample)
+
+        computed = [] # new results that still need to be saved to the cache
+        new_tiles = [] # new tiles that still need to be saved to the tile cache
+        for avg, tile, is_new in imap_ordered(task, items, threads = threads, executor = executor,
+                initializer = init_avg_worker, initargs = (args, kwargs)):
+            path, source = sources.popleft()
+            if profiler:
+                profiler.add(avg.pop('profile'), cached = not is_new)
+            if cache and is_new:
+                computed.append(avg)
+                if len(computed) >= 256:
+                    cache.put_many(computed, params)
+                    computed = []
+            tile, is_new_tile = cached_tile(tile, path, source, tile_cache, tile_params,
+                img_width = img_width, img_height = img_height, resample = resample)
+            if is_new_tile and tile_cache:
+                new_tiles.append((path, tile))
+                if len(new_tiles) >= 64:
+                    tile_cache.put_many(new_tiles, tile_params)
+                    new_tiles = []
+            yield(cls.from_dict(avg), tile)
+        if cache and computed:
+            cache.put_many(computed, params)
+        if tile_cache and new_tiles:
+            tile_cache.put_many(new_tiles, tile_params)
+
+    @classmethod
+    def from_csv(cls, csv_file: str) -> List[Avg]:
+        avgs = list(cls.iter_csv(csv_file))
+        return(avgs)
+
+    @classmethod
+    def from_index(cls, index_file: str, sort_key: str = None) -> List[Avg]:
+        """
+        Load Avg objects from a binary index file made by print --index, see AvgIndex
+        Rows are in the order they were saved in, unless a sort_key is given
+        """
+        with AvgIndex(index_file) as index:
+            rows = index.argsort(sort_key) if sort_key else None
+            avgs = list(index.iter_avgs(rows))
+        return(avgs)
+
+    @classmethod
+    def iter_csv(cls, csv_file: str) -> Generator[Avg, None, None]:
+        """
+        Yield Avg objects for each row of a csv file, one row at a time
+        """
+        int_attrs = ['red', 'green', 'blue', 'value', 'pixels_total', 'pixels_counted' ]
+        float_attrs = ['hue', 'saturation', 'pixels_pcnt']
+        with open(csv_file, "r") as f:
+            reader = csv.DictReader(f, delimiter = ',')
+            for row in reader:
+                for key in int_attrs:
+                    row[key] = int(row[key])
+                for key in float_attrs:
+                    row[key] = float(row[key])
+                if row.get('error'):
+                    row['error'] = float(row['error'])
+                yield(cls.from_dict(row))
+
+
+# symlink handling choices for find_files
+SYMLINK_CHOICES = ['follow', 'files', 'skip']
+
+# leading bytes of the image file types that can be found by sniffing, see looks_like_image
+IMAGE_SIGNATURES = [
+    b"\xff\xd8\xff", # JPEG
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+    b"II*\x00", # TIFF, little endian
+    b"MM\x00*", # TIFF, big endian
+    b"P3", b"P5", b"P6", # PPM / PGM
+    ]
+
+@functools.lru_cache(maxsize = None)
+def image_extensions() -> frozenset:
+    """
+    Get the lower case file extensions (with the dot) of all the image types that PIL can open
+    """
+    return(frozenset( ext.lower() for ext in Image.registered_extensions() ))
+
+def looks_like_image(path: str) -> bool:
+    """
+    Check the first bytes of a file against the signatures of common image file types
+    """
+    try:
+        with open(path, "rb") as f:
+            head = f.read(16)
+    except OSError:
+        return(False)
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return(True)
+    return(any( head.startswith(signature) for signature in IMAGE_SIGNATURES ))
+
+def match_globs(rel_path: str, patterns: List[str]) -> bool:
+    """
+    Check if a path relative to the search dir matches any of the glob patterns;
+    patterns with a '/' are matched against the whole relative path, others against the file or dir name only
+    """
+    name = rel_path.rsplit('/', 1)[-1]
+    return(any( fnmatch.fnmatch(rel_path if '/' in pattern else name, pattern) for pattern in patterns ))
+
+def scan_dir(
+        dir: str,
+        root: str,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        extensions: frozenset = None) -> Tuple[List[str], List[Tuple[str, Tuple[int, int], bool]]]:
+    """
+    List one dir for find_files with a single os.scandir call
+    Returns the paths of the image files in it and the (path, (device, inode), is symlink) of its subdirs that should be searched
+    """
+    files = []
+    subdirs = []
+    try:
+        entries = list(os.scandir(dir))
+    except OSError as e:
+        print(">>> WARNING: could not list dir {}: {}".format(dir, e), file = sys.stderr)
+        return(files, subdirs)
+    for entry in entries:
+        rel_path = entry.path[len(root):].lstrip(os.sep).replace(os.sep, '/')
+        if exclude and match_globs(rel_path, exclude):
+            continue
+        try:
+            is_link = entry.is_symlink()
+            if is_link and symlinks == 'skip':
+                continue
+            # the file type comes from the dir listing itself, except for symlinks
+            if entry.is_dir():
+                if is_link and symlinks != 'follow':
+                    continue
+                stat = entry.stat()
+                subdirs.append((entry.path, (stat.st_dev, stat.st_ino), is_link))
+                continue
+            if not entry.is_file():
+                continue
+        except OSError: # e.g. a broken symlink
+            continue
+        if include and not match_globs(rel_path, include):
+            continue
+        if sniff:
+            if not looks_like_image(entry.path):
+                continue
+        elif os.path.splitext(entry.name)[1].lower() not in extensions:
+            continue
+        files.append(entry.path)
+    return(files, subdirs)
+
+def shard_arg(value: str) -> Tuple[int, int]:
+    """
+    Parse a shard given as 'I/N', the I'th of N parts counting from 0, for --shard
+    """
+    try:
+        index, count = [ int(part) for part in str(value).split('/') ]
+    except ValueError:
+        index, count = None, None
+    if count is None or count < 1 or not 0 <= index < count:
+        print(">>> ERROR: shard must be given as I/N with 0 <= I < N: {}".format(value))
+        raise ValueError("bad shard: {}".format(value))
+    return((index, count))
+
+def in_shard(rel_path: str, shard: Tuple[int, int]) -> bool:
+    """
+    Check if a file belongs to a shard (index, count), by a hash of its path relative to the dir being searched
+    The hash only depends on the relative path with / separators,
+    so every node picks the same files however the shared filesystem is mounted, and in any order
+    """
+    index, count = shard
+    digest = hashlib.md5(rel_path.encode('utf-8', 'surrogateescape')).digest()
+    return(int.from_bytes(digest[:8], 'big') % count == index)
+
+def find_files(
+        dir: str,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        extensions: Iterable[str] = None,
+        threads: int = 1,
+        shard: Tuple[int, int] = None) -> Generator[Path, None, None]:
+    """
+    Yield the paths of all image files in a dir and its subdirs
+
+    Files are picked by their extension (default: every type PIL can open, see image_extensions),
+    or with sniff = True by their first bytes instead, so images without the usual extension are found too.
+    include and exclude are lists of glob patterns (see match_globs); excluded dirs are not searched at all.
+    max_depth limits how many levels of subdirs are searched, 0 is only the files in dir itself.
+    symlinks is 'follow' to search symlinked dirs, 'files' to only use symlinked files, or 'skip' to ignore all symlinks;
+    each dir is only searched once even if it can be reached through more than one link,
+    and a dir is searched by its real path rather than a symlink next to it.
+    With shard = (index, count), only the files in that hash partition of the dir are yielded, see in_shard;
+    the count shards of a dir together hold each of its files exactly once.
+
+    Paths are yielded in the same order as Path.glob('**/*'): the files of each dir, then each of its subdirs in turn.
+    With threads > 1 the dirs ahead of the one being yielded are listed in parallel in background threads,
+    so the files can be used while the search is still running
+    """
+    if symlinks not in SYMLINK_CHOICES:
+        print(">>> ERROR: unknown symlinks choice: {}".format(symlinks))
+        raise ValueError("symlinks must be one of {}".format(SYMLINK_CHOICES))
+    root = os.fspath(dir)
+    extensions = image_extensions() if extensions is None else frozenset( ext.lower() for ext in extensions )
+    scan = functools.partial(scan_dir, root = root, include = include, exclude = exclude,
+        symlinks = symlinks, sniff = sniff, extensions = extensions)
+    threads = int(threads)
+    stat = os.stat(root)
+    seen = {(stat.st_dev, stat.st_ino)}
+
+    # each item is a dir and its depth, along with its listing if that was already started in the background
+    stack = [(root, 0, None)]
+    prefetched = 0 # number of listings started in the background that have not been used yet
+    executor = concurrent.futures.ThreadPoolExecutor(threads) if threads > 1 else None
+    try:
+        while stack:
+            path, depth, listing = stack.pop()
+            if listing is not None:
+                prefetched -= 1
+                files, subdirs = listing.result()
+            else:
+                files, subdirs = scan(path)
+            for file in files:
+                if shard and not in_shard(file[len(root):].lstrip(os.sep).replace(os.sep, '/'), shard):
+                    continue
+                yield(Path(file))
+            if max_depth is not None and depth >= max_depth:
+                continue
+            # real subdirs are claimed before symlinks to them in the same dir
+            keep = set()
+            for subdir, key, is_link in sorted(subdirs, key = operator.itemgetter(2)):
+                if key not in seen:
+                    seen.add(key)
+                    keep.add(subdir)
+            children = []
+            for subdir in [ subdir for subdir, key, is_link in subdirs if subdir in keep ]:
+                # start listing the next few dirs while this one's files are used
+                listing = None
+                if executor and prefetched < 4 * threads:
+                    listing = executor.submit(scan, subdir)
+                    prefetched += 1
+                children.append((subdir, depth + 1, listing))
+            stack.extend(reversed(children))
+    finally:
+        if executor:
+            executor.shutdown(wait = False)
+
+def iter_chunks(items: Iterable, size: int) -> Generator[List, None, None]:
+    """
+    Yield lists of up to size items from an iterable, consuming it lazily
+    """
+    items = iter(items)
+    chunk = list(itertools.islice(items, size))
+    while chunk:
+        yield(chunk)
+        chunk = list(itertools.islice(items, size))
+
+# args for Avg.get_avg_rgb_hsv installed in each worker process when its pool starts, see init_avg_worker
+_worker_avg_args = ((), {})
+
+def init_avg_worker(args: Tuple, kwargs: Dict):
+    """
+    Pool initializer that installs the args used for every image, including the ignore table, in a worker process,
+    so that they are sent to each worker once instead of with every task
+    """
+    global _worker_avg_args
+    _worker_avg_args = (args, kwargs)
+
+# what to do with an image that can not be evaluated, see Avg.iter_from_list
+ON_ERROR_CHOICES = ['fail', 'skip', 'retry']
+# number of times an image that failed is sent to the workers again with on_error = 'retry', before it is skipped
+RETRY_ATTEMPTS = 2
+
+def check_image_limits(path: str, image: Image, data: bytes = None, max_pixels: int = None, max_file_mb: float = None):
+    """
+    Check an opened (not yet loaded) image against limits on its size, so that huge files and decompression bombs
+    are turned down from their header before they are decoded; raises ValueError.
+    This is on top of the check PIL makes when opening a file (Image.MAX_IMAGE_PIXELS)
+    """
+    if max_file_mb:
+        nbytes = len(data) if data is not None else os.path.getsize(path)
+        if nbytes > max_file_mb * (1 << 20):
+            raise ValueError("file is {:.1f} MB, more than the limit of {} MB: {}".format(nbytes / float(1 << 20), max_file_mb, path))
+    if max_pixels and image.size[0] * image.size[1] > max_pixels:
+        raise ValueError("image is {}x{} pixels, more than the limit of {}: {}".format(image.size[0], image.size[1], max_pixels, path))
+
+@contextlib.contextmanager
+def time_limit(seconds: float = None):
+    """
+    Raise TimeoutError in the block once it has run for longer than seconds
+    This uses SIGALRM, so it only works in the main thread of a process (the worker processes, or the serial executor);
+    elsewhere, e.g. in the workers of a thread executor, the block is not limited
+    """
+    if not seconds or not hasattr(signal, 'setitimer') or threading.current_thread() is not threading.main_thread():
+        yield
+        return
+
+    def on_alarm(signum, frame):
+        raise TimeoutError("took longer than {} seconds".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, on_alarm)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+class FailureReport(object):
+    """
+    Keeps track of the images that could not be evaluated and were skipped, see Avg.iter_from_list;
+    each one gets a warning, and with a path they are also listed in a csv file as they fail, so the list survives a crash
+    """
+    def __init__(self, path: str = None):
+        self.path = str(path) if path else None
+        self.count = 0
+        self.file = None
+        self.writer = None
+        if self.path:
+            self.file = open(self.path, "w", newline = '')
+            self.writer = csv.DictWriter(self.file, fieldnames = ['path', 'error', 'attempts'])
+            self.writer.writeheader()
+            self.file.flush()
+
+    def __enter__(self) -> FailureReport:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, path: str, error: str, attempts: int = 1):
+        self.count += 1
+        print(">>> WARNING: skipped {}: {}".format(path, error), file = sys.stderr)
+        if self.writer:
+            self.writer.writerow({'path': str(path), 'error': error, 'attempts': attempts})
+            self.file.flush()
+
+    def close(self):
+        """
+        Close the csv file, saying how many images were skipped
+        """
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.count:
+            print(">>> WARNING: skipped {} images that could not be evaluated{}".format(self.count,
+                ", listed in " + self.path if self.path else ""), file = sys.stderr)
+
+def open_failure_report(on_error: str = 'fail', failed_file: str = None, output_file: str = None) -> FailureReport:
+    """
+    Open the FailureReport for the CLI functions, or return None if failures stop the run (on_error = 'fail');
+    without failed_file, the skipped images are listed next to the output_file, if there is one, as <output_file>.failed.csv
+    """
+    if on_error == 'fail':
+        return(None)
+    if not failed_file and output_file and output_file != '-':
+        failed_file = output_file + '.failed.csv'
+    return(FailureReport(failed_file))
+
+def avg_chunk(paths: List[str], args: Tuple = None, kwargs: Dict = None) -> List[Dict]:
+    """
+    Evaluate a chunk of paths with Avg.get_avg_rgb_hsv; this is the task that is run by the worker processes
+    Without args and kwargs, the ones installed by init_avg_worker are used
+    Paths can also be (path, file contents) from a Prefetcher
+
+    Each image is given up to timeout seconds, if that is in the args, see time_limit.
+    With on_error in the args other than 'fail', an image that can not be evaluated gives {'path': path, 'failed': message}
+    instead of the error stopping the whole chunk
+    """
+    if kwargs is None:
+        args, kwargs = _worker_avg_args
+    timeout = kwargs.get('timeout')
+    catch = kwargs.get('on_error', 'fail') != 'fail'
+    avgs = []
+    for path in paths:
+        data = None
+        if isinstance(path, tuple):
+            path, data = path
+        try:
+            with time_limit(timeout):
+                avgs.append(Avg.get_avg_rgb_hsv(path, data = data, *args, **kwargs))
+        except Exception as e:
+            if not catch:
+                raise
+            avgs.append({'path': path, 'failed': "{}: {}".format(type(e).__name__, e)})
+    return(avgs)
+
+def merge_chunk(
+        paths: List[str],
+        cached: Dict[int, Dict],
+        computed: List[Dict],
+        cache: ResultCache = None,
+        params: str = None,
+        profiler: Profiler = None) -> List[Dict]:
+    """
+    Put the cached and newly computed results for a chunk of paths back in the original order,
+    saving the new results to the cache
+    The computed results are None for images that failed and were skipped, which are left out
+    The timings of the new results are taken out and passed to the profiler, if any, so they are not saved to the cache
+    """
+    new = [ avg for avg in computed if avg is not None ]
+    if profiler:
+        for avg in new:
+            profiler.add(avg.pop('profile'))
+        for i in cached:
+            profiler.add({'path': str(paths[i])}, cached = True)
+    if cache and new:
+        cache.put_many(new, params)
+    computed = iter(computed)
+    merged = [ cached[i] if i in cached else next(computed) for i in range(len(paths)) ]
+    return([ avg for avg in merged if avg is not None ])
+
+# values of an image that can be used for sorting
+SORT_COLUMNS = ['path', 'red', 'green', 'blue', 'hue', 'saturation', 'value', 'pixels_total', 'pixels_counted', 'pixels_pcnt']
+# sort keys that are calculated from the average color, see color_sort_values
+COLOR_SORT_KEYS = ['hilbert', 'lab', 'lightness']
+SORT_KEYS = SORT_COLUMNS + COLOR_SORT_KEYS
+
+# sRGB reference white (D65) and the matrix from linear sRGB to CIE XYZ
+D65_WHITE = (0.95047, 1.0, 1.08883)
+SRGB_TO_XYZ = [
+    (0.4124564, 0.3575761, 0.1804375),
+    (0.2126729, 0.7151522, 0.0721750),
+    (0.0193339, 0.1191920, 0.9503041),
+    ]
+
+def choose(mask: Any, a: Any, b: Any) -> Any:
+    """
+    a where mask is true and b elsewhere, for numpy arrays or for single values
+    """
+    if np is not None and isinstance(mask, np.ndarray):
+        return(np.where(mask, a, b))
+    return(a if mask else b)
+
+# linear light for each 0-255 sRGB channel value
+SRGB_LINEAR = [ c / 12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4 for c in [ v / 255.0 for v in range(256) ] ]
+
+def rgb_to_lab(red: Any, green: Any, blue: Any) -> Tuple[Any, Any, Any]:
+    """
+    Convert integer 0-255 sRGB values to CIELAB L*, a*, b* (D65); works on whole numpy arrays at once or on single values
+    """
+    if np is not None and isinstance(red, np.ndarray):
+        table = np.array(SRGB_LINEAR)
+        linear = [ table[c] for c in [red, green, blue] ]
+        cbrt = np.cbrt
+    else:
+        linear = [ SRGB_LINEAR[int(c)] for c in [red, green, blue] ]
+        cbrt = lambda t: t ** (1 / 3.0)
+    f = []
+    for (x, y, z), white in zip(SRGB_TO_XYZ, D65_WHITE):
+        t = (x * linear[0] + y * linear[1] + z * linear[2]) / white
+        f.append(choose(t > (6 / 29.0) ** 3, cbrt(t), t / (3 * (6 / 29.0) ** 2) + 4 / 29.0))
+    return(116 * f[1] - 16, 500 * (f[0] - f[1]), 200 * (f[1] - f[2]))
+
+def hilbert_index(coords: List[Any], bits: int = 8) -> Any:
+    """
+    Get the position along a Hilbert curve through a cube of 2**bits values per side, for points given by their
+    integer coordinates; points next to each other on the curve are next to each other in the cube.
+    Works on whole numpy arrays of unsigned coordinates at once or on single values.
+    Uses the transpose form of the curve from J. Skilling, "Programming the Hilbert curve", AIP Conf. Proc. 707 (2004),
+    with the branches replaced by bit masks so that arrays are handled without any per-element work
+    """
+    x = list(coords)
+    n = len(x)
+    top = 1 << (bits - 1)
+
+    # undo the excess work of the curve's rotations
+    q = top
+    while q > 1:
+        p = q - 1
+        shift = q.bit_length() - 1
+        for i in range(n):
+            # all ones when bit q of x[i] is set, else zero; invert the low bits of x[0] when set, else swap them with x[i]
+            mask = 0 - ((x[i] >> shift) & 1)
+            x[0] = x[0] ^ (p & mask)
+            if i:
+                swap = (x[0] ^ x[i]) & p & ~mask
+                x[0] = x[0] ^ swap
+                x[i] = x[i] ^ swap
+        q >>= 1
+
+    # Gray encode
+    for i in range(1, n):
+        x[i] = x[i] ^ x[i - 1]
+    t = 0
+    q = top
+    while q > 1:
+        shift = q.bit_length() - 1
+        t = t ^ ((q - 1) & (0 - ((x[n - 1] >> shift) & 1)))
+        q >>= 1
+    x = [ xi ^ t for xi in x ]
+
+    # interleave the bits of the transposed coordinates, highest first
+    index = 0
+    for bit in range(bits - 1, -1, -1):
+        for xi in x:
+            index = (index << 1) | ((xi >> bit) & 1)
+    return(index)
+
+def color_sort_values(sort_key: str, red: Any, green: Any, blue: Any) -> Any:
+    """
+    Calculate a COLOR_SORT_KEYS value from average colors, for whole numpy arrays at once or for single values
+
+    'hilbert' is the position along a Hilbert curve through the RGB cube, so similar colors end up next to each other;
+    'lab' is the same through CIELAB space (quantized to 8 bits per axis), where steps are closer to perceived differences;
+    'lightness' is CIELAB L*, the perceived lightness, which puts greys and near-blacks in order of brightness
+    """
+    is_array = np is not None and isinstance(red, np.ndarray)
+    if sort_key == 'hilbert':
+        if is_array:
+            red, green, blue = [ np.asarray(c, dtype = np.uint32) for c in [red, green, blue] ]
+        return(hilbert_index([red, green, blue]))
+    if is_array:
+        red, green, blue = [ np.asarray(c, dtype = np.intp) for c in [red, green, blue] ]
+    lightness, a, b = rgb_to_lab(red, green, blue)
+    if sort_key == 'lightness':
+        return(lightness)
+    # L* is 0 to 100, a* and b* are within about -128 to 127 for sRGB colors
+    coords = [ lightness * 2.55, a + 128, b + 128 ]
+    if is_array:
+        coords = [ np.clip(np.round(c), 0, 255).astype(np.uint32) for c in coords ]
+    else:
+        coords = [ min(255, max(0, int(round(c)))) for c in coords ]
+    return(hilbert_index(coords))
+
+def check_sort_key(sort_key: str) -> str:
+    """
+    Check a sort key, which can be one of SORT_KEYS or several of them separated by commas (sorted by the first, then the next)
+    """
+    for key in sort_key.split(','):
+        if key not in SORT_KEYS:
+            print(">>> ERROR: unknown sort key: {}".format(key))
+            raise ValueError("sort key must be one or more of {} separated by commas".format(SORT_KEYS))
+    return(sort_key)
+
+def avg_sort_key(sort_key: str) -> Callable[[Avg], Any]:
+    """
+    Return a function that gets the value used to sort Avg objects by the given key
+
+    Paths are compared as Path objects whether they were found on disk or read back from a csv file as strings,
+    so results from both sources sort the same way and can be merged together
+    """
+    keys = check_sort_key(sort_key).split(',')
+    funcs = []
+    for key in keys:
+        if key == 'path':
+            funcs.append(lambda avg: Path(avg.path))
+        elif key in COLOR_SORT_KEYS:
+            funcs.append(lambda avg, key = key: color_sort_values(key, avg.red, avg.green, avg.blue))
+        else:
+            funcs.append(operator.attrgetter(key))
+    if len(funcs) == 1:
+        return(funcs[0])
+    return(lambda avg: tuple( func(avg) for func in funcs ))
+
+def external_sort(
+        avgs: Iterable[Avg],
+        sort_key: str = 'hue',
+        buffer_size: int = 100000,
+        tmpdir: str = None) -> Generator[Avg, None, None]:
+    """
+    Sort an iterable of Avg objects while holding at most buffer_size of them in memory
+
+    Each buffer_size batch of items is sorted and saved as a csv file in a temporary directory,
+    then the sorted files are read back together with a k-way merge.
+    If all the items fit in one batch they are sorted in memory without using any files
+    """
+    key = avg_sort_key(sort_key)
+    avgs = iter(avgs)
+    run = sorted(itertools.islice(avgs, buffer_size), key = key)
+    if len(run) < buffer_size:
+        for avg in run:
+            yield(avg)
+        return
+
+    with tempfile.TemporaryDirectory(dir = tmpdir) as run_dir:
+        run_files = []
+        while run:
+            run_file = os.path.join(run_dir, "{}.csv".format(len(run_files)))
+            write_csv(dicts = [ avg.to_dict() for avg in run ], output_file = run_file)
+            run_files.append(run_file)
+            run = sorted(itertools.islice(avgs, buffer_size), key = key)
+
+        runs = [ Avg.iter_csv(run_file) for run_file in run_files ]
+        for avg in heapq.merge(*runs, key = key):
+            yield(avg)
+
+
+def replace_file(tmp_file: str, output_file: str):
+    """
+    Put a finished temporary file in place of output_file in one step,
+    giving it the permissions of the file it replaces, or the usual permissions of a new file
+    """
+    if os.path.exists(output_file):
+        mode = os.stat(output_file).st_mode & 0o777
+    else:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmp_file, mode)
+    os.replace(tmp_file, output_file)
+
+# columns of the binary index file, in the order they are stored, with their array type codes
+INDEX_COLUMNS = [
+    ('red', 'B'),
+    ('green', 'B'),
+    ('blue', 'B'),
+    ('value', 'B'),
+    ('pixels_total', 'Q'),
+    ('pixels_counted', 'Q'),
+    ('hue', 'd'),
+    ('saturation', 'd'),
+    ('pixels_pcnt', 'd'),
+    ('error', 'd'), # NaN for results that are not from the approximate mode
+    ]
+INDEX_MAGIC = b"IMGSORT\x01"
+# magic, number of rows, size of the path table in bytes
+INDEX_HEADER = struct.Struct("<8sQQ")
+
+def index_padding(nbytes: int) -> int:
+    """
+    Number of zero bytes that follow a block of nbytes in an index file, so each block starts on an 8 byte boundary
+    """
+    return(-nbytes % 8)
+
+def array_bytes(values: array.array) -> bytes:
+    """
+    Get the contents of a typed array as little-endian bytes, followed by the padding of index_padding
+    """
+    if sys.byteorder == 'big':
+        values = array.array(values.typecode, values)
+        values.byteswap()
+    data = values.tobytes()
+    return(data + b"\x00" * index_padding(len(data)))
+
+def array_view(buffer: Any, offset: int, code: str, count: int) -> Any:
+    """
+    Get the typed array of count little-endian values of array type code stored at offset in a buffer, without copying it
+    (a numpy array if numpy is installed, otherwise a memoryview)
+    """
+    if np is not None:
+        return(np.frombuffer(buffer, dtype = np.dtype(code).newbyteorder('<'), count = count, offset = offset))
+    values = memoryview(buffer)[offset:offset + count * array.array(code).itemsize]
+    if sys.byteorder == 'big':
+        # the file is little-endian; this needs a copy
+        values = array.array(code, values.tobytes())
+        values.byteswap()
+        return(values)
+    return(values.cast(code))
+
+class IndexWriter(object):
+    """
+    Write Avg objects to a binary index file that can be memory-mapped with AvgIndex
+
+    The file has a fixed size header, then each column of INDEX_COLUMNS as one little-endian typed array,
+    then the end offset of each path in the path table, then the path table of UTF-8 encoded paths.
+    The columns are collected in compact typed arrays and the file is written when the writer is closed
+    """
+    def __init__(self, output_file: str):
+        self.output_file = str(output_file)
+        self.columns = [ (name, array.array(code)) for name, code in INDEX_COLUMNS ]
+        self.offsets = array.array('Q', [0])
+        self.paths = bytearray()
+
+    def __enter__(self) -> IndexWriter:
+        return(self)
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+
+    def add(self, avg: Avg):
+        for name, values in self.columns:
+            value = getattr(avg, name, None)
+            values.append(math.nan if value is None else value)
+        self.paths += os.fsencode(str(avg.path))
+        self.offsets.append(len(self.paths))
+
+    def close(self):
+        # write to a temporary file in the same dir, then put it in place
+        output_dir = os.path.dirname(os.path.abspath(self.output_file))
+        fd, tmp_file = tempfile.mkstemp(dir = output_dir, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(INDEX_HEADER.pack(INDEX_MAGIC, len(self.offsets) - 1, len(self.paths)))
+                for values in [ values for name, values in self.columns ] + [self.offsets]:
+                    fout.write(array_bytes(values))
+                fout.write(self.paths)
+            replace_file(tmp_file, self.output_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+def write_index(avgs: Iterable[Avg], output_file: str) -> str:
+    """
+    Save Avg objects to a binary index file, see IndexWriter
+    """
+    with IndexWriter(output_file) as writer:
+        for avg in avgs:
+            writer.add(avg)
+    return(output_file)
+
+class AvgIndex(object):
+    """
+    Read-only view of a binary index file made by IndexWriter
+
+    The file is memory-mapped and each column is used in place as a typed array (a numpy array if numpy is installed,
+    otherwise a memoryview), so opening the index, sorting, and selecting rows do not make a Python object per row;
+    Avg objects are only made for the rows that are used
+    """
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.file = open(self.path, "rb")
+        self.mmap = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ)
+        magic = self.mmap[:len(INDEX_MAGIC)]
+        if magic == INDEX_MAGIC and len(self.mmap) >= INDEX_HEADER.size:
+            magic, self.size, path_bytes = INDEX_HEADER.unpack_from(self.mmap, 0)
+        if magic != INDEX_MAGIC or len(self.mmap) < INDEX_HEADER.size:
+            self.close()
+            print(">>> ERROR: not an index file: {}".format(path))
+            raise ValueError("not an index file: {}".format(path))
+
+        offset = INDEX_HEADER.size
+        self.columns = {}
+        for name, code in INDEX_COLUMNS + [('offsets', 'Q')]:
+            count = self.size + 1 if name == 'offsets' else self.size
+            self.columns[name] = self.view(offset, code, count)
+            nbytes = count * array.array(code).itemsize
+            offset += nbytes + index_padding(nbytes)
+        self.offsets = self.columns.pop('offsets')
+        self.path_table = memoryview(self.mmap)[offset:offset + path_bytes]
+
+    def view(self, offset: int, code: str, count: int) -> Any:
+        """
+        Get the typed array of count values of array type code stored at offset, without copying it
+        """
+        return(array_view(self.mmap, offset, code, count))
+
+    def __enter__(self) -> AvgIndex:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.columns = {}
+        self.offsets = None
+        self.path_table = None
+        try:
+            self.mmap.close()
+        except BufferError:
+            pass # numpy arrays that are still in use keep the mapping open until they are freed
+        self.file.close()
+
+    def __len__(self) -> int:
+        return(self.size)
+
+    def get_path(self, row: int) -> str:
+        return(os.fsdecode(bytes(self.path_table[self.offsets[row]:self.offsets[row + 1]])))
+
+    def get_avg(self, row: int) -> Avg:
+        """
+        Make an Avg object for one row
+        """
+        d = { name: float(self.columns[name][row]) if code == 'd' else int(self.columns[name][row])
+            for name, code in INDEX_COLUMNS }
+        if math.isnan(d['error']):
+            d['error'] = None
+        d['path'] = self.get_path(row)
+        return(Avg.from_dict(d))
+
+    def argsort(self, sort_key: str = 'hue') -> Iterable[int]:
+        """
+        Get the row numbers in sorted order; rows with the same value keep their order in the file, see AvgTable.argsort
+        """
+        return(AvgTable(self.columns, IndexPaths(self)).argsort(sort_key))
+
+    def iter_avgs(self, rows: Iterable[int] = None) -> Generator[Avg, None, None]:
+        """
+        Yield Avg objects for the given row numbers, or for all rows in file order
+        """
+        for row in (range(self.size) if rows is None else rows):
+            yield(self.get_avg(int(row)))
+
+class IndexPaths(object):
+    """
+    Sequence of the paths in an AvgIndex, decoded only when they are used
+    """
+    def __init__(self, index: AvgIndex):
+        self.index = index
+
+    def __len__(self) -> int:
+        return(len(self.index))
+
+    def __getitem__(self, row: int) -> str:
+        return(self.index.get_path(row))
+
+class AvgTable(object):
+    """
+    Columnar table of image average values: one typed array per numeric column of INDEX_COLUMNS and a path column
+
+    Sorting and selecting rows only make a new array of row numbers (order) over the same columns,
+    and sorting by a numeric column is a single vectorized argsort when numpy is installed.
+    Rows are used through AvgRow views that act like read-only Avg objects, made one at a time when they are accessed
+    """
+    def __init__(self, columns: Dict[str, Any], paths: Any, order: Any = None, index: AvgIndex = None):
+        self.columns = columns # column name: typed array (array.array, numpy array or memoryview)
+        self.paths = paths # sequence of paths
+        self.order = order # row numbers of the table in the columns, or None for all rows in order
+        self.index = index # open AvgIndex that holds the columns, if any
+
+    @classmethod
+    def from_avgs(cls, avgs: Iterable[Avg]) -> AvgTable:
+        columns = { name: array.array(code) for name, code in INDEX_COLUMNS }
+        paths = []
+        for avg in avgs:
+            for name, values in columns.items():
+                value = getattr(avg, name)
+                values.append(math.nan if value is None else value)
+            paths.append(avg.path)
+        return(cls(columns, paths))
+
+    @classmethod
+    def from_csv(cls, csv_file: str) -> AvgTable:
+        """
+        Load a csv table made by print; the rows go straight into the columns without making Avg objects
+        """
+        columns = { name: array.array(code) for name, code in INDEX_COLUMNS }
+        paths = []
+        with open(csv_file, "r") as f:
+            for row in csv.DictReader(f):
+                for name, code in INDEX_COLUMNS:
+                    value = row.get(name)
+                    if code == 'd':
+                        columns[name].append(float(value) if value else math.nan)
+                    else:
+                        columns[name].append(int(value))
+                paths.append(row['path'])
+        return(cls(columns, paths))
+
+    @classmethod
+    def from_index(cls, index_file: str) -> AvgTable:
+        """
+        Use the memory-mapped columns of a binary index file made by print --index, see AvgIndex
+        """
+        index = AvgIndex(index_file)
+        return(cls(index.columns, IndexPaths(index), index = index))
+
+    def close(self):
+        if self.index is not None:
+            self.index.close()
+
+    def __len__(self) -> int:
+        return(len(self.order) if self.order is not None else len(self.paths))
+
+    def __getitem__(self, i: int) -> AvgRow:
+        if isinstance(i, slice):
+            return(self.take(range(len(self))[i]))
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("table row out of range")
+        return(AvgRow(self, i))
+
+    def __iter__(self) -> Generator[AvgRow, None, None]:
+        for i in range(len(self)):
+            yield(AvgRow(self, i))
+
+    def base_row(self, i: int) -> int:
+        """
+        Get the row number in the columns for row i of the table
+        """
+        return(int(self.order[i]) if self.order is not None else i)
+
+    def get_value(self, name: str, i: int) -> Any:
+        """
+        Get a value from row i of the table as a plain Python value, as it would be held by an Avg object
+        """
+        row = self.base_row(i)
+        if name == 'path':
+            return(self.paths[row])
+        value = self.columns[name][row]
+        if isinstance(value, float) or (np is not None and isinstance(value, np.floating)):
+            value = float(value)
+            if name == 'error' and math.isnan(value):
+                return(None)
+            return(value)
+        return(int(value))
+
+    def column(self, name: str) -> Any:
+        """
+        Get the values of a numeric column in table order; a numpy array when numpy is installed, otherwise a list
+        """
+        values = self.columns[name]
+        if np is not None:
+            values = np.asarray(values)
+            return(values if self.order is None else values[self.order])
+        if self.order is None:
+            return(list(values))
+        return([ values[row] for row in self.order ])
+
+    def sort_values(self, sort_key: str) -> Any:
+        """
+        Get the values of a numeric column or a COLOR_SORT_KEYS key in table order, calculated for all rows at once
+        """
+        if sort_key in COLOR_SORT_KEYS:
+            if np is not None:
+                return(color_sort_values(sort_key, *[ self.column(name) for name in ['red', 'green', 'blue'] ]))
+            return([ color_sort_values(sort_key, *rgb) for rgb in zip(*[ self.column(name) for name in ['red', 'green', 'blue'] ]) ])
+        return(self.column(sort_key))
+
+    def argsort(self, sort_key: str = 'hue') -> Any:
+        """
+        Get the row numbers of the table in sorted order; rows with the same value keep their order
+        sort_key can be several keys separated by commas, see check_sort_key
+        """
+        keys = check_sort_key(sort_key).split(',')
+        if 'path' in keys:
+            key = avg_sort_key(sort_key)
+            return(sorted(range(len(self)), key = lambda i: key(AvgRow(self, i))))
+        values = [ self.sort_values(key) for key in keys ]
+        if np is not None:
+            if len(values) == 1:
+                return(np.argsort(values[0], kind = 'stable'))
+            # lexsort sorts by the last key first
+            return(np.lexsort(values[::-1]))
+        if len(values) == 1:
+            return(sorted(range(len(self)), key = values[0].__getitem__))
+        return(sorted(range(len(self)), key = lambda i: tuple( v[i] for v in values )))
+
+    def take(self, rows: Iterable[int]) -> AvgTable:
+        """
+        Get a table of the given rows of this table; the columns are shared, not copied
+        """
+        if np is not None:
+            rows = np.asarray(rows, dtype = np.int64)
+            order = rows if self.order is None else np.asarray(self.order)[rows]
+        else:
+            order = list(rows) if self.order is None else [ self.order[i] for i in rows ]
+        return(AvgTable(self.columns, self.paths, order = order, index = self.index))
+
+    def sorted(self, sort_key: str = 'hue') -> AvgTable:
+        return(self.take(self.argsort(sort_key)))
+
+def table_column(name: str) -> property:
+    """
+    Read-only property of an AvgRow that gets its value from the table
+    """
+    return(property(lambda self: self.table.get_value(name, self.row)))
+
+class AvgRow(Avg):
+    """
+    View of one row of an AvgTable that can be used in place of an Avg object
+    """
+    __slots__ = ('table', 'row')
+    path = table_column('path')
+    red = table_column('red')
+    green = table_column('green')
+    blue = table_column('blue')
+    hue = table_column('hue')
+    saturation = table_column('saturation')
+    value = table_column('value')
+    pixels_total = table_column('pixels_total')
+    pixels_counted = table_column('pixels_counted')
+    pixels_pcnt = table_column('pixels_pcnt')
+    error = table_column('error')
+    histogram = None # not held by the table
+
+    def __init__(self, table: AvgTable, row: int):
+        self.table = table
+        self.row = row
+
+# spaces the average colors can be searched in, see ColorTree
+COLOR_SPACES = ['rgb', 'lab', 'hsv']
+TREE_MAGIC = b"IMGSKDT\x01"
+# magic, space, number of points, leaf size, size and modification time of the table it was built from, size of the path table in bytes
+TREE_HEADER = struct.Struct("<8s8sQQQQQ")
+
+def color_points(space: str, red: Any, green: Any, blue: Any, hue: Any = None, saturation: Any = None, value: Any = None) -> List[Any]:
+    """
+    Get the three coordinates of colors in a COLOR_SPACES space, for whole numpy arrays at once or for single values
+
+    'rgb' is the 0-255 RGB cube; 'lab' is CIELAB, where distances are closer to perceived differences;
+    'hsv' is the HSV cone (saturation x value around the hue circle, and value as the height) in 0-255 units,
+    so that hues next to each other across 0 / 1 are also close. HSV values are calculated from RGB if they are not given
+    """
+    if space not in COLOR_SPACES:
+        print(">>> ERROR: unknown color space: {}".format(space))
+        raise ValueError("color space must be one of {}".format(COLOR_SPACES))
+    is_array = np is not None and isinstance(red, np.ndarray)
+    if space == 'rgb':
+        if is_array:
+            return([ np.asarray(c, dtype = np.float64) for c in [red, green, blue] ])
+        return([ float(c) for c in [red, green, blue] ])
+    if space == 'lab':
+        return(list(rgb_to_lab(red, green, blue)))
+    if hue is None:
+        if is_array:
+            hsv = [ colorsys.rgb_to_hsv(*rgb) for rgb in zip(red.tolist(), green.tolist(), blue.tolist()) ]
+            hue, saturation, value = [ np.array(c, dtype = np.float64) for c in zip(*hsv) ] if hsv else [np.zeros(0)] * 3
+        else:
+            hue, saturation, value = colorsys.rgb_to_hsv(red, green, blue)
+    if is_array:
+        angle = 2 * math.pi * np.asarray(hue, dtype = np.float64)
+        radius = np.asarray(saturation, dtype = np.float64) * value
+        return([radius * np.cos(angle), radius * np.sin(angle), np.asarray(value, dtype = np.float64)])
+    angle = 2 * math.pi * hue
+    return([saturation * value * math.cos(angle), saturation * value * math.sin(angle), float(value)])
+
+def parse_color(text: str) -> Tuple[int, int, int]:
+    """
+    Parse a color given as hex 'rrggbb' (with or without a leading #) or as 'red,green,blue'
+    """
+    try:
+        if ',' in text:
+            rgb = tuple( int(c) for c in text.split(',') )
+        else:
+            digits = text.lstrip('#')
+            if len(digits) != 6:
+                raise ValueError(text)
+            rgb = tuple( int(digits[i:i + 2], 16) for i in [0, 2, 4] )
+        if len(rgb) != 3 or not all( 0 <= c <= 255 for c in rgb ):
+            raise ValueError(text)
+    except ValueError:
+        print(">>> ERROR: colors must be given as rrggbb, #rrggbb or red,green,blue: {}".format(text))
+        raise ValueError("bad color: {}".format(text))
+    return(rgb)
+
+class ColorTree(object):
+    """
+    k-d tree over the average colors of a table, for finding the images with the closest colors without
+    comparing against every row; can be saved to a file and memory-mapped back without building it again
+
+    The tree is kept in flat arrays in the layout of an implicit balanced tree: the points of a node are a range
+    [lo, hi) of the arrays, the middle point mid = (lo + hi) // 2 splits them along axis dims[mid],
+    with the points before it no larger and the points after it no smaller on that axis.
+    Ranges of leaf_size points or fewer are leaves, which are scanned in one go.
+    Alongside each point are its row number in the table, its RGB color and its path, so matches can be reported
+    from the tree alone
+    """
+    def __init__(self,
+            space: str,
+            points: Any,
+            rows: Any,
+            dims: Any,
+            colors: Any,
+            paths: Any,
+            leaf_size: int = 16,
+            source: Tuple[int, int] = (0, 0),
+            mapped: Tuple = None):
+        self.space = space
+        self.points = points # flat x, y, z of each point in tree order
+        self.rows = rows # row number in the table of each point
+        self.dims = dims # split axis of each node, at its middle point
+        self.colors = colors # flat red, green, blue of each point
+        self.paths = paths # sequence of the paths of the points
+        self.leaf_size = leaf_size
+        self.source = source # (size, modification time) of the table the tree was built from
+        self.size = len(rows)
+        self.mapped = mapped # open (file, mmap) when loaded from a file
+        # the points as an N x 3 array, for scanning the leaves
+        self.block = np.asarray(points).reshape(-1, 3) if np is not None else None
+
+    @classmethod
+    def build(cls, table: AvgTable, space: str = 'lab', leaf_size: int = 16, source: Tuple[int, int] = (0, 0)) -> ColorTree:
+        """
+        Build the tree for all the rows of an AvgTable
+        Each node splits along the axis where its points are most spread out, at the median point of that axis
+        """
+        n = len(table)
+        red, green, blue, hue, saturation, value = [ table.column(name) for name in ['red', 'green', 'blue', 'hue', 'saturation', 'value'] ]
+        if np is not None:
+            coords = np.stack([ np.asarray(c, dtype = np.float64) for c in color_points(space, red, green, blue, hue, saturation, value) ], axis = 1) if n else np.zeros((0, 3))
+            perm = np.arange(n)
+        else:
+            coords = [ color_points(space, *values) for values in zip(red, green, blue, hue, saturation, value) ]
+            perm = list(range(n))
+        dims = array.array('B', bytes(n))
+
+        stack = [(0, n)]
+        while stack:
+            lo, hi = stack.pop()
+            if hi - lo <= leaf_size:
+                continue
+            mid = (lo + hi) // 2
+            segment = perm[lo:hi]
+            if np is not None:
+                block = coords[segment]
+                dim = int(np.argmax(block.max(axis = 0) - block.min(axis = 0)))
+                perm[lo:hi] = segment[np.argpartition(block[:, dim], mid - lo, kind = 'introselect')]
+            else:
+                spreads = [ max( coords[i][d] for i in segment ) - min( coords[i][d] for i in segment ) for d in range(3) ]
+                dim = spreads.index(max(spreads))
+                perm[lo:hi] = sorted(segment, key = lambda i: coords[i][dim])
+            dims[mid] = dim
+            stack.append((lo, mid))
+            stack.append((mid + 1, hi))
+
+        if np is not None:
+            points = array.array('d', coords[perm].ravel().tolist())
+            colors = array.array('B', np.stack([red, green, blue], axis = 1)[perm].astype(np.uint8).ravel().tolist())
+            perm = perm.tolist()
+        else:
+            points = array.array('d', [ c for i in perm for c in coords[i] ])
+            colors = array.array('B', [ int(c[i]) for i in perm for c in [red, green, blue] ])
+        rows = array.array('Q', perm)
+        paths = [ table.get_value('path', i) for i in rows ]
+        return(cls(space, points, rows, dims, colors, paths, leaf_size = leaf_size, source = source))
+
+    def save(self, output_file: str) -> str:
+        """
+        Write the tree to a file: a fixed size header, then the points, rows, split axes, colors and path offsets
+        as little-endian typed arrays, then the UTF-8 encoded paths, like IndexWriter
+        """
+        offsets = array.array('Q', [0])
+        path_table = bytearray()
+        for path in self.paths:
+            path_table += os.fsencode(str(path))
+            offsets.append(len(path_table))
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        fd, tmp_file = tempfile.mkstemp(dir = output_dir, suffix = ".tmp")
+        try:
+            with os.fdopen(fd, "wb") as fout:
+                fout.write(TREE_HEADER.pack(TREE_MAGIC, self.space.encode('ascii'), self.size, self.leaf_size,
+                    self.source[0], self.source[1], len(path_table)))
+                for code, values in [('d', self.points), ('Q', self.rows), ('B', self.dims), ('B', self.colors), ('Q', offsets)]:
+                    fout.write(array_bytes(array.array(code, values)))
+                fout.write(path_table)
+            replace_file(tmp_file, output_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        return(output_file)
+
+    @classmethod
+    def load(cls, tree_file: str) -> ColorTree:
+        """
+        Memory-map a tree saved by save; nothing is built or copied
+        """
+        f = open(tree_file, "rb")
+        buffer = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        if len(buffer) < TREE_HEADER.size or buffer[:len(TREE_MAGIC)] != TREE_MAGIC:
+            buffer.close()
+            f.close()
+            print(">>> ERROR: not a color tree file: {}".format(tree_file))
+            raise ValueError("not a color tree file: {}".format(tree_file))
+        magic, space, size, leaf_size, source_size, source_mtime_ns, path_bytes = TREE_HEADER.unpack_from(buffer, 0)
+        offset = TREE_HEADER.size
+        arrays = []
+        for code, count in [('d', 3 * size), ('Q', size), ('B', size), ('B', 3 * size), ('Q', size + 1)]:
+            arrays.append(array_view(buffer, offset, code, count))
+            nbytes = count * array.array(code).itemsize
+            offset += nbytes + index_padding(nbytes)
+        points, rows, dims, colors, offsets = arrays
+        path_table = memoryview(buffer)[offset:offset + path_bytes]
+        paths = TablePaths(path_table, offsets)
+        return(cls(space.rstrip(b"\x00").decode('ascii'), points, rows, dims, colors, paths,
+            leaf_size = leaf_size, source = (source_size, source_mtime_ns), mapped = (f, buffer)))
+
+    def close(self):
+        if self.mapped:
+            f, buffer = self.mapped
+            self.points = self.rows = self.dims = self.colors = self.paths = self.block = None
+            try:
+                buffer.close()
+            except BufferError:
+                pass # numpy arrays that are still in use keep the mapping open until they are freed
+            f.close()
+            self.mapped = None
+
+    def __enter__(self) -> ColorTree:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return(self.size)
+
+    def nearest(self, point: List[float], k: int = None, radius: float = None) -> List[Tuple[float, int]]:
+        """
+        Find the k points closest to a point in the tree's space, or all the points within radius, or the k closest within radius
+        Returns (squared distance, position in the tree) for each match, closest first; equal distances are in row order
+        """
+        limit = radius * radius if radius is not None else math.inf
+        found = [] # heap of (-squared distance, -row, position) of the k best so far with k, otherwise a list
+        points = self.points
+        x, y, z = point
+
+        def bound() -> float:
+            if k is not None and len(found) >= k:
+                return(min(limit, -found[0][0]))
+            return(limit)
+
+        def add(d2: float, i: int):
+            if d2 > limit:
+                return
+            row = int(self.rows[i])
+            if k is None:
+                found.append((d2, row, i))
+            elif len(found) < k:
+                heapq.heappush(found, (-d2, -row, i))
+            elif (d2, row) < (-found[0][0], -found[0][1]):
+                heapq.heapreplace(found, (-d2, -row, i))
+
+        if k is not None and k <= 0:
+            return([])
+        stack = [(0, self.size, 0.0)] # node range and squared distance from the point to the node's side of its parent's split
+        while stack:
+            lo, hi, plane = stack.pop()
+            if lo >= hi or plane > bound():
+                continue
+            if hi - lo <= self.leaf_size:
+                if np is not None:
+                    d2s = ((self.block[lo:hi] - point) ** 2).sum(axis = 1)
+                    for j in np.flatnonzero(d2s <= bound()):
+                        add(float(d2s[j]), lo + int(j))
+                else:
+                    for i in range(lo, hi):
+                        add((points[3 * i] - x) ** 2 + (points[3 * i + 1] - y) ** 2 + (points[3 * i + 2] - z) ** 2, i)
+                continue
+            mid = (lo + hi) // 2
+            add((points[3 * mid] - x) ** 2 + (points[3 * mid + 1] - y) ** 2 + (points[3 * mid + 2] - z) ** 2, mid)
+            diff = point[self.dims[mid]] - points[3 * mid + self.dims[mid]]
+            near, far = ((lo, mid), (mid + 1, hi)) if diff < 0 else ((mid + 1, hi), (lo, mid))
+            # the far side can only hold closer points if the split plane itself is close enough
+            stack.append(far + (max(plane, diff * diff),))
+            stack.append(near + (plane,))
+
+        if k is not None:
+            found = [ (-d2, -row, i) for d2, row, i in found ]
+        return([ (d2, i) for d2, row, i in sorted(found) ])
+
+    def query(self, colors: Iterable[Tuple[int, int, int]], k: int = None, radius: float = None) -> List[List[Dict]]:
+        """
+        Find the closest images to each of a batch of RGB colors, see nearest (default: the 10 closest)
+        Returns a list of matches for each color, each a dict of the row number in the table, path, RGB color, and distance
+        """
+        if k is None and radius is None:
+            k = 10
+        results = []
+        for rgb in colors:
+            point = color_points(self.space, *rgb)
+            matches = []
+            for d2, i in self.nearest(point, k = k, radius = radius):
+                matches.append({
+                    'row': int(self.rows[i]),
+                    'path': self.paths[i],
+                    'red': int(self.colors[3 * i]),
+                    'green': int(self.colors[3 * i + 1]),
+                    'blue': int(self.colors[3 * i + 2]),
+                    'distance': round(math.sqrt(d2), 3),
+                    })
+            results.append(matches)
+        return(results)
+
+class TablePaths(object):
+    """
+    Paths stored as one table of UTF-8 encoded bytes and the end offset of each one, used in place
+    """
+    def __init__(self, path_table: memoryview, offsets: Any):
+        self.path_table = path_table
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return(len(self.offsets) - 1)
+
+    def __getitem__(self, i: int) -> str:
+        return(os.fsdecode(bytes(self.path_table[self.offsets[i]:self.offsets[i + 1]])))
+
+def table_stamp(path: str) -> Tuple[int, int]:
+    """
+    Get the (size, modification time) of a table file, to tell if a ColorTree built from it is out of date
+    """
+    stat = os.stat(path)
+    return((stat.st_size, stat.st_mtime_ns))
+
+def open_color_tree(input_path: str, space: str = 'lab', tree_file: str = None, leaf_size: int = 16, rebuild: bool = False) -> ColorTree:
+    """
+    Load the ColorTree for a csv table or binary index, building and saving it first if there is none,
+    or if the table changed since it was built or it was built for another space or leaf size
+    The tree is saved to tree_file, by default next to the table as input_path + '.<space>.kdtree'
+    """
+    tree_file = tree_file or "{}.{}.kdtree".format(input_path, space)
+    stamp = table_stamp(input_path)
+    if not rebuild and os.path.exists(tree_file):
+        tree = ColorTree.load(tree_file)
+        if (tree.space, tree.leaf_size, tree.source) == (space, leaf_size, stamp):
+            return(tree)
+        tree.close()
+    if str(input_path).endswith('.idx'):
+        table = AvgTable.from_index(input_path)
+    else:
+        table = AvgTable.from_csv(input_path)
+    tree = ColorTree.build(table, space = space, leaf_size = leaf_size, source = stamp)
+    table.close()
+    tree.save(tree_file)
+    print("Built color tree {} for {} images".format(tree_file, len(tree)), file = sys.stderr)
+    return(tree)
+
+class ResultCache(object):
+    """
+    Persistent on-disk cache of image average results, stored in a SQLite database
+
+    Entries are keyed on the file path and a fingerprint of the parameters used to compute them (the ignore pixels),
+    and are only used while the file's size and modification time are unchanged.
+    With content_hash = True, a file whose size or modification time changed is still a hit if its contents hash the same
+    """
+    def __init__(self, path: str, content_hash: bool = False):
+        self.path = str(path)
+        self.content_hash = content_hash
+        self.read_only = False # set when saving to the cache fails
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok = True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT NOT NULL,
+                params TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                hash TEXT,
+                result TEXT NOT NULL,
+                PRIMARY KEY (path, params)
+            )""")
+        self.conn.commit()
+
+    def __enter__(self) -> ResultCache:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def params_key(
+            ignore_vals: List[Tuple[int, int, int]] = None,
+            approx: bool = False,
+            tolerance: float = None,
+            sample_pixels: int = APPROX_SAMPLE_PIXELS,
+            histogram_bins: int = 0,
+            *args, **kwargs) -> str:
+        """
+        Fingerprint of the parameters that change the computed results
+        The engine is not included since all engines give the same results
+        """
+        key = "ignore={}".format(ignore_fingerprint(ignore_vals))
+        if approx:
+            key += ";approx={};tolerance={}".format(sample_pixels, tolerance)
+        if histogram_bins:
+            key += ";histogram={}".format(histogram_bins)
+        return(key)
+
+    @staticmethod
+    def hash_file(path: str) -> str:
+        """
+        Get the sha1 of a file's contents, reading it in small chunks
+        """
+        with open(path, "rb") as f:
+            file_hash = hashlib.sha1()
+            chunk = f.read(1 << 20)
+            while chunk:
+                file_hash.update(chunk)
+                chunk = f.read(1 << 20)
+        return(file_hash.hexdigest())
+
+    def get(self, path: str, params: str) -> Dict:
+        """
+        Return the saved result dict for a path, or None if there is no valid entry for it
+        """
+        key = os.path.abspath(str(path))
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return(None)
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, hash, result FROM results WHERE path = ? AND params = ?", (key, params)).fetchone()
+        if row is None:
+            return(None)
+        size, mtime_ns, file_hash, result = row
+
+        if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+            if not self.content_hash or file_hash is None or file_hash != self.hash_file(key):
+                return(None)
+            # same contents with a new timestamp; refresh the entry so the next lookup does not need to hash it
+            self.conn.execute("UPDATE results SET size = ?, mtime_ns = ? WHERE path = ? AND params = ?",
+                (stat.st_size, stat.st_mtime_ns, key, params))
+
+        avg = json.loads(result)
+        avg['path'] = path
+        return(avg)
+
+    def get_many(self, paths: List[str], params: str) -> Dict[int, Dict]:
+        """
+        Look up a list of paths, returning a dict of the found results keyed by their index in the list
+        """
+        found = {}
+        for i, path in enumerate(paths):
+            avg = self.get(path, params)
+            if avg is not None:
+                found[i] = avg
+        self.conn.commit()
+        return(found)
+
+    def put_many(self, avgs: List[Dict], params: str):
+        """
+        Save a list of result dicts from Avg.get_avg_rgb_hsv
+        """
+        rows = []
+        for avg in avgs:
+            key = os.path.abspath(str(avg['path']))
+            stat = os.stat(key)
+            file_hash = self.hash_file(key) if self.content_hash else None
+            result = json.dumps({ k: v for k, v in avg.items() if k != 'path' })
+            rows.append((key, params, stat.st_size, stat.st_mtime_ns, file_hash, result))
+        if self.read_only:
+            return
+        try:
+            self.conn.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # e.g. a read-only or full disk; keep going with the results that were already calculated
+            print(">>> WARNING: could not save to cache file {}, no more results will be saved: {}".format(self.path, e), file = sys.stderr)
+            self.read_only = True
+
+    def prune(self) -> int:
+        """
+        Remove the entries for files that no longer exist or whose size or modification time changed
+        Returns the number of entries removed
+        """
+        stale = []
+        for path, params, size, mtime_ns in self.conn.execute("SELECT path, params, size, mtime_ns FROM results"):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stale.append((path, params))
+                continue
+            if (size, mtime_ns) != (stat.st_size, stat.st_mtime_ns):
+                stale.append((path, params))
+        self.conn.executemany("DELETE FROM results WHERE path = ? AND params = ?", stale)
+        self.conn.commit()
+        self.conn.execute("VACUUM")
+        return(len(stale))
+
+
+def open_cache(cache_file: str = None, cache_hash: bool = False) -> ResultCache:
+    """
+    Open the ResultCache for the CLI functions, or return None if caching is disabled
+    The cache is on by default, so a cache file that cannot be created (e.g. a read-only home dir) only gives a warning
+    """
+    if not cache_file:
+        return(None)
+    try:
+        return(ResultCache(cache_file, content_hash = cache_hash))
+    except (OSError, sqlite3.Error) as e:
+        print(">>> WARNING: could not open cache file {}, continuing without the cache: {}".format(cache_file, e), file = sys.stderr)
+        return(None)
+
+class TileCache(object):
+    """
+    Persistent on-disk cache of the resized tiles used by thumbnails, collage, and gif, stored in a SQLite database
+
+    Entries are keyed on the identity of the source file, its absolute path, size and modification time,
+    or with content_hash = True the sha1 of its contents so that moved and copied files share their tiles,
+    and on the parameters the tile was made with (its size and resample filter).
+    Once the saved tiles take up more than max_bytes, the least recently used ones are removed
+    """
+    def __init__(self, path: str, max_bytes: int = DEFAULT_TILE_CACHE_MB << 20, content_hash: bool = False):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        self.read_only = False # set when saving to the cache fails
+        self.hashes = {} # (path, size, mtime_ns): sha1 of the files hashed so far
+        self.hits = 0
+        self.misses = 0
+        cache_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(cache_dir, exist_ok = True)
+        self.conn = sqlite3.connect(self.path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS tiles (
+                source TEXT NOT NULL,
+                params TEXT NOT NULL,
+                mode TEXT NOT NULL,
+                width INTEGER NOT NULL,
+                height INTEGER NOT NULL,
+                palette BLOB,
+                data BLOB NOT NULL,
+                nbytes INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (source, params)
+            )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tiles_last_used ON tiles (last_used)")
+        self.conn.commit()
+
+    def __enter__(self) -> TileCache:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
+
+    @staticmethod
+    def params_key(img_width: int = 300, img_height: int = 300, resample: str = DEFAULT_RESAMPLE) -> str:
+        """
+        Fingerprint of the parameters that change the resized tile, see load_tile
+        """
+        return("size={}x{};resample={}".format(img_width, img_height, resample))
+
+    def source_key(self, path: str) -> str:
+        """
+        Get the key for the current contents of a file, or None if it can not be found
+        """
+        key = os.path.abspath(str(path))
+        try:
+            stat = os.stat(key)
+        except OSError:
+            return(None)
+        if not self.content_hash:
+            return("{}:{}:{}".format(key, stat.st_size, stat.st_mtime_ns))
+        file_id = (key, stat.st_size, stat.st_mtime_ns)
+        if file_id not in self.hashes:
+            self.hashes[file_id] = ResultCache.hash_file(key)
+        return("sha1:" + self.hashes[file_id])
+
+    def write(self, sql: str, rows: List[Tuple]) -> bool:
+        """
+        Run a statement that changes the cache for each of the rows, returning whether it was saved
+        """
+        if self.read_only or not rows:
+            return(False)
+        try:
+            self.conn.executemany(sql, rows)
+            self.conn.commit()
+        except sqlite3.Error as e:
+            # e.g. a read-only or full disk; keep going with the tiles that were already made
+            print(">>> WARNING: could not save to tile cache file {}, no more tiles will be saved: {}".format(self.path, e), file = sys.stderr)
+            self.read_only = True
+            return(False)
+        return(True)
+
+    def find_many(self, paths: List[str], params: str) -> Dict[int, str]:
+        """
+        Look up a list of paths, returning a dict of the source keys of the saved tiles keyed by their index in the list;
+        the found tiles are marked as used so they are the last to be removed
+        """
+        found = {}
+        for i, path in enumerate(paths):
+            source = self.source_key(path)
+            if source is not None and self.conn.execute(
+                    "SELECT 1 FROM tiles WHERE source = ? AND params = ?", (source, params)).fetchone():
+                found[i] = source
+        self.hits += len(found)
+        self.misses += len(paths) - len(found)
+        now = time.time()
+        self.write("UPDATE tiles SET last_used = ? WHERE source = ? AND params = ?",
+            [ (now, source, params) for source in found.values() ])
+        return(found)
+
+    def load(self, source: str, params: str) -> Image:
+        """
+        Get the saved tile for a source key from find_many, or None if it is no longer in the cache
+        """
+        row = self.conn.execute(
+            "SELECT mode, width, height, palette, data FROM tiles WHERE source = ? AND params = ?", (source, params)).fetchone()
+        if row is None:
+            return(None)
+        mode, width, height, palette, data = row
+        tile = Image.frombytes(mode, (width, height), zlib.decompress(data))
+        if palette is not None:
+            tile.putpalette(palette)
+        return(tile)
+
+    def get_many(self, paths: List[str], params: str) -> Dict[int, Image]:
+        """
+        Look up a list of paths, returning a dict of the saved tiles keyed by their index in the list
+        """
+        found = {}
+        for i, source in self.find_many(paths, params).items():
+            tile = self.load(source, params)
+            if tile is not None:
+                found[i] = tile
+        return(found)
+
+    def put_many(self, tiles: List[Tuple[str, Image]], params: str):
+        """
+        Save a list of (path, tile) pairs, then remove the least recently used tiles if the cache is over its size limit
+        """
+        rows = []
+        now = time.time()
+        for path, tile in tiles:
+            source = self.source_key(path)
+            if source is None:
+                continue
+            # a fast compression level, the tiles are saved as they are made
+            data = zlib.compress(tile.tobytes(), 1)
+            palette = bytes(tile.getpalette()) if tile.mode in ('P', 'PA') else None
+            rows.append((source, params, tile.mode, tile.size[0], tile.size[1], palette, data, len(data), now))
+        if self.write("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows):
+            self.evict()
+
+    def evict(self) -> int:
+        """
+        Remove the least recently used tiles until the cache is within its size limit
+        Returns the number of tiles removed
+        """
+        total = self.conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM tiles").fetchone()[0]
+        if total <= self.max_bytes:
+            return(0)
+        old = []
+        for source, params, nbytes in self.conn.execute("SELECT source, params, nbytes FROM tiles ORDER BY last_used").fetchall():
+            if total <= self.max_bytes:
+                break
+            old.append((source, params))
+            total -= nbytes
+        self.write("DELETE FROM tiles WHERE source = ? AND params = ?", old)
+        return(len(old))
+
+def open_tile_cache(tile_cache_file: str = None, cache_hash: bool = False, max_mb: int = DEFAULT_TILE_CACHE_MB) -> TileCache:
+    """
+    Open the TileCache for the CLI functions, or return None if tile caching is disabled
+    Like open_cache, a cache file that cannot be created only gives a warning
+    """
+    if not tile_cache_file:
+        return(None)
+    try:
+        return(TileCache(tile_cache_file, max_bytes = max_mb << 20, content_hash = cache_hash))
+    except (OSError, sqlite3.Error) as e:
+        print(">>> WARNING: could not open tile cache file {}, continuing without it: {}".format(tile_cache_file, e), file = sys.stderr)
+        return(None)
+
+class StageTimer(object):
+    """
+    Times the steps of processing one image, for --profile; the time since the last lap is added to the named step
+    """
+    __slots__ = ('start', 'last', 'stages')
+
+    def __init__(self):
+        self.start = self.last = time.perf_counter()
+        self.stages = {}
+
+    def lap(self, stage: str):
+        now = time.perf_counter()
+        self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+        self.last = now
+
+    def record(self, path: str, pixels: int = None, merge: Dict = None) -> Dict:
+        """
+        Get the profile record for the image; the step times of another record for the same image can be added in with merge
+        """
+        stages = dict(self.stages)
+        total = self.last - self.start
+        if merge:
+            for stage, seconds in merge['stages'].items():
+                stages[stage] = stages.get(stage, 0.0) + seconds
+            total += merge['total']
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            size = None
+        return({'path': str(path), 'pid': os.getpid(), 'bytes': size, 'pixels': pixels, 'total': total, 'stages': stages})
+
+def percentile(values: List[float], pct: float) -> float:
+    """
+    Get a percentile of a sorted list of values, by the nearest rank
+    """
+    if not values:
+        return(None)
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return(values[max(0, rank - 1)])
+
+class Profiler(object):
+    """
+    Collects the per-image timings from the workers for --profile and --metrics
+
+    Each image is written to the profile file as a line of JSON as soon as its timings arrive,
+    followed by a summary line when the profiler is closed; with metrics = True the summary is also printed to stderr.
+    The time spent on steps of the whole run in the main process, like searching the dirs, is kept by stage and timed
+    """
+    def __init__(self, profile_file: str = None, metrics: bool = False, slowest: int = 10):
+        self.path = profile_file
+        self.file = open(profile_file, "w") if profile_file else None
+        self.metrics = metrics
+        self.slowest = slowest
+        self.start = time.perf_counter()
+        self.times = collections.defaultdict(lambda: array.array('d')) # step: seconds for each computed image
+        self.run_stages = collections.OrderedDict() # step of the whole run: seconds
+        self.slowest_heap = [] # (total seconds, path) of the slowest images
+        self.sections = {} # statistics from other parts of the run, e.g. 'prefetch', see Prefetcher.close
+        self.computed = 0
+        self.cached = 0
+        self.pixels = 0
+        self.bytes = 0
+
+    def __enter__(self) -> Profiler:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def add(self, record: Dict, cached: bool = False):
+        """
+        Add the profile record of an image; cached images only had their tile made, or nothing at all
+        """
+        record = dict(record, type = 'image', cached = cached)
+        if self.file:
+            self.file.write(json.dumps(record) + "\n")
+        if cached:
+            self.cached += 1
+            return
+        self.computed += 1
+        self.pixels += record.get('pixels') or 0
+        self.bytes += record.get('bytes') or 0
+        self.times['total'].append(record['total'])
+        for stage, seconds in record['stages'].items():
+            self.times[stage].append(seconds)
+        item = (record['total'], record['path'])
+        if len(self.slowest_heap) < self.slowest:
+            heapq.heappush(self.slowest_heap, item)
+        elif self.slowest:
+            heapq.heappushpop(self.slowest_heap, item)
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Time a step of the whole run
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.run_stages[name] = self.run_stages.get(name, 0.0) + time.perf_counter() - start
+
+    def timed(self, name: str, items: Iterable) -> Generator[Any, None, None]:
+        """
+        Yield the items of an iterable, adding the time spent getting each one to a step of the whole run
+        """
+        items = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield(item)
+
+    def summary(self) -> Dict:
+        """
+        Get the throughput, the percentiles of the time spent on each step per image, and the slowest images
+        """
+        wall_time = time.perf_counter() - self.start
+        images = self.computed + self.cached
+        stages = collections.OrderedDict()
+        for stage, times in sorted(self.times.items(), key = lambda item: item[0] == 'total'):
+            times = sorted(times)
+            stages[stage] = {
+                'sum': sum(times),
+                'p50': percentile(times, 50),
+                'p90': percentile(times, 90),
+                'p99': percentile(times, 99),
+                'max': times[-1],
+                }
+        return({
+            'type': 'summary',
+            'images': images,
+            'computed': self.computed,
+            'cached': self.cached,
+            'wall_time': wall_time,
+            'images_per_s': images / wall_time if wall_time else None,
+            'megapixels_per_s': self.pixels / 1e6 / wall_time if wall_time else None,
+            'bytes': self.bytes,
+            'stages': stages,
+            'run_stages': dict(self.run_stages),
+            'slowest': [ {'path': path, 'total': total} for total, path in sorted(self.slowest_heap, reverse = True) ],
+            **self.sections
+            })
+
+    def print_summary(self, summary: Dict, output = sys.stderr):
+        """
+        Print a summary from the summary method in a readable form
+        """
+        print(">>> {images} images ({computed} computed, {cached} cached) in {wall_time:.2f}s: {images_per_s:.1f} images/s, {megapixels_per_s:.1f} MP/s".format(
+            **summary), file = output)
+        for stage, seconds in summary['run_stages'].items():
+            print("    {:<10} {:10.3f}s".format(stage, seconds), file = output)
+        if 'prefetch' in summary:
+            print("    prefetch: {files} files, {megabytes:.1f} MB read in {read_seconds:.2f}s by {readers} readers; "
+                "waited {wait_seconds:.2f}s for reads".format(**summary['prefetch']), file = output)
+        if summary['stages']:
+            print("    {:<10} {:>10} {:>10} {:>10} {:>10} {:>10}".format('per image', 'sum', 'p50', 'p90', 'p99', 'max'), file = output)
+            for stage, times in summary['stages'].items():
+                print("    {:<10} {sum:10.3f}s {p50:10.4f}s {p90:10.4f}s {p99:10.4f}s {max:10.4f}s".format(stage, **times), file = output)
+        if summary['slowest']:
+            print("    slowest images:", file = output)
+            for item in summary['slowest']:
+                print("    {total:10.4f}s {path}".format(**item), file = output)
+
+    def close(self):
+        """
+        Write the summary to the profile file, and print it with metrics
+        """
+        summary = self.summary()
+        if self.file:
+            self.file.write(json.dumps(summary) + "\n")
+            self.file.close()
+            self.file = None
+        if self.metrics:
+            self.print_summary(summary)
+        return(summary)
+
+def open_profiler(profile_file: str = None, metrics: bool = False, slowest: int = 10) -> Profiler:
+    """
+    Make the Profiler for the CLI functions, or return None if neither a profile file nor metrics were asked for,
+    in which case nothing is timed
+    """
+    if not profile_file and not metrics:
+        return(None)
+    return(Profiler(profile_file, metrics = metrics, slowest = slowest))
+
+def profile_stage(profiler: Profiler, name: str) -> Any:
+    """
+    Time a step of the whole run with the profiler, or do nothing if there is none
+    """
+    if profiler is None:
+        return(contextlib.nullcontext())
+    return(profiler.stage(name))
+
+def profile_items(profiler: Profiler, name: str, items: Iterable) -> Iterable:
+    """
+    Add the time spent getting the items of an iterable to a step of the whole run, if there is a profiler
+    """
+    if profiler is None:
+        return(items)
+    return(profiler.timed(name, items))
+
+def read_file(path: str) -> Tuple[bytes, float]:
+    """
+    Read the contents of a file and return them along with the seconds it took; this is the task run by the Prefetcher readers
+    """
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        data = f.read()
+    return(data, time.perf_counter() - start)
+
+class Prefetcher(object):
+    """
+    Reads the contents of upcoming files in background threads, ahead of the workers that decode them
+
+    On slow or network filesystems the workers would otherwise spend much of their time waiting for bytes;
+    the reads are done by readers threads instead, and the workers decode the files from memory.
+    At most depth files are read ahead, and no more are started while the files that were read and not yet
+    handed on take up memory bytes or more.
+    Keeps the time spent reading, and the time the caller had to wait for reads that were not done yet,
+    which is the I/O wait that is left
+    """
+    def __init__(self, depth: int = 16, memory: int = 256 << 20, readers: int = 8):
+        self.depth = max(1, depth)
+        self.memory = memory
+        self.readers = readers
+        self.pool = concurrent.futures.ThreadPoolExecutor(readers)
+        self.files = 0
+        self.bytes = 0
+        self.read_seconds = 0.0
+        self.wait_seconds = 0.0
+
+    def __enter__(self) -> Prefetcher:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def prefetch(self, items: Iterable, paths: Callable = None) -> Generator[Tuple[Any, List[bytes]], None, None]:
+        """
+        Yield each item with the contents of its files, in order; paths gets the list of files for an item (default: the item is the path)
+        """
+        items = iter(items)
+        pending = collections.deque() # (item, futures) for the items whose files are being read
+        queued = 0 # number of files being read or waiting to be handed on
+        exhausted = False
+        while True:
+            while not exhausted and queued < self.depth and self.held(pending) < self.memory:
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                futures = [ self.pool.submit(read_file, path) for path in (paths(item) if paths else [item]) ]
+                pending.append((item, futures))
+                queued += len(futures)
+            if not pending:
+                return
+            item, futures = pending.popleft()
+            queued -= len(futures)
+            start = time.perf_counter()
+            results = [ future.result() for future in futures ]
+            self.wait_seconds += time.perf_counter() - start
+            for data, seconds in results:
+                self.files += 1
+                self.bytes += len(data)
+                self.read_seconds += seconds
+            yield(item, [ data for data, seconds in results ])
+
+    @staticmethod
+    def held(pending: Iterable) -> int:
+        """
+        Get the number of bytes of the files that have been read and not yet handed on
+        """
+        return(sum( len(future.result()[0]) for item, futures in pending for future in futures
+            if future.done() and not future.exception() ))
+
+    def stats(self) -> Dict:
+        return({
+            'files': self.files,
+            'megabytes': self.bytes / 1e6,
+            'readers': self.readers,
+            'depth': self.depth,
+            'read_seconds': self.read_seconds,
+            'wait_seconds': self.wait_seconds,
+            })
+
+    def close(self, profiler: Profiler = None):
+        """
+        Stop the reader threads, and add the statistics to the summary of the profiler, if any
+        """
+        self.pool.shutdown(wait = True)
+        if profiler:
+            profiler.sections['prefetch'] = self.stats()
+
+def open_prefetcher(depth: int = 0, memory: int = 256, readers: int = 8) -> Prefetcher:
+    """
+    Make the Prefetcher for the CLI functions, reading up to depth files and memory MB ahead,
+    or return None if depth is 0 and files are read by the workers
+    """
+    if not depth:
+        return(None)
+    return(Prefetcher(depth = int(depth), memory = int(memory) << 20, readers = int(readers)))
+
+def ignore_fingerprint(ignore_vals: List[Tuple[int, int, int]] = None) -> str:
+    """
+    Get a short hash that identifies a set of ignore pixels regardless of their order
+    """
+    ignore = IgnoreTable.coerce(ignore_vals)
+    if not ignore:
+        return('none')
+    return(ignore.fingerprint())
+
+class IgnoreTable(object):
+    """
+    Lookup table of the RGB colors to ignore when calculating averages
+
+    Holds one bit for each of the 2**24 possible colors (a 2 MB bitmap), so checking a pixel takes constant time
+    no matter how many colors are ignored, and whole arrays of pixels can be checked at once with numpy.
+    Bit number (red << 16) | (green << 8) | blue is set for each ignored color
+    """
+    size = 1 << 24 # number of RGB colors
+    _unpickled = {} # tables already received by this process, by fingerprint, so each one is only unpacked once
+
+    def __init__(self, bitmap: bytes = None):
+        self.bitmap = bytes(bitmap) if bitmap is not None else bytes(self.size // 8)
+        self.empty = self.bitmap == bytes(len(self.bitmap)) # checked once here instead of on every lookup
+        self._count = None # number of ignored colors, counted when it is first needed
+        self._fingerprint = None
+        self._lut = None # unpacked numpy version of the bitmap, made when it is first needed
+
+    def __getstate__(self) -> Dict:
+        # the bitmap is mostly zeros so it compresses to a few KB for sending to worker processes
+        return({'packed': zlib.compress(self.bitmap), 'fingerprint': self.fingerprint()})
+
+    def __setstate__(self, state: Dict):
+        known = IgnoreTable._unpickled.get(state['fingerprint'])
+        if known is not None:
+            # share the bitmap and lookup array with the copy this process already has
+            self.__dict__.update(known.__dict__)
+            return
+        self.__init__(zlib.decompress(state['packed']))
+        if len(IgnoreTable._unpickled) >= 4:
+            IgnoreTable._unpickled.clear()
+        IgnoreTable._unpickled[state['fingerprint']] = self
+
+    def __bool__(self) -> bool:
+        return(not self.empty)
+
+    def __len__(self) -> int:
+        if self._count is None:
+            self._count = bin(int.from_bytes(self.bitmap, 'little')).count('1')
+        return(self._count)
+
+    def __contains__(self, rgb: Tuple[int, int, int]) -> bool:
+        code = (rgb[0] << 16) | (rgb[1] << 8) | rgb[2]
+        return(bool((self.bitmap[code >> 3] >> (code & 7)) & 1))
+
+    @classmethod
+    def from_pixels(cls, pixels: Iterable[Tuple[int, int, int]], tolerance: int = 0) -> IgnoreTable:
+        """
+        Make a table from RGB tuples; see expand for tolerance
+        """
+        bitmap = bytearray(cls.size // 8)
+        for red, green, blue in set( tuple(p) for p in pixels ):
+            code = (red << 16) | (green << 8) | blue
+            bitmap[code >> 3] |= 1 << (code & 7)
+        return(cls(bitmap).expand(tolerance))
+
+    @classmethod
+    def from_file(cls, path: str, tolerance: int = 0) -> IgnoreTable:
+        """
+        Make a table from all the colors in an image file; see expand for tolerance
+        """
+        img = Image.open(path).convert('RGB')
+        if np is None:
+            return(cls.from_pixels(img.getdata(), tolerance = tolerance))
+        flags = np.zeros(cls.size, dtype = np.bool_)
+        flags[rgb_codes(np.asarray(img).reshape(-1, 3))] = True
+        return(cls(np.packbits(flags, bitorder = 'little').tobytes()).expand(tolerance))
+
+    @classmethod
+    def coerce(cls, ignore_vals: Any = None) -> IgnoreTable:
+        """
+        Return an IgnoreTable for a table or a list of RGB tuples, or None if there is nothing to ignore
+        """
+        if isinstance(ignore_vals, cls):
+            return(None if ignore_vals.empty else ignore_vals)
+        if not ignore_vals:
+            return(None)
+        return(cls.from_pixels(ignore_vals))
+
+    def expand(self, tolerance: int = 0) -> IgnoreTable:
+        """
+        Return a table that also ignores every color within tolerance of an ignored color,
+        where the distance between two colors is their largest difference in any one channel
+
+        The bitmap is treated as a 256 x 256 x 256 cube of bits held in one integer and grown along each channel
+        with shifts, so the work depends on the tolerance and not on the number of ignored colors
+        """
+        if tolerance <= 0:
+            return(self)
+        tolerance = min(int(tolerance), 255)
+        all_bits = (1 << self.size) - 1
+        cube = int.from_bytes(self.bitmap, 'little')
+        for stride in [1, 256, 65536]: # blue, green, red channels
+            block = 256 * stride # bits in one full run of the channel
+            repeats = self.size // block
+            grown = cube
+            for k in range(1, tolerance + 1):
+                shift = k * stride
+                # keep the shifted bits that stay inside the same run of the channel
+                up_mask = ((1 << block) - 1) ^ ((1 << shift) - 1)
+                down_mask = (1 << (block - shift)) - 1
+                if repeats > 1:
+                    nbytes = block // 8 if block >= 8 else 1
+                    up_mask = int.from_bytes(up_mask.to_bytes(nbytes, 'little') * repeats, 'little')
+                    down_mask = int.from_bytes(down_mask.to_bytes(nbytes, 'little') * repeats, 'little')
+                grown |= ((cube << shift) & up_mask & all_bits) | ((cube >> shift) & down_mask)
+            cube = grown
+        return(IgnoreTable(cube.to_bytes(self.size // 8, 'little')))
+
+    def fingerprint(self) -> str:
+        """
+        Get a short hash that identifies the set of ignored colors
+        """
+        if self._fingerprint is None:
+            self._fingerprint = hashlib.sha1(self.bitmap).hexdigest()
+        return(self._fingerprint)
+
+    @property
+    def lut(self) -> np.ndarray:
+        """
+        Boolean numpy array with one entry per color, True for the ignored colors
+        """
+        if self._lut is None:
+            self._lut = np.unpackbits(np.frombuffer(self.bitmap, dtype = np.uint8), bitorder = 'little').view(np.bool_)
+        return(self._lut)
+
+    def mask(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Get a boolean array that is True for each ignored pixel in an N x 3 array of RGB pixels
+        """
+        return(self.lut[rgb_codes(pixels)])
+
+def load_ignore_table(ignore_file: str = None, tolerance: int = 0) -> IgnoreTable:
+    """
+    Load the ignore pixels for the CLI functions, or return None if no ignore file was given
+    """
+    if not ignore_file:
+        return(None)
+    return(IgnoreTable.from_file(ignore_file, tolerance = tolerance))
+
+def rgb_codes(pixels: np.ndarray) -> np.ndarray:
+    """
+    Pack each row of an N x 3 array of RGB pixels into a single 24-bit integer, so whole pixels can be compared at once
+    """
+    return((pixels[:, 0].astype(np.uint32) << 16) | (pixels[:, 1].astype(np.uint32) << 8) | pixels[:, 2])
+
+def approx_sum_pixels(
+        img: Image,
+        ignore: IgnoreTable = None,
+        engine: str = DEFAULT_ENGINE,
+        sample_pixels: int = APPROX_SAMPLE_PIXELS) -> Tuple[int, int, int, int, int, float]:
+    """
+    Add up the red, green, and blue values of a sample of about sample_pixels pixels from an opened (not yet loaded) image
+
+    JPEG files are decoded at the smallest reduced scale that still has at least sample_pixels pixels,
+    then one pixel is taken from the centre of each cell of an evenly spaced grid over the decoded image.
+    Returns the three sums, the number of sampled pixels counted, the number of pixels sampled,
+    and the estimated error of the averages: the largest 95% confidence interval half-width of the three channels
+    ignore is a non-empty IgnoreTable (see IgnoreTable.coerce) or None
+    """
+    size_x, size_y = img.size
+    if size_x * size_y > sample_pixels:
+        scale = math.sqrt(sample_pixels / float(size_x * size_y))
+        img.draft('RGB', (max(1, int(size_x * scale)), max(1, int(size_y * scale))))
+    img = img.convert('RGB')
+
+    # take one pixel from each step x step cell
+    step = max(1, int(math.sqrt(img.size[0] * img.size[1] / float(sample_pixels))))
+    if step > 1:
+        img = img.resize((img.size[0] // step, img.size[1] // step), Image.NEAREST)
+    sampled = img.size[0] * img.size[1]
+
+    if engine == 'numpy':
+        pixels = np.asarray(img).reshape(-1, 3)
+        if ignore is not None:
+            pixels = pixels[~ignore.mask(pixels)]
+        sums = [ int(v) for v in pixels.sum(axis = 0, dtype = np.uint64) ]
+        squares = [ int(v) for v in (pixels.astype(np.uint64) ** 2).sum(axis = 0) ]
+        counted = int(pixels.shape[0])
+    else:
+        sums = [0, 0, 0]
+        squares = [0, 0, 0]
+        counted = 0
+        bitmap = ignore.bitmap if ignore is not None else None
+        for pixel in img.getdata():
+            if bitmap is not None:
+                code = (pixel[0] << 16) | (pixel[1] << 8) | pixel[2]
+                if (bitmap[code >> 3] >> (code & 7)) & 1:
+                    continue
+            for i in range(3):
+                sums[i] += pixel[i]
+                squares[i] += pixel[i] ** 2
+            counted += 1
+
+    # standard error of the mean for each channel; there is no error if every pixel was visited
+    error = 0.0
+    if counted > 1 and sampled < size_x * size_y:
+        for total, total_sq in zip(sums, squares):
+            variance = max(0.0, (total_sq - total * total / float(counted)) / (counted - 1))
+            error = max(error, 1.96 * math.sqrt(variance / counted))
+    return(sums[0], sums[1], sums[2], counted, sampled, round(error, 2))
+
+def sum_pixels_python(
+        img: Image,
+        ignore: IgnoreTable = None) -> Tuple[int, int, int, int]:
+    """
+    Add up the red, green, and blue values of all pixels in an RGB image, one pixel at a time
+    Returns the three sums and the number of pixels that were counted
+    ignore is a non-empty IgnoreTable (see IgnoreTable.coerce) or None
+    """
+    # check if there are some pixels to ignore
+    bitmap = ignore.bitmap if ignore is not None else None
+
+    pixels = img.load()
+    red_sum = 0
+    green_sum = 0
+    blue_sum = 0
+    counted = 0
+    for x in range(img.size[0]): # iterate over all x pixels
+        for y in range(img.size[1]): # iterate over all y pixels
+            red, green, blue = pixels[x, y]
+
+            # skip the pixel if it matches one of the ignored pixels
+            if bitmap is not None:
+                code = (red << 16) | (green << 8) | blue
+                if (bitmap[code >> 3] >> (code & 7)) & 1:
+                    continue
+            red_sum += red
+            green_sum += green
+            blue_sum += blue
+            counted += 1
+    return(red_sum, green_sum, blue_sum, counted)
+
+def sum_pixels_numpy(
+        img: Image,
+        ignore: IgnoreTable = None) -> Tuple[int, int, int, int]:
+    """
+    Add up the red, green, and blue values of all pixels in an RGB image using numpy arrays
+    Returns the same values as sum_pixels_python
+    """
+    pixels = np.asarray(img).reshape(-1, 3)
+
+    if ignore is not None:
+        pixels = pixels[~ignore.mask(pixels)]
+
+    sums = pixels.sum(axis = 0, dtype = np.uint64)
+    return(int(sums[0]), int(sums[1]), int(sums[2]), int(pixels.shape[0]))
+
+# number of histogram bins per channel for --histogram without a value
+DEFAULT_HISTOGRAM_BINS = 8
+# number of the most common exact colors of an image kept in its histogram, see ColorHistogram
+HISTOGRAM_PEAKS = 16
+
+def check_histogram_bins(bins: Any) -> int:
+    """
+    Check a number of histogram bins per channel, which must be a power of two from 1 to 64
+    """
+    bins = int(bins)
+    if bins not in [ 1 << n for n in range(7) ]:
+        print(">>> ERROR: histogram bins must be a power of two from 1 to 64: {}".format(bins))
+        raise ValueError("bad number of histogram bins: {}".format(bins))
+    return(bins)
+
+def weighted_percentile(values: List[float], weights: List[int], pct: float) -> float:
+    """
+    Get a percentile of values that each stand for weight items, by the nearest rank
+    """
+    total = sum(weights)
+    if not total:
+        return(None)
+    rank = max(1, int(math.ceil(pct / 100.0 * total)))
+    seen = 0
+    for value, weight in sorted(zip(values, weights)):
+        seen += weight
+        if seen >= rank:
+            return(value)
+
+class ColorHistogram(object):
+    """
+    Quantized 3-D color histogram of an image, saved next to its averages so that other statistics can be found later
+    without decoding the image again
+
+    The RGB cube is split into bins x bins x bins cells, and each cell that has any pixels holds
+    [number of pixels, sum of red, sum of green, sum of blue] for them, so the averages it gives back are exact.
+    The exact counts of the image's most common colors (its peaks, e.g. a plain background) are kept as well.
+    Statistics that need single pixels, like ignoring colors or medians, are estimated by treating the rest of each cell
+    as its number of pixels of its average color
+    """
+    __slots__ = ('bins', 'cells', 'peaks')
+    header = struct.Struct("<BII") # bins, number of cells, number of peaks
+
+    def __init__(self, bins: int = DEFAULT_HISTOGRAM_BINS, cells: Dict[int, List[int]] = None, peaks: Dict[int, int] = None):
+        self.bins = check_histogram_bins(bins)
+        self.cells = cells if cells is not None else {} # cell number: [count, red sum, green sum, blue sum]
+        self.peaks = peaks if peaks is not None else {} # (red << 16) | (green << 8) | blue: count
+
+    @classmethod
+    def from_image(cls,
+            img: Image,
+            bins: int = DEFAULT_HISTOGRAM_BINS,
+            engine: str = DEFAULT_ENGINE,
+            peaks: int = HISTOGRAM_PEAKS) -> ColorHistogram:
+        """
+        Count all the pixels of an RGB image into a histogram, keeping the counts of the peaks most common colors
+        The cell of a pixel is (red >> shift) * bins * bins + (green >> shift) * bins + (blue >> shift)
+        """
+        hist = cls(bins)
+        shift = 8 - (bins.bit_length() - 1)
+        if engine == 'numpy':
+            pixels = np.asarray(img).reshape(-1, 3)
+            cell = ((pixels[:, 0] >> shift).astype(np.int64) * bins + (pixels[:, 1] >> shift)) * bins + (pixels[:, 2] >> shift)
+            cells = bins ** 3
+            counts = np.bincount(cell, minlength = cells)
+            # sums are exact in float64 up to 2**53, far more than 255 x the pixels of any image
+            sums = [ np.bincount(cell, weights = pixels[:, i], minlength = cells) for i in range(3) ]
+            for c in np.flatnonzero(counts):
+                hist.cells[int(c)] = [int(counts[c]), int(sums[0][c]), int(sums[1][c]), int(sums[2][c])]
+            codes, code_counts = np.unique(rgb_codes(pixels), return_counts = True)
+            # most common first, then by color
+            for i in np.lexsort((codes, -code_counts))[:peaks]:
+                hist.peaks[int(codes[i])] = int(code_counts[i])
+        else:
+            code_counts = collections.Counter()
+            for red, green, blue in img.getdata():
+                c = ((red >> shift) * bins + (green >> shift)) * bins + (blue >> shift)
+                entry = hist.cells.get(c)
+                if entry is None:
+                    hist.cells[c] = [1, red, green, blue]
+                else:
+                    entry[0] += 1
+                    entry[1] += red
+                    entry[2] += green
+                    entry[3] += blue
+                code_counts[(red << 16) | (green << 8) | blue] += 1
+            for code, count in sorted(code_counts.items(), key = lambda item: (-item[1], item[0]))[:peaks]:
+                hist.peaks[code] = count
+        return(hist)
+
+    def encode(self) -> str:
+        """
+        Pack the histogram into a short string for a csv cell or the cache: the cell numbers, the counts and sums,
+        then the peak colors and their counts, as little-endian integers compressed with zlib and base64 encoded
+        """
+        cells = sorted(self.cells)
+        peaks = list(self.peaks)
+        data = self.header.pack(self.bins, len(cells), len(peaks))
+        data += struct.pack("<{}I".format(len(cells)), *cells)
+        for i in range(4):
+            data += struct.pack("<{}Q".format(len(cells)), *[ self.cells[c][i] for c in cells ])
+        data += struct.pack("<{}I".format(len(peaks)), *peaks)
+        data += struct.pack("<{}Q".format(len(peaks)), *[ self.peaks[code] for code in peaks ])
+        return(base64.b64encode(zlib.compress(data, 9)).decode('ascii'))
+
+    @classmethod
+    def decode(cls, text: str) -> ColorHistogram:
+        """
+        Get back a histogram from the string made by encode
+        """
+        data = zlib.decompress(base64.b64decode(text))
+        bins, n, n_peaks = cls.header.unpack_from(data)
+        offset = cls.header.size
+        cells = struct.unpack_from("<{}I".format(n), data, offset)
+        offset += 4 * n
+        values = []
+        for i in range(4):
+            values.append(struct.unpack_from("<{}Q".format(n), data, offset))
+            offset += 8 * n
+        peaks = struct.unpack_from("<{}I".format(n_peaks), data, offset)
+        offset += 4 * n_peaks
+        peak_counts = struct.unpack_from("<{}Q".format(n_peaks), data, offset)
+        return(cls(bins, { c: [ v[j] for v in values ] for j, c in enumerate(cells) }, dict(zip(peaks, peak_counts))))
+
+    @property
+    def pixels_total(self) -> int:
+        return(sum( entry[0] for entry in self.cells.values() ))
+
+    def colors(self, ignore: IgnoreTable = None) -> List[Tuple[int, int, int, int]]:
+        """
+        Get the pixels of the histogram as (count, red sum, green sum, blue sum) groups of one color each:
+        each peak color, then the rest of each cell as its average color
+
+        With ignore (see IgnoreTable.coerce), the ignored peak colors are left out exactly,
+        and so is the rest of a cell when its average color is ignored. This is exact when every ignored color
+        in the image is a peak or fills its cell with other ignored colors, and an estimate when it is not
+        """
+        shift = 8 - (self.bins.bit_length() - 1)
+        rest = { c: list(entry) for c, entry in self.cells.items() }
+        colors = []
+        for code, count in self.peaks.items():
+            rgb = (code >> 16, (code >> 8) & 255, code & 255)
+            entry = rest[((rgb[0] >> shift) * self.bins + (rgb[1] >> shift)) * self.bins + (rgb[2] >> shift)]
+            entry[0] -= count
+            for i in range(3):
+                entry[i + 1] -= count * rgb[i]
+            if ignore is None or rgb not in ignore:
+                colors.append((count, count * rgb[0], count * rgb[1], count * rgb[2]))
+        for count, red, green, blue in rest.values():
+            if not count:
+                continue
+            if ignore is not None and (red // count, green // count, blue // count) in ignore:
+                continue
+            colors.append((count, red, green, blue))
+        return(colors)
+
+    def avg(self, ignore_vals: List[Tuple[int, int, int]] = None) -> Dict:
+        """
+        Get the same values as Avg.get_avg_rgb_hsv from the histogram
+        Without ignore_vals they are exact; with them, see colors
+        """
+        colors = self.colors(IgnoreTable.coerce(ignore_vals))
+        counted = sum( color[0] for color in colors )
+        if not counted:
+            print(">>> ERROR: all the pixels of the histogram are ignored")
+            raise ValueError("no pixels left after ignoring colors")
+        avg = {
+            'red': sum( color[1] for color in colors ) // counted,
+            'green': sum( color[2] for color in colors ) // counted,
+            'blue': sum( color[3] for color in colors ) // counted,
+            'pixels_total': self.pixels_total,
+            'pixels_counted': counted,
+            }
+        avg['hue'], avg['saturation'], avg['value'] = colorsys.rgb_to_hsv(avg['red'], avg['green'], avg['blue'])
+        avg['pixels_pcnt'] = round((float(counted) / float(avg['pixels_total'])) * 100, 1)
+        return(avg)
+
+    def stats(self, ignore_vals: List[Tuple[int, int, int]] = None, dominant: int = 3) -> Dict:
+        """
+        Estimate more statistics of the (not ignored) pixels from the histogram:
+        the median of each channel, the 10th, 50th and 90th percentiles of saturation and value (in the units of the
+        averages), and the dominant colors: the average colors of the cells with the most pixels
+        with the percent of the counted pixels in each, as 'rrggbb:percent' separated by spaces
+        """
+        colors = [ (count, red // count, green // count, blue // count)
+            for count, red, green, blue in self.colors(IgnoreTable.coerce(ignore_vals)) ]
+        counts = [ color[0] for color in colors ]
+        counted = sum(counts)
+        stats = {}
+        for i, name in enumerate(['red', 'green', 'blue'], 1):
+            stats['median_' + name] = weighted_percentile([ color[i] for color in colors ], counts, 50)
+        hsv = [ colorsys.rgb_to_hsv(*color[1:]) for color in colors ]
+        for i, name in [(1, 'saturation'), (2, 'value')]:
+            values = [ round(v[i], 4) for v in hsv ]
+            for pct in [10, 50, 90]:
+                stats['{}_p{}'.format(name, pct)] = weighted_percentile(values, counts, pct)
+
+        # group the colors back into their cells
+        shift = 8 - (self.bins.bit_length() - 1)
+        cells = {}
+        for count, red, green, blue in colors:
+            c = ((red >> shift) * self.bins + (green >> shift)) * self.bins + (blue >> shift)
+            entry = cells.setdefault(c, [0, 0, 0, 0])
+            for i, value in enumerate([count, count * red, count * green, count * blue]):
+                entry[i] += value
+        top = sorted(cells.values(), key = lambda entry: -entry[0])[:dominant]
+        stats['dominant'] = ' '.join( '{:02x}{:02x}{:02x}:{:.1f}'.format(
+            red // count, green // count, blue // count, 100.0 * count / counted) for count, red, green, blue in top )
+        return(stats)
+
+
+# ~~~~~ CLI ~~~~~ #
+# functions for running the module as a command line script
+def load_all_pixels(path: str) -> List[Tuple[int, int, int]]:
+    all_pixels = []
+    # load the unique pixels from the file
+    img = Image.open(path).convert('RGB')
+    pixels = img.load()
+    size_x = img.size[0]
+    size_y = img.size[1]
+
+    for x in range(img.size[0]): # iterate over all x pixels
+        for y in range(img.size[1]): # iterate over all y pixels
+            red = pixels[x, y][0]
+            green = pixels[x, y][1]
+            blue = pixels[x, y][2]
+            all_pixels.append((red, green, blue))
+    return(all_pixels)
+
+def write_csv(dicts: List[Dict], output_file: str):
+    with open(output_file, "w") as fout:
+        fieldnames = dicts[0].keys()
+        writer = csv.DictWriter(fout, fieldnames = fieldnames)
+        writer.writeheader()
+        for d in dicts:
+            writer.writerow(d)
+
+def print_from_path(
+        path: str,
+        output_file: str = '-',
+        threads: int = 4,
+        ignore_file: str = None,
+        sort_key: str = 'hue',
+        ignore_tolerance: int = 0,
+        engine: str = DEFAULT_ENGINE,
+        approx: bool = False,
+        tolerance: float = None,
+        cache_file: str = None,
+        cache_hash: bool = False,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        shard: Tuple[int, int] = None,
+        unsorted: bool = False,
+        buffer_size: int = 100000,
+        index_file: str = None,
+        histogram: int = 0,
+        profile_file: str = None,
+        metrics: bool = False,
+        slowest: int = 10,
+        executor: Any = None,
+        prefetch: int = 0,
+        prefetch_memory: int = 256,
+        prefetch_readers: int = 8,
+        on_error: str = 'fail',
+        failed_file: str = None,
+        timeout: float = None,
+        max_pixels: int = None,
+        max_file_mb: float = None,
+        max_tasks: int = None,
+        max_memory: float = None,
+        func = None):
+    """
+    Print image average RGB values to stdout or file
+    include, exclude, max_depth, symlinks, sniff and shard choose the files used from a dir, see find_files
+
+    With unsorted = True, rows are written as each image finishes.
+    Otherwise they are sorted holding at most buffer_size rows in memory at a time, see external_sort
+    With index_file, the rows are also saved to a binary index file that can be loaded quickly, see AvgIndex
+    With histogram, a color histogram with that many bins per channel is saved in each row, see ColorHistogram
+    With profile_file and/or metrics, the time spent on each image is saved and/or summarized, see Profiler
+    executor is an Executor to run the work on, or the name of a backend for threads workers, see Executor.coerce
+    With prefetch, up to that many files (and prefetch_memory MB) are read ahead of the workers by prefetch_readers threads, see Prefetcher
+    on_error, timeout, max_pixels and max_file_mb decide what happens to images that fail, hang, or are too big, see Avg.iter_from_list;
+    the skipped images are listed in failed_file (default: <output_file>.failed.csv), see open_failure_report
+    max_tasks and max_memory are when the worker processes are replaced, see Executor
+    """
+    path = Path(path)
+    cache = open_cache(cache_file, cache_hash)
+    profiler = open_profiler(profile_file, metrics = metrics, slowest = slowest)
+    executor, own_executor = Executor.coerce(executor, threads, max_tasks = max_tasks, max_memory = max_memory)
+    prefetcher = open_prefetcher(prefetch, memory = prefetch_memory, readers = prefetch_readers)
+    failures = open_failure_report(on_error, failed_file, output_file)
+    avg_args = {'engine': engine, 'approx': approx, 'tolerance': tolerance, 'cache': cache, 'profiler': profiler,
+        'executor': executor, 'prefetcher': prefetcher, 'on_error': on_error, 'timeout': timeout, 'failures': failures}
+    if histogram:
+        avg_args['histogram_bins'] = histogram
+    if max_pixels:
+        avg_args['max_pixels'] = max_pixels
+    if max_file_mb:
+        avg_args['max_file_mb'] = max_file_mb
+    walk_args = {'include': include, 'exclude': exclude, 'max_depth': max_depth, 'symlinks': symlinks, 'sniff': sniff,
+        'shard': shard, 'threads': executor.workers}
+
+    ignore_pixels = load_ignore_table(ignore_file, tolerance = ignore_tolerance)
+
+    if ignore_pixels:
+        avg_args['ignore_vals'] = ignore_pixels
+
+    if not path.exists():
+        print(">>> ERROR: path does not exist: " + str(path))
+        raise
+
+    if path.is_dir():
+        # unsorted rows are written out as soon as they are available, in the order the images finish;
+        # keep the files in order for sorting so that ties are in the same order every time
+        avgs = Avg.iter_from_dir(dir = path, ordered = not unsorted, walk_args = walk_args, **avg_args)
+        if not unsorted:
+            avgs = external_sort(avgs, sort_key = sort_key, buffer_size = buffer_size)
+
+    if path.is_file():
+        avgs = Avg().from_list(paths = [path], **avg_args)
+
+    if output_file == '-':
+        fout = sys.stdout # with open(sys.stdout) as fout:
+    else:
+        fout = open(output_file, "w")
+    writer = None
+    index = IndexWriter(index_file) if index_file else None
+    for avg in avgs:
+        d = avg.to_dict()
+        if writer is None:
+            fieldnames = d.keys()
+            writer = csv.DictWriter(fout, fieldnames = fieldnames)
+            writer.writeheader()
+        writer.writerow(d)
+        if index:
+            index.add(avg)
+        if unsorted:
+            fout.flush()
+
+    fout.close()
+    if index:
+        index.close()
+
+    if cache:
+        cache.close()
+    if own_executor:
+        executor.close()
+    if failures:
+        failures.close()
+    if prefetcher:
+        prefetcher.close(profiler)
+    if profiler:
+        profiler.close()
+
+
+def check_sorted(avgs: Iterable[Avg], sort_key: str, csv_file: str) -> Generator[Avg, None, None]:
+    """
+    Yield the Avg objects read from a csv table, checking that they are in order by sort_key
+    """
+    key = avg_sort_key(sort_key)
+    last = None
+    for avg in avgs:
+        if last is not None and key(avg) < last:
+            print(">>> ERROR: the rows of {} are not sorted by '{}'; use print to make the table again".format(csv_file, sort_key))
+            raise ValueError("csv file is not sorted by {}: {}".format(sort_key, csv_file))
+        last = key(avg)
+        yield(avg)
+
+def read_manifest(manifest_file: str) -> Dict[str, Tuple[int, int]]:
+    """
+    Load the size and modification time of each file in a csv table, saved by update_csv; returns None if there is none
+    """
+    if not os.path.exists(manifest_file):
+        return(None)
+    manifest = {}
+    with open(manifest_file, "r") as f:
+        for row in csv.reader(f, delimiter = '\t'):
+            manifest[row[0]] = (int(row[1]), int(row[2]))
+    return(manifest)
+
+def update_csv(
+        csv_file: str,
+        path: str,
+        output_file: str = None,
+        threads: int = 4,
+        ignore_file: str = None,
+        ignore_tolerance: int = 0,
+        sort_key: str = 'hue',
+        engine: str = DEFAULT_ENGINE,
+        approx: bool = False,
+        tolerance: float = None,
+        cache_file: str = None,
+        cache_hash: bool = False,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        shard: Tuple[int, int] = None,
+        histogram: int = None,
+        profile_file: str = None,
+        metrics: bool = False,
+        slowest: int = 10,
+        executor: Any = None,
+        prefetch: int = 0,
+        prefetch_memory: int = 256,
+        prefetch_readers: int = 8,
+        on_error: str = 'fail',
+        failed_file: str = None,
+        timeout: float = None,
+        max_pixels: int = None,
+        max_file_mb: float = None,
+        max_tasks: int = None,
+        max_memory: float = None,
+        func = None) -> Dict[str, int]:
+    """
+    Bring a sorted csv table made by print up to date with the image files now in a dir
+
+    Files that were added or modified since the table was written are evaluated,
+    rows for removed or modified files are dropped, and the new rows are merged into the existing rows in one pass,
+    so the table is never sorted again as a whole. The table must already be sorted by sort_key.
+    A file counts as modified if its size or modification time is not the same as in the manifest file
+    saved next to the table (csv_file + '.manifest') by the last update, or, the first time, if it is newer than the table.
+    New rows get a color histogram with histogram bins per channel, by default only if the table has them, with the same bins.
+    The table (output_file, default: csv_file) and its manifest are replaced atomically once the new ones are complete.
+    Returns the number of 'added', 'modified', 'removed', and 'kept' rows, and unless on_error is 'fail',
+    the number of added or modified files that were 'skipped'; they are left out of the manifest, so the next update tries them again
+    With profile_file and/or metrics, the time spent on each image is saved and/or summarized, see Profiler
+    executor is an Executor to run the work on, or the name of a backend for threads workers, see Executor.coerce
+    With prefetch, up to that many files (and prefetch_memory MB) are read ahead of the workers by prefetch_readers threads, see Prefetcher
+    on_error, failed_file, timeout, max_pixels, max_file_mb, max_tasks and max_memory are the same as for print_from_path
+    """
+    output_file = output_file or csv_file
+    profiler = open_profiler(profile_file, metrics = metrics, slowest = slowest)
+    executor, own_executor = Executor.coerce(executor, threads, max_tasks = max_tasks, max_memory = max_memory)
+    prefetcher = open_prefetcher(prefetch, memory = prefetch_memory, readers = prefetch_readers)
+    csv_mtime_ns = os.stat(csv_file).st_mtime_ns
+    manifest = read_manifest(csv_file + '.manifest')
+
+    # size and modification time of every image file in the dir
+    walk_args = {'include': include, 'exclude': exclude, 'max_depth': max_depth, 'symlinks': symlinks, 'sniff': sniff,
+        'shard': shard, 'threads': executor.workers}
+    current = {}
+    for file in profile_items(profiler, 'scan', find_files(path, **walk_args)):
+        stat = os.stat(file)
+        current[str(file)] = (stat.st_size, stat.st_mtime_ns)
+
+    def is_modified(file: str) -> bool:
+        if manifest is not None:
+            return(manifest.get(file) != current[file])
+        return(current[file][1] > csv_mtime_ns)
+
+    # first pass over the table: find the rows that can be kept
+    with open(csv_file, "r") as f:
+        reader = csv.DictReader(f)
+        fieldnames = reader.fieldnames
+        listed = []
+        for row in reader:
+            listed.append(row['path'])
+            if histogram is None and row.get('histogram'):
+                histogram = ColorHistogram.decode(row['histogram']).bins
+    listed_set = set(listed)
+    counts = {
+        'removed': sum( 1 for file in listed if file not in current ),
+        'modified': sum( 1 for file in listed if file in current and is_modified(file) ),
+        }
+    todo = [ file for file in current if file not in listed_set or is_modified(file) ]
+    counts['added'] = len(todo) - counts['modified']
+    counts['kept'] = len(listed) - counts['removed'] - counts['modified']
+    del listed, listed_set
+
+    cache = open_cache(cache_file, cache_hash)
+    failures = open_failure_report(on_error, failed_file, output_file)
+    avg_args = {'engine': engine, 'approx': approx, 'tolerance': tolerance, 'cache': cache, 'profiler': profiler,
+        'prefetcher': prefetcher, 'on_error': on_error, 'timeout': timeout, 'failures': failures}
+    if histogram:
+        avg_args['histogram_bins'] = histogram
+    if max_pixels:
+        avg_args['max_pixels'] = max_pixels
+    if max_file_mb:
+        avg_args['max_file_mb'] = max_file_mb
+    ignore_pixels = load_ignore_table(ignore_file, tolerance = ignore_tolerance)
+    if ignore_pixels:
+        avg_args['ignore_vals'] = ignore_pixels
+    new_avgs = Avg.from_list(paths = todo, sort_key = sort_key, executor = executor, **avg_args) if todo else []
+    if cache:
+        cache.close()
+    if own_executor:
+        executor.close()
+    if failures:
+        failures.close()
+        counts['skipped'] = failures.count
+
+    key = avg_sort_key(sort_key)
+    # second pass over the table: the rows that are kept, checking that they are in order
+    kept_avgs = check_sorted(( avg for avg in Avg.iter_csv(csv_file)
+        if avg.path in current and not is_modified(avg.path) ), sort_key, csv_file)
+
+    # write the merged table and its manifest next to the output, then swap them in
+    output_dir = os.path.dirname(os.path.abspath(output_file))
+    fd, tmp_csv = tempfile.mkstemp(dir = output_dir, suffix = ".csv.tmp")
+    fd_manifest, tmp_manifest = tempfile.mkstemp(dir = output_dir, suffix = ".manifest.tmp")
+    try:
+        with os.fdopen(fd, "w") as fout, os.fdopen(fd_manifest, "w") as fmanifest:
+            # new columns, e.g. 'error' from approx, go after the existing ones
+            fieldnames = list(fieldnames or [])
+            if new_avgs:
+                fieldnames += [ k for k in new_avgs[0].to_dict() if k not in fieldnames ]
+            writer = csv.DictWriter(fout, fieldnames = fieldnames, extrasaction = 'ignore')
+            writer.writeheader()
+            manifest_writer = csv.writer(fmanifest, delimiter = '\t')
+            # existing rows come first when the keys are equal
+            for avg in heapq.merge(kept_avgs, new_avgs, key = key):
+                writer.writerow(avg.to_dict())
+                manifest_writer.writerow([str(avg.path)] + list(current[str(avg.path)]))
+        replace_file(tmp_csv, output_file)
+        replace_file(tmp_manifest, output_file + '.manifest')
+    except BaseException:
+        for tmp in [tmp_csv, tmp_manifest]:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        raise
+
+    print("Updated {}: {added} added, {modified} modified, {removed} removed, {kept} kept".format(output_file, **counts),
+        file = sys.stderr)
+    if prefetcher:
+        prefetcher.close(profiler)
+    if profiler:
+        profiler.close()
+    return(counts)
+
+def merge_csv(
+        input_files: List[str],
+        output_file: str = "-",
+        sort_key: str = 'hue',
+        func = None) -> int:
+    """
+    Merge csv tables that are each sorted by sort_key, e.g. made by print --shard on several nodes, into one sorted table
+
+    The tables are read one row at a time and merged with a heap, so only one row of each table is held in memory.
+    Rows with equal keys keep the order of input_files. Columns that are only in some tables, e.g. 'error' from approx,
+    are left empty for the rows of the others. The output is written to a temporary file and moved into place when complete,
+    so it can be one of the inputs. Returns the number of rows written
+    """
+    for input_file in input_files:
+        if not os.path.exists(input_file):
+            print(">>> ERROR: csv file does not exist: " + str(input_file))
+            raise FileNotFoundError(input_file)
+
+    # header of the output: the columns of every table, in the order they are first seen
+    fieldnames = []
+    for input_file in input_files:
+        with open(input_file, "r") as f:
+            header = next(csv.reader(f), [])
+        fieldnames += [ name for name in header if name not in fieldnames ]
+
+    tables = [ check_sorted(Avg.iter_csv(input_file), sort_key, input_file) for input_file in input_files ]
+    rows = 0
+    if output_file == '-':
+        fout, tmp_csv = sys.stdout, None
+    else:
+        fd, tmp_csv = tempfile.mkstemp(dir = os.path.dirname(os.path.abspath(output_file)), suffix = ".csv.tmp")
+        fout = os.fdopen(fd, "w")
+    try:
+        writer = csv.DictWriter(fout, fieldnames = fieldnames, restval = '', extrasaction = 'ignore')
+        writer.writeheader()
+        for avg in heapq.merge(*tables, key = avg_sort_key(sort_key)):
+            writer.writerow(avg.to_dict())
+            rows += 1
+        if tmp_csv:
+            fout.close()
+            replace_file(tmp_csv, output_file)
+    except BaseException:
+        if tmp_csv:
+            fout.close()
+            if os.path.exists(tmp_csv):
+                os.remove(tmp_csv)
+        raise
+    print("Merged {} tables, {} rows".format(len(input_files), rows), file = sys.stderr)
+    return(rows)
+
+def histogram_stats(
+        csv_file: str,
+        output_file: str = "-",
+        ignore_file: str = None,
+        ignore_tolerance: int = 0,
+        sort_key: str = 'hue',
+        dominant: int = 3,
+        func = None) -> int:
+    """
+    Work out the averages and more statistics again from the histograms saved in a csv table by print --histogram,
+    without opening the image files, e.g. to try a different ignore file
+
+    The averages are replaced with the ones from the histograms (see ColorHistogram.avg) and the columns from
+    ColorHistogram.stats are added, then the rows are sorted by sort_key. Returns the number of rows written
+    """
+    if not os.path.exists(csv_file):
+        print(">>> ERROR: csv file does not exist: " + str(csv_file))
+        raise FileNotFoundError(csv_file)
+    ignore_pixels = load_ignore_table(ignore_file, tolerance = ignore_tolerance)
+
+    rows = [] # (Avg with the new averages, added statistics)
+    for avg in Avg.iter_csv(csv_file):
+        if not avg.histogram:
+            print(">>> ERROR: there is no histogram for {} in {}; make the table with print --histogram".format(avg.path, csv_file))
+            raise ValueError("csv file has no histogram column: {}".format(csv_file))
+        hist = ColorHistogram.decode(avg.histogram)
+        new_avg = Avg.from_dict({'path': avg.path, 'histogram': avg.histogram, **hist.avg(ignore_pixels)})
+        rows.append((new_avg, hist.stats(ignore_pixels, dominant = dominant)))
+    key = avg_sort_key(sort_key)
+    rows.sort(key = lambda row: key(row[0]))
+
+    fout = sys.stdout if output_file == '-' else open(output_file, "w")
+    writer = None
+    for avg, stats in rows:
+        d = avg.to_dict()
+        # keep the histogram as the last column
+        d.update(stats)
+        d['histogram'] = d.pop('histogram')
+        if writer is None:
+            writer = csv.DictWriter(fout, fieldnames = d.keys())
+            writer.writeheader()
+        writer.writerow(d)
+    if fout is not sys.stdout:
+        fout.close()
+    return(len(rows))
+
+def query_colors(
+        input_path: str,
+        colors: List[str] = None,
+        colors_file: str = None,
+        nearest: int = None,
+        radius: float = None,
+        space: str = 'lab',
+        tree_file: str = None,
+        leaf_size: int = 16,
+        rebuild: bool = False,
+        output_file: str = "-",
+        func = None) -> List[List[Dict]]:
+    """
+    Find the images with the closest average colors to each of a batch of colors in a csv table or binary index from print
+
+    colors are given as rrggbb, #rrggbb or red,green,blue (see parse_color), and/or one per line in colors_file.
+    The nearest images (default: 10), or all the images within radius, or the nearest within radius are found
+    with a ColorTree in the given space, which is loaded from tree_file if it is up to date and built and saved otherwise,
+    see open_color_tree. Writes a csv table of the matches of each color, closest first, and returns the matches
+    """
+    if not os.path.exists(input_path):
+        print(">>> ERROR: path does not exist: " + str(input_path))
+        raise FileNotFoundError(input_path)
+    colors = list(colors or [])
+    if colors_file:
+        with open(colors_file) as f:
+            colors += [ line.strip() for line in f if line.strip() ]
+    queries = [ parse_color(color) for color in colors ]
+
+    tree = open_color_tree(input_path, space = space, tree_file = tree_file, leaf_size = leaf_size, rebuild = rebuild)
+    results = tree.query(queries, k = nearest, radius = radius)
+    tree.close()
+
+    fout = sys.stdout if output_file == '-' else open(output_file, "w")
+    writer = csv.DictWriter(fout, fieldnames = ['query', 'rank', 'distance', 'red', 'green', 'blue', 'path'], extrasaction = 'ignore')
+    writer.writeheader()
+    for rgb, matches in zip(queries, results):
+        for rank, match in enumerate(matches, 1):
+            writer.writerow({'query': '#{:02x}{:02x}{:02x}'.format(*rgb), 'rank': rank, **match})
+    if fout is not sys.stdout:
+        fout.close()
+    return(results)
+
+def prune_cache(cache_file: str = DEFAULT_CACHE_FILE, func = None) -> int:
+    """
+    Evict the stale entries from a result cache file
+    """
+    if not os.path.exists(cache_file):
+        print(">>> ERROR: cache file does not exist: " + str(cache_file))
+        raise FileNotFoundError(cache_file)
+    with ResultCache(cache_file) as cache:
+        removed = cache.prune()
+    print("Removed {} stale entries from {}".format(removed, cache_file))
+    return(removed)
+
+
+def can_draft(image: Image, img_width: int, img_height: int) -> bool:
+    """
+    Check if an opened (not yet loaded) image can be decoded at a reduced scale that is still at least img_width x img_height;
+    JPEG files can be decoded at 1/2, 1/4, or 1/8 of their size, which takes a fraction of the time of a full decode
+    """
+    return(image.format == 'JPEG' and image.size[0] >= 2 * img_width and image.size[1] >= 2 * img_height)
+
+def make_thumbnail(
+        red: int,
+        blue: int,
+        green: int,
+        input_path: str,
+        output_path: str,
+        img_width: int = 300,
+        img_height: int = 300,
+        bar_height: int = 50,
+        tile: Image = None,
+        resample: str = DEFAULT_RESAMPLE,
+        ) -> Tuple[str, Image]:
+    """
+    Make a thumbnail from a single image and its average RGB values
+    Using the avg RBG as a background color upon which to place and scaled version
+    Of the input image file
+    Final thumbnail size will be img_width * img_height + bar_height
+    If tile is supplied it is used as the already resized input image, otherwise see load_tile for resample
+    """
+    canvas = make_thumbnail_canvas(red = red, blue = blue, green = green, input_path = input_path,
+        img_width = img_width, img_height = img_height, bar_height = bar_height, tile = tile, resample = resample)
+    canvas.save(output_path, format='JPEG')
+    return(output_path, canvas)
+
+def make_thumbnail_canvas(
+        red: int,
+        blue: int,
+        green: int,
+        input_path: str,
+        img_width: int = 300,
+        img_height: int = 300,
+        bar_height: int = 50,
+        tile: Image = None,
+        resample: str = DEFAULT_RESAMPLE,
+        ) -> Image:
+    """
+    Make the thumbnail image for make_thumbnail without saving it
+    """
+    # start collage canvas with a background color of the avg RGB values
+    canvas_size = (img_width, img_height + bar_height)
+    canvas = Image.new('RGB', canvas_size, (red, blue, green))
+    # load image and add to canvas
+    image = tile if tile is not None else load_tile(input_path, img_width = img_width, img_height = img_height, resample = resample)
+    canvas.paste(image, (0, 0))
+    return(canvas)
+
+def load_tile(
+        input_path: str,
+        img_width: int = 300,
+        img_height: int = 300,
+        image: Image = None,
+        resample: str = DEFAULT_RESAMPLE) -> Image:
+    """
+    Load an image file resized to the size used for thumbnails, collage, and gif tiles
+    If image is supplied, it is used as the already opened image for input_path
+
+    JPEG files are decoded at the smallest reduced scale that is still at least the tile size (see can_draft),
+    then reduced by whole factors to within TILE_REDUCING_GAP of the tile size before the final resample filter,
+    one of RESAMPLE_FILTERS; 'nearest' skips the reduction and is the fastest
+    """
+    if resample not in RESAMPLE_FILTERS:
+        print(">>> ERROR: unknown resample filter: {}".format(resample))
+        raise ValueError("resample must be one of {}".format(list(RESAMPLE_FILTERS)))
+    if image is None:
+        image = Image.open(input_path)
+    if can_draft(image, img_width, img_height):
+        image.draft(image.mode, (img_width, img_height))
+    reducing_gap = None if resample == 'nearest' else TILE_REDUCING_GAP
+    image = image.resize((img_width, img_height), RESAMPLE_FILTERS[resample], reducing_gap = reducing_gap)
+    return(image)
+
+def avg_tile_task(
+        item: Tuple[str, Dict],
+        img_width: int = 300,
+        img_height: int = 300,
+        resample: str = DEFAULT_RESAMPLE,
+        args: Tuple = None,
+        kwargs: Dict = None) -> Tuple[Dict, Image, bool]:
+    """
+    Decode an image once and return both its average values and its resized tile;
+    this is the task that is run by the worker processes for Avg.iter_with_tiles
+    Without args and kwargs for Avg.get_avg_rgb_hsv, the ones installed by init_avg_worker are used
+
+    item is the path and its cached average values, or None if they still need to be calculated,
+    optionally followed by whether the tile is needed (default: True; False when it is in a TileCache)
+    and the contents of the file from a Prefetcher.
+    Returns the average values, the tile (None if it was not needed), and whether the average values were newly calculated
+
+    The tile is always the same as load_tile gives. If the averages are needed and the tile comes from a reduced decode
+    (see can_draft), the averages get their own full size decode, since the small decode for the tile costs little next to it.
+    Otherwise the tile is made first and the averages re-use the decoded pixels; with approx this means the sample is taken
+    from the full size image instead of a reduced JPEG decode, which gives the same kind of estimate without decoding the file twice
+    """
+    path, avg = item[:2]
+    need_tile = item[2] if len(item) > 2 else True
+    data = item[3] if len(item) > 3 else None
+    if kwargs is None:
+        args, kwargs = _worker_avg_args
+    timer = StageTimer() if kwargs.get('_profile') else None
+    is_new = avg is None
+    image = None
+    if is_new or need_tile:
+        image = Image.open(BytesIO(data) if data is not None else path)
+        check_image_limits(path, image, data = data, max_pixels = kwargs.get('max_pixels'), max_file_mb = kwargs.get('max_file_mb'))
+        if timer:
+            timer.lap('open')
+    tile = None
+    if need_tile:
+        tile_image = image
+        if is_new and can_draft(image, img_width, img_height):
+            tile_image = Image.open(BytesIO(data) if data is not None else path)
+        tile = load_tile(path, img_width = img_width, img_height = img_height, image = tile_image, resample = resample)
+        if timer:
+            timer.lap('tile')
+    if is_new:
+        avg = Avg.get_avg_rgb_hsv(path, image = image, data = data, *args, **kwargs)
+    if timer:
+        pixels = image.size[0] * image.size[1] if image is not None else None
+        avg['profile'] = timer.record(path, pixels = pixels, merge = avg.get('profile'))
+    return(avg, tile, is_new)
+
+def tile_task(
+        item: Tuple[str, bool],
+        img_width: int = 300,
+        img_height: int = 300,
+        resample: str = DEFAULT_RESAMPLE) -> Image:
+    """
+    Load the tile for a path, or return None if it is not needed (it is in a TileCache);
+    this is the task that is run by the worker processes for iter_tiles
+    """
+    path, need_tile = item
+    if not need_tile:
+        return(None)
+    return(load_tile(path, img_width = img_width, img_height = img_height, resample = resample))
+
+def cached_tile(
+        tile: Image,
+        path: str,
+        source: str,
+        tile_cache: TileCache,
+        params: str,
+        img_width: int = 300,
+        img_height: int = 300,
+        resample: str = DEFAULT_RESAMPLE) -> Tuple[Image, bool]:
+    """
+    Get the tile for a path from a worker's result, or from the tile_cache when the worker skipped it;
+    returns the tile and whether it was newly made, so it can be saved to the tile_cache
+    """
+    if tile is not None:
+        return(tile, True)
+    tile = tile_cache.load(source, params)
+    if tile is not None:
+        return(tile, False)
+    # removed from the cache since it was looked up, e.g. by another run over the same cache
+    return(load_tile(path, img_width = img_width, img_height = img_height, resample = resample), True)
+
+def iter_tiles(
+        paths: Iterable[str],
+        img_width: int = 300,
+        img_height: int = 300,
+        resample: str = DEFAULT_RESAMPLE,
+        tile_cache: TileCache = None,
+        threads: int = 2,
+        executor: Any = None,
+        max_in_flight: int = None) -> Generator[Image, None, None]:
+    """
+    Yield the tile for each path, in order, see load_tile
+    The tiles are loaded in parallel by executor, see imap_ordered; with a TileCache, the saved tiles are used
+    and only the missing ones are loaded, which are then saved to it
+    """
+    params = tile_cache.params_key(img_width, img_height, resample) if tile_cache else None
+    sources = collections.deque() # (path, source key of its saved tile or None) for the items sent to the workers
+
+    def iter_items():
+        for chunk in iter_chunks(paths, 256):
+            cached_tiles = tile_cache.find_many(chunk, params) if tile_cache else {}
+            for i, path in enumerate(chunk):
+                sources.append((path, cached_tiles.get(i)))
+                yield((path, i not in cached_tiles))
+
+    task = functools.partial(tile_task, img_width = img_width, img_height = img_height, resample = resample)
+    tiles = imap_ordered(task, iter_items(), threads = threads, executor = executor, max_in_flight = max_in_flight)
+    new_tiles = [] # new tiles that still need to be saved to the tile cache
+    try:
+        for tile in tiles:
+            path, source = sources.popleft()
+            tile, is_new_tile = cached_tile(tile, path, source, tile_cache, params,
+                img_width = img_width, img_height = img_height, resample = resample)
+            if is_new_tile and tile_cache:
+                new_tiles.append((path, tile))
+                if len(new_tiles) >= 64:
+                    tile_cache.put_many(new_tiles, params)
+                    new_tiles = []
+            yield(tile)
+    finally:
+        # stops the worker pool if the tiles were not all used
+        tiles.close()
+        if tile_cache and new_tiles:
+            tile_cache.put_many(new_tiles, params)
+
+def attach_tiles(
+        all_kwds: Iterable[Dict],
+        img_width: int = 300,
+        img_height: int = 300,
+        resample: str = DEFAULT_RESAMPLE,
+        *args, **kwargs) -> Generator[Dict, None, None]:
+    """
+    Add the tile to each of a list of make_thumbnail_canvas args, see iter_tiles for the other args
+    """
+    all_kwds, path_kwds = itertools.tee(all_kwds)
+    tiles = iter_tiles(( kwds['input_path'] for kwds in path_kwds ), img_width = img_width, img_height = img_height,
+        resample = resample, *args, **kwargs)
+    try:
+        for kwds, tile in zip(all_kwds, tiles):
+            yield(dict(kwds, tile = tile))
+    finally:
+        tiles.close()
+
+class TileSpool(object):
+    """
+    Temporary file that holds tile images until they are rendered, so they do not all need to be kept in memory
+    """
+    def __init__(self, dir: str = None):
+        self.file = tempfile.TemporaryFile(dir = dir)
+        self.index = {} # key: (offset, length) of the saved tile
+
+    def __enter__(self) -> TileSpool:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.file.close()
+
+    def add(self, key: Any, tile: Image):
+        data = pickle.dumps(tile, protocol = pickle.HIGHEST_PROTOCOL)
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(data)
+        self.index[key] = (offset, len(data))
+
+    def get(self, key: Any) -> Image:
+        offset, length = self.index[key]
+        self.file.seek(offset)
+        return(pickle.loads(self.file.read(length)))
+
+def load_avgs_and_tiles(
+        paths: Iterable[str],
+        img_width: int = 300,
+        img_height: int = 300,
+        sort_key: str = 'hue',
+        *args, **kwargs) -> Tuple[AvgTable, TileSpool]:
+    """
+    Get the sorted AvgTable for a list of paths along with a TileSpool of their tiles, keyed by path,
+    decoding each image only once; see Avg.iter_with_tiles
+    """
+    spool = TileSpool()
+    def iter_avgs():
+        for avg, tile in Avg.iter_with_tiles(paths, img_width = img_width, img_height = img_height, *args, **kwargs):
+            spool.add(avg.path, tile)
+            yield(avg)
+
+    # only the columns of values are kept, not an Avg object for each image
+    avgs = AvgTable.from_avgs(iter_avgs())
+    if sort_key:
+        avgs = avgs.sorted(sort_key)
+    return(avgs, spool)
+
+def thumbnail_task(kwds: Dict) -> str:
+    """
+    Make and save one thumbnail from the make_thumbnail args; this is the task that is run by the worker processes
+    """
+    output_path, canvas = make_thumbnail(**kwds)
+    return(output_path)
+
+def thumbnail_canvas_task(kwds: Dict) -> Image:
+    """
+    Make one thumbnail image from the make_thumbnail_canvas args; this is the task that is run by the worker processes
+    """
+    return(make_thumbnail_canvas(**kwds))
+
+def call_chunk(func: Callable, chunk: List) -> List:
+    """
+    Call func on each item of a chunk; this is the task that is run by the worker processes for imap_ordered
+    """
+    return([ func(item) for item in chunk ])
+
+# backends an Executor can run tasks with
+EXECUTOR_CHOICES = ['auto', 'process', 'thread', 'serial']
+
+# with a tuned chunk size, each chunk sent to a worker takes about this many seconds;
+# long enough that sending it costs little next to the work, short enough to keep all the workers busy
+CHUNK_SECONDS = 0.05
+MAX_CHUNKSIZE = 256
+
+def cpu_count() -> int:
+    """
+    Get the number of CPUs this process can run on
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return(len(os.sched_getaffinity(0)))
+    return(os.cpu_count() or 1)
 
-    @staticmethod
-    def get_avg_rgb_hsv(
-            path: str,
-            _verbose: bool = False,
-            ignore_vals: List[Tuple[int, int, int]] = None,
-            *args, **kwargs) -> Dict:
-        """
-        Get the average RGB and HSV values from an image file path
+def workers_arg(workers: str) -> Any:
+    """
+    Check a number of workers from the command line, which is a positive number or 'auto' for one per CPU
+    """
+    if workers == 'auto':
+        return(workers)
+    if not str(workers).isdigit() or int(workers) < 1:
+        print(">>> ERROR: number of workers must be a positive number or 'auto': {}".format(workers))
+        raise ValueError("invalid number of workers: {}".format(workers))
+    return(int(workers))
 
-        TODO: Need to check that we are really ignoring all the input ignore pixels, its not entirely clear that its working on the asset images
-        """
-        # check if there are some pixels to ignore
-        ignore_pixel_ids = set()
-        if ignore_vals:
-            for vals in ignore_vals:
-                id = "{}.{}.{}".format(vals[0], vals[1], vals[2]) # RGB values
-                ignore_pixel_ids.add(id)
+def peak_memory_mb() -> float:
+    """
+    Get the most memory this process has used so far, in MB, or None where it can not be measured
+    """
+    if resource is None:
+        return(None)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return(peak / float(1 << 20) if sys.platform == 'darwin' else peak / 1024.0)
 
-        img = Image.open(path).convert('RGB')
-        pixels = img.load()
-        size_x = img.size[0]
-        size_y = img.size[1]
-        avg = {
-            'red': 0,
-            'green': 0,
-            'blue': 0,
-            'pixels_total' : size_x * size_y,
-            'pixels_counted' : 0,
-            'path': path
-            }
+def timed_call(func: Callable, *args) -> Tuple[Any, float, float]:
+    """
+    Call func and return its result along with the seconds it took and the peak memory use of the worker in MB, see peak_memory_mb;
+    this is the task that is run by the workers of an Executor
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return(result, time.perf_counter() - start, peak_memory_mb())
 
-        if _verbose:
-            print("Loaded image: {0} total pixels".format(avg['pixels_total']))
+class SerialResult(object):
+    """
+    Result of a task that an Executor ran right away in the calling thread, used like the AsyncResult of a Pool
+    """
+    def __init__(self, value: Any = None, error: BaseException = None):
+        self.value = value
+        self.error = error
 
-        # add up the RGB values for all pixels
-        for x in range(img.size[0]): # iterate over all x pixels
-            for y in range(img.size[1]): # iterate over all y pixels
-                red = pixels[x, y][0]
-                green = pixels[x, y][1]
-                blue = pixels[x, y][2]
-
-                # skip the pixel if it matches one of the ignored pixels
-                if len(ignore_pixel_ids) > 0:
-                    id = "{0}.{1}.{2}".format(red, green, blue)
-                    if id not in ignore_pixel_ids:
-                        avg['red'] += red
-                        avg['green'] += green
-                        avg['blue'] += blue
-                        avg['pixels_counted'] += 1
-                else:
-                    avg['red'] += red
-                    avg['green'] += green
-                    avg['blue'] += blue
-                    avg['pixels_counted'] += 1
+    def get(self) -> Any:
+        if self.error is not None:
+            raise self.error
+        return(self.value)
 
-        # calculate averages
-        avg['red'] = avg['red'] // avg['pixels_counted']
-        avg['green'] = avg['green'] // avg['pixels_counted']
-        avg['blue'] = avg['blue'] // avg['pixels_counted']
+class TaskResult(object):
+    """
+    Result of a task submitted to an Executor, without the time it took to run
+    """
+    def __init__(self, result: Any):
+        self.result = result
 
-        # convert to HSV
-        hue, saturation, value = colorsys.rgb_to_hsv(avg['red'], avg['green'], avg['blue'])
-        avg['hue'] = hue
-        avg['saturation'] = saturation
-        avg['value'] = value
+    def get(self) -> Any:
+        value, seconds, peak_mb = self.result.get()
+        return(value)
 
-        # calculate percent
-        avg['pixels_pcnt'] = round((float(avg['pixels_counted']) / float(avg['pixels_total'])) * 100, 1)
+class Executor(object):
+    """
+    Runs tasks on a pool of worker processes ('process') or threads ('thread'), or one at a time in the calling thread ('serial')
 
-        return(avg)
+    The pool is started when it is first needed and kept until close, so one Executor can be held by a library caller and
+    used for many Avg.from_list, Avg.iter_with_tiles, and imap_ordered calls; the worker threads suit the PIL decode
+    and resize steps, which release the GIL, while processes also run the pure Python pixel loops in parallel.
+    'auto' uses a process pool with workers = 'auto' (one per CPU) or the given number of workers, or runs serially for one worker.
 
-    def to_dict(self):
-        d = {
-        'red': self.red,
-        'green': self.green,
-        'blue': self.blue,
-        'hue': self.hue,
-        'saturation': self.saturation,
-        'value': self.value,
-        'pixels_total': self.pixels_total,
-        'pixels_counted': self.pixels_counted,
-        'pixels_pcnt': self.pixels_pcnt,
-        'path': self.path
-        }
-        return(d)
+    Each task is timed in the worker, and without a fixed chunksize, chunk_size gives the number of items per chunk
+    that takes about CHUNK_SECONDS at the measured cost per item
+
+    Worker processes are replaced by new ones after max_tasks tasks each, and once a worker has used more than max_memory MB
+    the pool is retired: it finishes the tasks it has while a new pool takes the next ones, so long runs do not slow down
+    as the workers grow. Worker threads are not replaced
+    """
+    def __init__(self, backend: str = 'auto', workers: Any = 'auto', chunksize: int = None, max_tasks: int = None, max_memory: float = None):
+        if backend not in EXECUTOR_CHOICES:
+            print(">>> ERROR: unknown executor: {}".format(backend))
+            raise ValueError("executor must be one of {}".format(EXECUTOR_CHOICES))
+        workers = cpu_count() if workers in [None, 'auto'] else workers_arg(workers)
+        if backend == 'auto':
+            backend = 'serial' if workers == 1 else 'process'
+        self.backend = backend
+        self.workers = 1 if backend == 'serial' else workers
+        self.chunksize = chunksize
+        self.cost = None # average seconds per item of the tasks so far
+        self.max_tasks = max_tasks
+        self.max_memory = max_memory
+        self.pool = None
+        self.pool_state = None # pickled initializer and initargs the pool's workers were started with
+        self.retired = [] # pools that are finishing their tasks after a worker went over max_memory
+        self.recycle = False # set when a worker of the current pool went over max_memory
+        self.recycled = 0 # number of pools retired for using too much memory
+
+    def __enter__(self) -> Executor:
+        return(self)
+
+    def __exit__(self, *args):
+        self.close()
 
     def __repr__(self):
-        r = 'Avg(' + 'path=' + self.path.__repr__()
-        r += ')'
-        return(r)
+        return("Executor(backend={!r}, workers={})".format(self.backend, self.workers))
 
     @classmethod
-    def from_dict(cls, d: Dict) -> Avg:
+    def coerce(cls, executor: Any = None, workers: Any = 'auto', *args, **kwargs) -> Tuple[Executor, bool]:
         """
-        Return an Avg instance from a pre-made dict of values
+        Get an Executor from an Executor or the name of a backend (default: 'process', or 'serial' for one worker),
+        and whether it was made here, in which case the caller should close it when it is done
+        The other args are passed on to a new Executor, e.g. max_tasks and max_memory
         """
-        avg = cls()
-        attrs = ['path', 'red', 'green', 'blue', 'hue', 'saturation', 'value', 'pixels_total', 'pixels_counted', 'pixels_pcnt']
-        for a in attrs:
-            setattr(avg, a, d[a])
-        return(avg)
+        if isinstance(executor, Executor):
+            return(executor, False)
+        if executor is None:
+            executor = 'serial' if workers == 1 or workers == '1' else 'process'
+        return(cls(executor, workers, *args, **kwargs), True)
 
-    @classmethod
-    def from_list(cls,
-        paths: List[str],
-        sort_key: str = "hue",
-        threads: int = 2,
-        _verbose: bool = False,
-        *args, **kwargs) -> List[Avg]:
+    def chunk_size(self) -> int:
         """
-        Return a list of Avg objects by evaluating a list of paths in parallel
+        Get the number of items to send to a worker at a time
+        Before any task has finished there is no measured cost, so items are sent one at a time
         """
-        avgs = []
-        # run in single-threaded mode
-        if threads == 1:
-            for path in paths:
-                avgs.append(cls.get_avg_rgb_hsv(path, *args, **kwargs))
+        if self.chunksize:
+            return(self.chunksize)
+        if self.cost is None:
+            return(1)
+        return(max(1, min(MAX_CHUNKSIZE, int(CHUNK_SECONDS / max(self.cost, 1e-6)))))
 
-        # run in multi-threaded mode
-        else:
-            pool = Pool(int(threads))
+    def record_cost(self, seconds: float, size: int):
+        """
+        Add the time a task with size items took to the running average cost per item
+        """
+        cost = seconds / max(1, size)
+        self.cost = cost if self.cost is None else 0.8 * self.cost + 0.2 * cost
 
-            # generate the aysnc result instances
-            results = []
-            for path in paths:
-                result = pool.apply_async(cls.get_avg_rgb_hsv, args=(path, *args), kwds=kwargs)
-                results.append(result)
+    def install(self, initializer: Callable = None, initargs: Tuple = ()) -> Any:
+        """
+        Make sure the workers have been set up with initializer(*initargs), and return the pool, or None when running serially
+        A pool that was started with other initargs is closed once its tasks are done and a new one is started;
+        tasks without an initializer can use any pool
+        """
+        state = pickle.dumps((initializer, initargs)) if initializer else None
+        if self.backend == 'serial':
+            if state is not None and state != self.pool_state:
+                initializer(*initargs)
+                self.pool_state = state
+            return(None)
+        if self.pool is not None and state is not None and state != self.pool_state:
+            self.close()
+        if self.pool is not None and self.recycle:
+            # the old workers stop once their tasks are done, without holding up the new tasks
+            self.pool.close()
+            self.retired.append(self.pool)
+            self.pool = None
+            self.recycled += 1
+        if self.pool is None:
+            if self.backend == 'process':
+                self.pool = Pool(self.workers, initializer = initializer, initargs = initargs, maxtasksperchild = self.max_tasks)
+            else:
+                self.pool = ThreadPool(self.workers, initializer = initializer, initargs = initargs)
+            self.pool_state = state
+            self.recycle = False
+        return(self.pool)
 
-             # get each result
-            for result in results:
-                avg = result.get()
-                avgs.append(avg)
+    def apply_async(self,
+            func: Callable,
+            args: Tuple = (),
+            size: int = 1,
+            callback: Callable = None,
+            error_callback: Callable = None,
+            initializer: Callable = None,
+            initargs: Tuple = ()) -> TaskResult:
+        """
+        Run func(*args) in a worker, like Pool.apply_async; size is the number of items the task works on, for timing it
+        The workers are set up with initializer(*initargs) first, see install
+        When running serially, the task is run right away and the callbacks are called before this returns
+        """
+        def finish(timed):
+            value, seconds, peak_mb = timed
+            self.record_cost(seconds, size)
+            if self.max_memory and peak_mb is not None and peak_mb > self.max_memory:
+                # only retire the pool that ran the task, not a new one that has taken over since
+                if self.backend == 'process' and pool is not None and pool is self.pool:
+                    self.recycle = True
+            if callback:
+                callback(value)
 
-        if sort_key:
-            avgs = sorted(avgs, key = lambda avg: avg[sort_key])
+        pool = self.install(initializer, initargs)
+        if pool is not None:
+            return(TaskResult(pool.apply_async(timed_call, (func,) + tuple(args), callback = finish, error_callback = error_callback)))
+        try:
+            timed = timed_call(func, *args)
+        except Exception as error:
+            if error_callback:
+                error_callback(error)
+            return(TaskResult(SerialResult(error = error)))
+        finish(timed)
+        return(TaskResult(SerialResult(timed)))
 
-        objs = []
-        for avg in avgs:
-            obj = cls().from_dict(avg)
-            objs.append(obj)
+    def close(self):
+        """
+        Stop the workers once their tasks are done
+        """
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+            self.pool_state = None
+        for pool in self.retired:
+            pool.join()
+        self.retired = []
 
-        return(objs)
+    def terminate(self):
+        """
+        Stop the workers right away, dropping any tasks that are not done
+        """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+            self.pool_state = None
+        for pool in self.retired:
+            pool.terminate()
+            pool.join()
+        self.retired = []
 
-    @classmethod
-    def from_dir(cls, dir: str, *args, **kwargs) -> List[Avg]:
-        path = Path(dir)
-        paths = [ p for p in path.glob('**/*') if p.is_file() ]
-        avgs = Avg().from_list(paths = paths, *args, **kwargs)
-        return(avgs)
+def imap_ordered(
+        func: Callable,
+        items: Iterable,
+        threads: int = 2,
+        chunksize: int = None,
+        max_in_flight: int = None,
+        initializer: Callable = None,
+        initargs: Tuple = (),
+        executor: Any = None) -> Generator[Any, None, None]:
+    """
+    Yield the results of func for each item, evaluated in parallel but returned in the same order as the items
+    The items are evaluated by executor, an Executor or the name of a backend, see Executor.coerce;
+    without one, a process pool with threads workers is used for this call.
+    Items are sent in chunks of chunksize items (default: tuned by the executor).
+    With max_in_flight, at most that many items are sent to the workers before their results have been used
+    The workers are set up with initializer(*initargs) before running func, see Executor.install
 
-    @classmethod
-    def from_csv(cls, csv_file: str) -> List[Avg]:
-        int_attrs = ['red', 'green', 'blue', 'value', 'pixels_total', 'pixels_counted' ]
-        float_attrs = ['hue', 'saturation', 'pixels_pcnt']
-        avgs = []
-        with open(csv_file, "r") as f:
-            reader = csv.DictReader(f, delimiter = ',')
-            for row in reader:
-                for key in int_attrs:
-                    row[key] = int(row[key])
-                for key in float_attrs:
-                    row[key] = float(row[key])
-                avgs.append(cls.from_dict(row))
-        return(avgs)
+    Items are only taken from the iterable and submitted from the calling thread, so an error in func,
+    or closing the generator early, stops the pool right away (when it was made for this call) instead of leaving a feeder thread waiting
+    """
+    executor, owned = Executor.coerce(executor, threads)
+    # run in single-threaded mode, one item at a time as they are asked for
+    if executor.backend == 'serial':
+        executor.install(initializer, initargs)
+        for item in items:
+            yield(func(item))
+        return
 
+    # run in multi-threaded mode
+    items = iter(items)
+    pending = collections.deque() # (result, number of items) for each submitted chunk
+    in_flight = 0
+    exhausted = False
+    try:
+        while True:
+            # top up the submitted chunks
+            while not exhausted and (not max_in_flight or in_flight < max_in_flight):
+                size = chunksize or executor.chunk_size()
+                if max_in_flight:
+                    # a chunk can not be bigger than the number of items allowed in flight
+                    size = max(1, min(size, max_in_flight - in_flight))
+                chunk = list(itertools.islice(items, size))
+                if chunk:
+                    result = executor.apply_async(call_chunk, (func, chunk), size = len(chunk),
+                        initializer = initializer, initargs = initargs)
+                    pending.append((result, len(chunk)))
+                    in_flight += len(chunk)
+                else:
+                    exhausted = True
+            if not pending:
+                break
+            result, size = pending.popleft()
+            in_flight -= size
+            for value in result.get():
+                yield(value)
+    finally:
+        if owned:
+            executor.terminate()
 
 
+class PNGBandWriter(object):
+    """
+    Write an RGB image to a PNG file one horizontal band at a time, so the full image never has to be held in memory
+    """
+    def __init__(self, output_file: str, size: Tuple[int, int]):
+        self.width, self.height = size
+        self.rows_written = 0
+        self.fout = open(output_file, "wb")
+        self.compressor = zlib.compressobj(6)
+        self.fout.write(b"\x89PNG\r\n\x1a\n")
+        # 8 bit RGB, no interlacing
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", self.width, self.height, 8, 2, 0, 0, 0))
 
+    def write_chunk(self, chunk_type: bytes, data: bytes):
+        self.fout.write(struct.pack(">I", len(data)))
+        self.fout.write(chunk_type)
+        self.fout.write(data)
+        self.fout.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xffffffff))
 
+    def write(self, band: Image):
+        data = band.convert('RGB').tobytes()
+        stride = self.width * 3
+        # each scanline starts with its filter type; 0 is no filtering
+        rows = b"".join( b"\x00" + data[i:i + stride] for i in range(0, len(data), stride) )
+        compressed = self.compressor.compress(rows)
+        if compressed:
+            self.write_chunk(b"IDAT", compressed)
+        self.rows_written += band.size[1]
 
-# ~~~~~ CLI ~~~~~ #
-# functions for running the module as a command line script
-def load_all_pixels(path: str) -> List[Tuple[int, int, int]]:
-    all_pixels = []
-    # load the unique pixels from the file
-    img = Image.open(path).convert('RGB')
-    pixels = img.load()
-    size_x = img.size[0]
-    size_y = img.size[1]
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.fout.close()
 
-    for x in range(img.size[0]): # iterate over all x pixels
-        for y in range(img.size[1]): # iterate over all y pixels
-            red = pixels[x, y][0]
-            green = pixels[x, y][1]
-            blue = pixels[x, y][2]
-            all_pixels.append((red, green, blue))
-    return(all_pixels)
+    def abort(self):
+        """
+        Close the file without finishing it, when rendering fails part way
+        """
+        self.fout.close()
 
-def write_csv(dicts: List[Dict], output_file: str):
-    with open(output_file, "w") as fout:
-        fieldnames = dicts[0].keys()
-        writer = csv.DictWriter(fout, fieldnames = fieldnames)
-        writer.writeheader()
-        for d in dicts:
-            writer.writerow(d)
+class PPMBandWriter(object):
+    """
+    Write an RGB image to a binary PPM file one horizontal band at a time
+    """
+    def __init__(self, output_file: str, size: Tuple[int, int]):
+        self.width, self.height = size
+        self.rows_written = 0
+        self.fout = open(output_file, "wb")
+        self.fout.write("P6\n{} {}\n255\n".format(self.width, self.height).encode())
 
-def print_from_path(
-        path: str,
-        output_file: str = '-',
-        threads: int = 4,
-        ignore_file: str = None,
-        sort_key: str = 'hue',
-        func = None):
+    def write(self, band: Image):
+        self.fout.write(band.convert('RGB').tobytes())
+        self.rows_written += band.size[1]
+
+    def close(self):
+        self.fout.close()
+
+    def abort(self):
+        self.fout.close()
+
+class GIFStreamWriter(object):
     """
-    Print image average RGB values to stdout or file
+    Write an animated GIF one frame at a time, so the frames never all have to be held in memory
+
+    If palette (a 'P' mode image) is supplied, its colors are used as one global color table for all the frames;
+    otherwise each frame gets its own adaptive palette.
+    Each frame is saved as a single image GIF with PIL and its compressed image data is copied into the animation
     """
-    path = Path(path)
-    avg_args = {'sort_key': sort_key}
+    def __init__(self,
+            output_file: str,
+            size: Tuple[int, int],
+            duration: int = 100, # milliseconds per frame
+            loop: int = 0, # number of times to loop, 0 is forever
+            palette: Image = None):
+        self.width, self.height = size
+        self.duration = duration
+        self.palette = palette
+        self.frames_written = 0
+        self.fout = open(output_file, "wb")
 
-    ignore_pixels = []
-    if ignore_file:
-        ignore_pixels = set(load_all_pixels(ignore_file))
+        # logical screen descriptor; 0xf7 means a global color table of 256 entries follows
+        flags = 0xf7 if palette is not None else 0x70
+        self.fout.write(b"GIF89a" + struct.pack("<HHBBB", self.width, self.height, flags, 0, 0))
+        self.global_table = None
+        if palette is not None:
+            self.global_table = self.palette_bytes(palette)
+            self.fout.write(self.global_table)
+        # application extension for looping the animation
+        self.fout.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
 
-    if ignore_pixels:
-        avg_args['ignore_vals'] = ignore_pixels
+    @staticmethod
+    def palette_bytes(image: Image) -> bytes:
+        """
+        Get the 256 entry color table for a 'P' mode image
+        """
+        palette = bytes(image.getpalette()[:768])
+        return(palette + b"\x00" * (768 - len(palette)))
 
-    if not path.exists():
-        print(">>> ERROR: path does not exist: " + str(path))
-        raise
+    @staticmethod
+    def encode_frame(frame: Image) -> Tuple[bytes, int, bytes]:
+        """
+        Save a 'P' mode frame as a single image GIF in memory and pull out the parts needed for an animation frame
+        Returns the color table PIL wrote for it, the interlace flag of its image descriptor,
+        and the image data: the LZW code size followed by the data sub-blocks
+        """
+        buf = BytesIO()
+        frame.save(buf, format = 'GIF', interlace = False, optimize = False)
+        data = buf.getvalue()
 
-    if path.is_dir():
-        avgs = Avg().from_dir(dir = path, threads = int(threads), **avg_args)
-        dicts = [avg.to_dict() for avg in avgs]
+        def skip_sub_blocks(pos: int) -> int:
+            # sub-blocks each start with their length and end with an empty block
+            while data[pos]:
+                pos += 1 + data[pos]
+            return(pos + 1)
 
-    if path.is_file():
-        avg = Avg(path = path, **avg_args)
-        dicts = [avg.to_dict()]
+        # the color table can follow either the logical screen descriptor or the image descriptor
+        color_table = b""
+        flags = data[10]
+        pos = 13
+        if flags & 0x80:
+            color_table = data[pos:pos + 3 * (2 << (flags & 7))]
+            pos += len(color_table)
+        while data[pos:pos + 1] == b"!": # extension blocks
+            pos = skip_sub_blocks(pos + 2)
+        if data[pos:pos + 1] != b",":
+            raise ValueError("no image data found in the GIF saved for a frame")
+        flags = data[pos + 9]
+        pos += 10
+        if flags & 0x80:
+            color_table = data[pos:pos + 3 * (2 << (flags & 7))]
+            pos += len(color_table)
+        return(color_table, flags & 0x40, data[pos:skip_sub_blocks(pos + 1)])
 
-    if output_file == '-':
-        fout = sys.stdout # with open(sys.stdout) as fout:
-    else:
-        fout = open(output_file, "w")
-    fieldnames = dicts[0].keys()
-    writer = csv.DictWriter(fout, fieldnames = fieldnames)
-    writer.writeheader()
-    for d in dicts:
-        writer.writerow(d)
+    def write(self, frame: Image):
+        if self.palette is not None:
+            frame = frame.convert('RGB').quantize(palette = self.palette)
+        else:
+            # fast octree quantization gives each frame its own palette for about the cost of a fixed palette
+            frame = frame.convert('RGB').quantize(256, method = Image.FASTOCTREE)
+        color_table, interlace, image_data = self.encode_frame(frame)
 
-    fout.close()
+        # graphic control extension with the frame delay in hundredths of a second
+        self.fout.write(b"!\xf9\x04\x00" + struct.pack("<H", self.duration // 10) + b"\x00\x00")
+        # image descriptor, followed by a local color table unless the global one holds the same colors
+        # (PIL may shorten or reorder the palette it saves)
+        local = self.global_table is None or self.global_table[:len(color_table)] != color_table
+        flags = interlace | ((0x80 | ((len(color_table) // 3).bit_length() - 2)) if local else 0x00)
+        self.fout.write(b"," + struct.pack("<HHHHB", 0, 0, frame.size[0], frame.size[1], flags))
+        if local:
+            self.fout.write(color_table)
+        self.fout.write(image_data)
+        self.frames_written += 1
 
+    def close(self):
+        self.fout.write(b";")
+        self.fout.close()
 
-def make_thumbnail(
-        red: int,
-        blue: int,
-        green: int,
-        input_path: str,
-        output_path: str,
-        img_width: int = 300,
-        img_height: int = 300,
-        bar_height: int = 50,
-        ) -> Tuple[str, Image]:
+    def abort(self):
+        self.fout.close()
+
+def make_gif_palette(
+        colors: List[Tuple[int, int, int]],
+        frames: List[Image] = None,
+        sample_size: Tuple[int, int] = (64, 64)) -> Image:
     """
-    Make a thumbnail from a single image and its average RGB values
-    Using the avg RBG as a background color upon which to place and scaled version
-    Of the input image file
-    Final thumbnail size will be img_width * img_height + bar_height
+    Make one 256 color palette for a gif from the average colors of its images and a sample of its frames
+    Returns a 'P' mode image that can be used with GIFStreamWriter
     """
-    # start collage canvas with a background color of the avg RGB values
-    canvas_size = (img_width, img_height + bar_height)
-    canvas = Image.new('RGB', canvas_size, (red, blue, green))
-    # load image and add to canvas
-    image = Image.open(input_path).resize((img_width, img_height), Image.ANTIALIAS)
-    canvas.paste(image, (0, 0))
-    canvas.save(output_path, format='JPEG')
-    return(output_path, canvas)
+    frames = frames or []
+    # put the colors in a strip and each frame, scaled down, in a row below it
+    width = max(len(colors), sample_size[0] * max(1, len(frames)))
+    sample = Image.new('RGB', (width, 1 + sample_size[1]), "black")
+    for i, color in enumerate(colors):
+        sample.putpixel((i, 0), tuple(color))
+    for i, frame in enumerate(frames):
+        sample.paste(frame.convert('RGB').resize(sample_size), (i * sample_size[0], 1))
+    return(sample.quantize(colors = 256))
+
+# output file extensions that can be written one band at a time
+BAND_WRITERS = {
+    '.png': PNGBandWriter,
+    '.ppm': PPMBandWriter,
+    '.pnm': PPMBandWriter,
+    }
+
+def band_writer_class(output_file: str) -> type:
+    """
+    Get the band writer for the extension of output_file, so an unsupported file type fails before any work is done
+    """
+    ext = os.path.splitext(str(output_file))[1].lower()
+    if ext not in BAND_WRITERS:
+        print(">>> ERROR: streaming output needs one of these file types: {}".format(', '.join(sorted(BAND_WRITERS))))
+        raise ValueError("cannot stream output to file type: {}".format(ext))
+    return(BAND_WRITERS[ext])
+
+def open_band_writer(output_file: str, size: Tuple[int, int]) -> PNGBandWriter:
+    """
+    Open a writer for output_file that takes the image one band at a time; the format is chosen from the extension
+    """
+    return(band_writer_class(output_file)(output_file, size))
 
 
 def make_thumbnails(
@@ -332,25 +4226,60 @@ def make_thumbnails(
         input_files: List[str] = None, # list of file paths
         input_avgs: List[Avg] = None, # list of Avg instances
         input_is_csv: bool = False, # input_path is a .csv file
+        input_is_index: bool = False, # input_path is a binary index file
         x: int = 300,
         y: int = 300,
         bar_height: int = 50,
         ignore_file: str = None,
+        ignore_tolerance: int = 0,
         rename: bool = True,
         sort_key: str = 'hue',
+        threads: int = 2,
+        cache_file: str = None,
+        cache_hash: bool = False,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        shard: Tuple[int, int] = None,
+        profile_file: str = None,
+        metrics: bool = False,
+        slowest: int = 10,
+        executor: Any = None,
+        prefetch: int = 0,
+        prefetch_memory: int = 256,
+        prefetch_readers: int = 8,
+        resample: str = DEFAULT_RESAMPLE,
+        tile_cache_file: str = None,
+        tile_cache_size: int = DEFAULT_TILE_CACHE_MB,
+        max_tasks: int = None,
+        max_memory: float = None,
         *args, **kwargs) -> List[str]:
     """
     Create thumbnail images with average color information
     In parallel for all supplied images
+    include, exclude, max_depth, symlinks, sniff and shard choose the files used from a dir, see find_files
+    With profile_file and/or metrics, the time spent on each image is saved and/or summarized, see Profiler
+    executor is an Executor to run the work on, or the name of a backend for threads workers, see Executor.coerce
+    With prefetch, up to that many files (and prefetch_memory MB) are read ahead of the workers by prefetch_readers threads, see Prefetcher
+    resample is the filter used to resize the images, see load_tile
+    With tile_cache_file, the resized images are kept in a TileCache of up to tile_cache_size MB and re-used by later runs
+    max_tasks and max_memory are when the worker processes are replaced, see Executor
     """
     if not input_files and not input_avgs and not input_path:
         print(">>> ERROR: either input_avgs or input_files or input_path must be supplied")
         raise
 
-    avg_args = {'sort_key': sort_key}
-    ignore_pixels = []
-    if ignore_file:
-        ignore_pixels = set(load_all_pixels(ignore_file))
+    cache = open_cache(cache_file, cache_hash)
+    tile_cache = open_tile_cache(tile_cache_file, cache_hash, max_mb = tile_cache_size)
+    profiler = open_profiler(profile_file, metrics = metrics, slowest = slowest)
+    executor, own_executor = Executor.coerce(executor, threads, max_tasks = max_tasks, max_memory = max_memory)
+    threads = executor.workers
+    prefetcher = open_prefetcher(prefetch, memory = prefetch_memory, readers = prefetch_readers)
+    avg_args = {'sort_key': sort_key, 'cache': cache, 'profiler': profiler, 'executor': executor, 'prefetcher': prefetcher,
+        'resample': resample, 'tile_cache': tile_cache}
+    ignore_pixels = load_ignore_table(ignore_file, tolerance = ignore_tolerance)
 
     if ignore_pixels:
         avg_args['ignore_vals'] = ignore_pixels
@@ -360,18 +4289,25 @@ def make_thumbnails(
         input_path = Path(input_path)
         # find all files in the dir
         if input_path.is_dir():
-            input_files = [ p for p in input_path.glob('**/*') if p.is_file() ]
+            # the images start being processed while the dir is still being searched
+            input_files = profile_items(profiler, 'scan', find_files(input_path, include = include, exclude = exclude,
+                max_depth = max_depth, symlinks = symlinks, sniff = sniff, shard = shard, threads = threads))
         elif input_is_csv:
-            input_avgs = Avg.from_csv(input_path)
+            input_avgs = AvgTable.from_csv(input_path)
+        elif input_is_index:
+            input_avgs = AvgTable.from_index(input_path)
         elif input_path.is_file():
             input_files = [input_path]
 
     if not input_avgs:
         input_avgs = []
 
+    spool = None
     if input_files and not input_avgs:
         # NOTE: the images will get sorted by avg RGB HSV here unless sort_key = False is pased
-        input_avgs = Avg().from_list(paths = input_files, *args, **avg_args, **kwargs)
+        # the tiles are made in the same pass so that each image only gets decoded once
+        input_avgs, spool = load_avgs_and_tiles(paths = input_files, img_width = x, img_height = y,
+            threads = threads, *args, **avg_args, **kwargs)
 
     # make a list of tuples for the values we need to make each thumbnail
     rgb_paths = []
@@ -384,7 +4320,7 @@ def make_thumbnails(
         rgb_paths.append(rgb_path)
 
     # collect output paths for the completed thumbnails
-    output_paths = []
+    all_kwds = []
     for red, blue, green, input_path, output_path in rgb_paths:
         kwds = {
             'red': red,
@@ -394,10 +4330,33 @@ def make_thumbnails(
             'output_path': output_path,
             'img_width': x,
             'img_height': y,
-            'bar_height': bar_height
+            'bar_height': bar_height,
+            'resample': resample
             }
-        output, canvas = make_thumbnail(**kwds)
-        output_paths.append(output)
+        all_kwds.append(kwds)
+    max_in_flight = None
+    if spool:
+        all_kwds = ( dict(kwds, tile = spool.get(kwds['input_path'])) for kwds in all_kwds )
+    elif tile_cache:
+        # the tiles are loaded (or read from the cache) ahead of the thumbnails being made and saved
+        all_kwds = attach_tiles(all_kwds, img_width = x, img_height = y, resample = resample, tile_cache = tile_cache,
+            executor = executor, max_in_flight = 4 * threads)
+        max_in_flight = 4 * threads
+    with profile_stage(profiler, 'render'):
+        output_paths = list(imap_ordered(thumbnail_task, all_kwds, executor = executor, max_in_flight = max_in_flight))
+
+    if spool:
+        spool.close()
+    if cache:
+        cache.close()
+    if tile_cache:
+        tile_cache.close()
+    if own_executor:
+        executor.close()
+    if prefetcher:
+        prefetcher.close(profiler)
+    if profiler:
+        profiler.close()
     return(output_paths)
 
 def make_collage(
@@ -405,29 +4364,78 @@ def make_collage(
         input_avgs: List[Avg] = None,
         input_path: str = None, # dir or csv or file list to load files from
         input_is_csv: bool = False,
+        input_is_index: bool = False, # input_path is a binary index file
         output_file: str = "collage.jpg",
         x: int = 300, # width of each image
         y: int = 300, # height of each image
         ncol: int = 8, # number of columns in the collage
         bar_height: int = 50, # height for average colore bar on each image
         sort_key: str = 'hue',
+        threads: int = 2,
+        stream: bool = False,
+        cache_file: str = None,
+        cache_hash: bool = False,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        shard: Tuple[int, int] = None,
+        profile_file: str = None,
+        metrics: bool = False,
+        slowest: int = 10,
+        executor: Any = None,
+        prefetch: int = 0,
+        prefetch_memory: int = 256,
+        prefetch_readers: int = 8,
+        resample: str = DEFAULT_RESAMPLE,
+        tile_cache_file: str = None,
+        tile_cache_size: int = DEFAULT_TILE_CACHE_MB,
+        max_tasks: int = None,
+        max_memory: float = None,
         *args, **kwargs) -> str:
     """
     Make a collage image out of the supplied input image
     Adapted from https://github.com/fwenzel/collage
+
+    With stream = True the collage is rendered and written one row of images at a time,
+    so memory use does not depend on the number of rows; output_file must be a .png or .ppm file
+    include, exclude, max_depth, symlinks, sniff and shard choose the files used from a dir, see find_files
+    With profile_file and/or metrics, the time spent on each image is saved and/or summarized, see Profiler
+    executor is an Executor to run the work on, or the name of a backend for threads workers, see Executor.coerce
+    With prefetch, up to that many files (and prefetch_memory MB) are read ahead of the workers by prefetch_readers threads, see Prefetcher
+    resample is the filter used to resize the images, see load_tile
+    With tile_cache_file, the resized images are kept in a TileCache of up to tile_cache_size MB and re-used by later runs
+    max_tasks and max_memory are when the worker processes are replaced, see Executor
     """
-    avg_args = {'sort_key':sort_key}
+    cache = open_cache(cache_file, cache_hash)
+    tile_cache = open_tile_cache(tile_cache_file, cache_hash, max_mb = tile_cache_size)
+    profiler = open_profiler(profile_file, metrics = metrics, slowest = slowest)
+    executor, own_executor = Executor.coerce(executor, threads, max_tasks = max_tasks, max_memory = max_memory)
+    threads = executor.workers
+    prefetcher = open_prefetcher(prefetch, memory = prefetch_memory, readers = prefetch_readers)
+    avg_args = {'sort_key':sort_key, 'cache': cache, 'profiler': profiler, 'executor': executor, 'prefetcher': prefetcher,
+        'resample': resample, 'tile_cache': tile_cache}
 
     if not any([input_dicts, input_avgs, input_path]):
         print(">>> ERROR: either input_avgs or input_dicts or input_path must be supplied")
         raise
+    if stream:
+        band_writer_class(output_file)
 
+    spool = None
     if input_path and not input_avgs:
         if input_is_csv:
-            input_avgs = Avg.from_csv(input_path)
+            input_avgs = AvgTable.from_csv(input_path)
+        elif input_is_index:
+            input_avgs = AvgTable.from_index(input_path)
         else:
             # NOTE: this will automatically apply sorting
-            input_avgs = Avg.from_dir(dir = input_path, *args, **avg_args, **kwargs)
+            # the tiles are made in the same pass so that each image only gets decoded once
+            input_files = profile_items(profiler, 'scan', find_files(input_path, include = include, exclude = exclude,
+                max_depth = max_depth, symlinks = symlinks, sniff = sniff, shard = shard, threads = threads))
+            input_avgs, spool = load_avgs_and_tiles(paths = input_files, img_width = x, img_height = y,
+                threads = threads, *args, **avg_args, **kwargs)
 
     if input_dicts and not input_avgs:
         input_avgs = [ Avg.from_dict(d) for d in input_dicts ]
@@ -442,35 +4450,81 @@ def make_collage(
     canvas_height = img_height_padded * num_rows
     canvas_size = (canvas_width, canvas_height)
 
-    # start collage canvas
-    canvas = Image.new('RGB', canvas_size, "black")
+    writer = None
+    tiles = None
+    try:
+        with profile_stage(profiler, 'render'):
+            # start collage canvas
+            if stream:
+                # only one row of the collage is kept in memory at a time
+                writer = open_band_writer(output_file, canvas_size)
+                band_size = (canvas_width, img_height_padded)
+                canvas = None
+            else:
+                canvas = Image.new('RGB', canvas_size, "black")
 
-    # add each image to the collage canvas
-    img_num = 0
-    for avg in input_avgs:
-        rgb = (avg.red, avg.blue, avg.green)
+            # load and resize the input images in parallel
+            if spool:
+                tiles = ( spool.get(avg.path) for avg in input_avgs )
+            else:
+                tiles = iter_tiles(( avg.path for avg in input_avgs ), img_width = img_width, img_height = img_height,
+                    resample = resample, tile_cache = tile_cache, executor = executor, max_in_flight = 4 * max(ncol, threads))
+
+            # add each image to the collage canvas
+            img_num = 0
+            for avg, image in zip(input_avgs, tiles):
+                rgb = (avg.red, avg.blue, avg.green)
 
-        # line up top-left corner of image placement based on image number
-        position = img_num
-        x = position % ncol
-        y = position // ncol
-        xoff = x * img_width
-        yoff = y * img_height_padded
+                # line up top-left corner of image placement based on image number
+                position = img_num
+                x = position % ncol
+                y = position // ncol
+                xoff = x * img_width
+                yoff = y * img_height_padded
 
-        # load the input image and resize
-        image = Image.open(avg.path).resize((img_width, img_height), Image.ANTIALIAS)
+                # start the next row
+                if stream:
+                    if x == 0:
+                        if canvas is not None:
+                            writer.write(canvas)
+                        canvas = Image.new('RGB', band_size, "black")
+                    yoff = 0
 
-        # place color bar on the canvas
-        bar_coord = (xoff, yoff, xoff + img_width, yoff + img_height + bar_height)
-        canvas.paste(rgb, bar_coord)
+                # place color bar on the canvas
+                bar_coord = (xoff, yoff, xoff + img_width, yoff + img_height + bar_height)
+                canvas.paste(rgb, bar_coord)
 
-        # Place tile on canvas.
-        canvas.paste(image, (xoff, yoff))
+                # Place tile on canvas.
+                canvas.paste(image, (xoff, yoff))
 
-        img_num += 1
+                img_num += 1
 
-    # save canvas
-    canvas.save(output_file)
+            # save canvas
+            if stream:
+                if canvas is not None:
+                    writer.write(canvas)
+                writer.close()
+                writer = None
+            else:
+                canvas.save(output_file)
+    finally:
+        if tiles is not None:
+            # stops the worker pool if rendering failed part way
+            tiles.close()
+        if writer is not None:
+            writer.abort()
+        if spool:
+            spool.close()
+        if cache:
+            cache.close()
+        if tile_cache:
+            tile_cache.close()
+        if own_executor:
+            executor.close()
+        if prefetcher:
+            prefetcher.close(profiler)
+        if profiler:
+            profiler.close()
 
     return(output_file)
 
@@ -478,16 +4532,53 @@ def make_gif(
         input_path: str = None,
         input_avgs: List[Avg] = None,
         input_is_csv: bool = False, # input_path is a .csv file
+        input_is_index: bool = False, # input_path is a binary index file
         output_file: str = "image.gif",
         ignore_file: str = None,
+        ignore_tolerance: int = 0,
         x: int = 300,
         y: int = 300,
         bar_height: int = 50,
         sort_key: str = 'hue',
+        threads: int = 2,
+        stream: bool = False,
+        palette: str = 'adaptive',
+        palette_sample: int = 16,
+        cache_file: str = None,
+        cache_hash: bool = False,
+        include: List[str] = None,
+        exclude: List[str] = None,
+        max_depth: int = None,
+        symlinks: str = 'follow',
+        sniff: bool = False,
+        shard: Tuple[int, int] = None,
+        profile_file: str = None,
+        metrics: bool = False,
+        slowest: int = 10,
+        executor: Any = None,
+        prefetch: int = 0,
+        prefetch_memory: int = 256,
+        prefetch_readers: int = 8,
+        resample: str = DEFAULT_RESAMPLE,
+        tile_cache_file: str = None,
+        tile_cache_size: int = DEFAULT_TILE_CACHE_MB,
+        max_tasks: int = None,
+        max_memory: float = None,
         *args, **kwargs) -> str:
     """
     https://pillow.readthedocs.io/en/stable/handbook/image-file-formats.html#gif
 
+    With stream = True each frame is written as soon as it is made, see GIFStreamWriter.
+    palette = 'global' then uses one shared palette for all frames, made from the average colors of the images
+    and up to palette_sample of the frames; 'adaptive' gives each frame its own palette
+    include, exclude, max_depth, symlinks, sniff and shard choose the files used from a dir, see find_files
+    With profile_file and/or metrics, the time spent on each image is saved and/or summarized, see Profiler
+    executor is an Executor to run the work on, or the name of a backend for threads workers, see Executor.coerce
+    With prefetch, up to that many files (and prefetch_memory MB) are read ahead of the workers by prefetch_readers threads, see Prefetcher
+    resample is the filter used to resize the images, see load_tile
+    With tile_cache_file, the resized images are kept in a TileCache of up to tile_cache_size MB and re-used by later runs
+    max_tasks and max_memory are when the worker processes are replaced, see Executor
+
     equivalent to imagemagick:
     $ convert -resize 90% -delay 10 -loop 0 $(OUTPUTDIR)/thumbnails/{1..$(NUM_JPG)}.jpg $(OUTPUTDIR)/sequence.gif
     """
@@ -499,43 +4590,103 @@ def make_gif(
     img_height = y
 
     # check if ignore file was used
-    avg_args = {'sort_key':sort_key}
-    ignore_pixels = []
-    if ignore_file:
-        ignore_pixels = set(load_all_pixels(ignore_file))
+    cache = open_cache(cache_file, cache_hash)
+    tile_cache = open_tile_cache(tile_cache_file, cache_hash, max_mb = tile_cache_size)
+    profiler = open_profiler(profile_file, metrics = metrics, slowest = slowest)
+    executor, own_executor = Executor.coerce(executor, threads, max_tasks = max_tasks, max_memory = max_memory)
+    threads = executor.workers
+    prefetcher = open_prefetcher(prefetch, memory = prefetch_memory, readers = prefetch_readers)
+    avg_args = {'sort_key':sort_key, 'cache': cache, 'profiler': profiler, 'executor': executor, 'prefetcher': prefetcher,
+        'resample': resample, 'tile_cache': tile_cache}
+    ignore_pixels = load_ignore_table(ignore_file, tolerance = ignore_tolerance)
 
     if ignore_pixels:
         avg_args['ignore_vals'] = ignore_pixels
 
     # load all Avg instances if a input dir was passed
+    spool = None
     if input_path:
         if input_is_csv:
-            input_avgs = Avg.from_csv(input_path)
+            input_avgs = AvgTable.from_csv(input_path)
+        elif input_is_index:
+            input_avgs = AvgTable.from_index(input_path)
         else:
             # NOTE: this will automatically apply sorting
-            input_avgs = Avg.from_dir(dir = input_path, *args, **avg_args, **kwargs)
+            # the tiles are made in the same pass so that each image only gets decoded once
+            input_files = profile_items(profiler, 'scan', find_files(input_path, include = include, exclude = exclude,
+                max_depth = max_depth, symlinks = symlinks, sniff = sniff, shard = shard, threads = threads))
+            input_avgs, spool = load_avgs_and_tiles(paths = input_files, img_width = x, img_height = y,
+                threads = threads, *args, **avg_args, **kwargs)
 
     # start making thumbnails for each image
-    thumbnails = []
+    all_kwds = []
     for avg in input_avgs:
-        output_obj = BytesIO() # store the thumbnails in memory
         kwds = {
             'red': avg.red,
             'blue': avg.blue,
             'green': avg.green,
             'input_path': avg.path,
-            'output_path': output_obj,
             'img_width': img_width,
             'img_height': img_height,
-            'bar_height': bar_height
+            'bar_height': bar_height,
+            'resample': resample
             }
-        output_obj, canvas = make_thumbnail(**kwds)
-        thumbnails.append(canvas)
+        all_kwds.append(kwds)
 
-    # write out the final gif animation
-    first = thumbnails.pop(0)
-    first.save(fp=output_file, format='GIF', append_images=thumbnails,
-             save_all=True, duration=100, loop=0)
+    def render(kwds_list: Iterable[Dict]) -> Iterable[Image]:
+        if spool:
+            # only the canvases are left to be put together
+            return( make_thumbnail_canvas(tile = spool.get(kwds['input_path']), **kwds) for kwds in kwds_list )
+        if tile_cache:
+            kwds_list = attach_tiles(kwds_list, img_width = img_width, img_height = img_height, resample = resample,
+                tile_cache = tile_cache, executor = executor, max_in_flight = 4 * threads)
+        return(imap_ordered(thumbnail_canvas_task, kwds_list, executor = executor, max_in_flight = 4 * threads))
+
+    thumbnails = None
+    writer = None
+    try:
+        with profile_stage(profiler, 'render'):
+            # write out the final gif animation
+            if stream:
+                gif_palette = None
+                sample = {}
+                if palette == 'global':
+                    # make a sample of evenly spaced frames to get the palette from;
+                    # they are kept and used again when their turn comes instead of being made twice
+                    step = max(1, len(all_kwds) // palette_sample)
+                    sample_nums = list(range(0, len(all_kwds), step))[:palette_sample]
+                    sample = dict(zip(sample_nums, render([ all_kwds[i] for i in sample_nums ])))
+                    gif_palette = make_gif_palette([ (avg.red, avg.blue, avg.green) for avg in input_avgs ], list(sample.values()))
+                thumbnails = render( kwds for i, kwds in enumerate(all_kwds) if i not in sample )
+                writer = GIFStreamWriter(output_file, (img_width, img_height + bar_height),
+                    duration = 100, loop = 0, palette = gif_palette)
+                for i in range(len(all_kwds)):
+                    writer.write(sample.pop(i) if i in sample else next(thumbnails))
+                writer.close()
+                writer = None
+            else:
+                thumbnails = list(render(all_kwds))
+                first = thumbnails.pop(0)
+                first.save(fp=output_file, format='GIF', append_images=thumbnails,
+                         save_all=True, duration=100, loop=0)
+    finally:
+        if hasattr(thumbnails, 'close'):
+            # stops the worker pool if writing failed part way
+            thumbnails.close()
+        if writer is not None:
+            writer.abort()
+        if spool:
+            spool.close()
+        if cache:
+            cache.close()
+        if tile_cache:
+            tile_cache.close()
+        if own_executor:
+            executor.close()
+        if prefetcher:
+            prefetcher.close(profiler)
+        if profiler:
+            profiler.close()
 
     return(output_file)
 
@@ -552,16 +4703,137 @@ def main():
     # add sub-parsers for specific file outputs
     subparsers = parser.add_subparsers(help ='Sub-commands available')
 
-    sort_key_choices = ['path', 'red', 'green', 'blue', 'hue', 'saturation', 'value', 'pixels_total', 'pixels_counted', 'pixels_pcnt']
+    def add_cache_args(subparser):
+        """
+        Add the args for the persistent result cache to a sub-command parser
+        """
+        subparser.add_argument('--cache', dest = 'cache_file', default = DEFAULT_CACHE_FILE,
+            help = 'SQLite file used to cache image averages between runs (default: {})'.format(DEFAULT_CACHE_FILE))
+        subparser.add_argument('--no-cache', dest = 'cache_file', action = 'store_const', const = None,
+            help = 'Do not read or save cached image averages')
+        subparser.add_argument('--cache-hash', dest = 'cache_hash', action = 'store_true',
+            help = 'Re-use cached averages for files whose timestamp changed but whose contents hash the same')
+
+    def add_profile_args(subparser):
+        """
+        Add the args for timing the processing of each image to a sub-command parser
+        """
+        subparser.add_argument('--profile', dest = 'profile_file', default = None,
+            help = 'Save the time spent on each step for each image to this file, as one line of JSON per image followed by a summary')
+        subparser.add_argument('--metrics', dest = 'metrics', action = 'store_true',
+            help = 'Print a summary of the throughput, the time spent on each step, and the slowest images at the end of the run')
+        subparser.add_argument('--slowest', dest = 'slowest', default = 10, type = int,
+            help = 'Number of slowest images to list in the summary')
+
+    def add_executor_args(subparser):
+        """
+        Add the args that choose how the work is run in parallel to a sub-command parser
+        """
+        subparser.add_argument('--executor', dest = 'executor', default = 'auto', choices = EXECUTOR_CHOICES,
+            help = "Run the work in worker processes, worker threads (fastest when most of the time goes to decoding and resizing), "
+            "or one image at a time; 'auto' uses processes, or one at a time for --threads 1. "
+            "Use --threads auto for one worker per CPU")
+        subparser.add_argument('--max-tasks', dest = 'max_tasks', default = None, type = int,
+            help = 'Replace each worker process with a new one after it has run this many tasks')
+        subparser.add_argument('--max-memory', dest = 'max_memory', default = None, type = float,
+            help = 'Replace the worker processes once one of them has used more than this many MB')
+
+    def add_error_args(subparser):
+        """
+        Add the args that decide what happens to images that can not be evaluated to a sub-command parser
+        """
+        subparser.add_argument('--on-error', dest = 'on_error', default = 'fail', choices = ON_ERROR_CHOICES,
+            help = 'What to do with an image that can not be evaluated: stop, leave it out, '
+            'or try it again by itself up to {} times before leaving it out'.format(RETRY_ATTEMPTS))
+        subparser.add_argument('--failed', dest = 'failed_file', default = None,
+            help = 'Csv file to list the images that were left out in (default: next to the output, as <output>.failed.csv)')
+        subparser.add_argument('--timeout', dest = 'timeout', default = None, type = float,
+            help = 'Give up on an image that takes longer than this many seconds; not with --executor thread')
+        subparser.add_argument('--max-pixels', dest = 'max_pixels', default = None, type = int,
+            help = 'Turn down images with more pixels than this, before they are decoded')
+        subparser.add_argument('--max-file-size', dest = 'max_file_mb', default = None, type = float,
+            help = 'Turn down image files larger than this many MB, before they are decoded')
+
+    def add_prefetch_args(subparser):
+        """
+        Add the args for reading files ahead of the workers to a sub-command parser
+        """
+        subparser.add_argument('--prefetch', dest = 'prefetch', default = 0, type = int,
+            help = 'Read up to this many files ahead of the workers, which then decode them from memory; helps on slow or network filesystems')
+        subparser.add_argument('--prefetch-memory', dest = 'prefetch_memory', default = 256, type = int,
+            help = 'With --prefetch, stop reading ahead while the files read take up this many MB')
+        subparser.add_argument('--prefetch-readers', dest = 'prefetch_readers', default = 8, type = int,
+            help = 'With --prefetch, number of files to read at the same time')
+
+    def add_resample_args(subparser):
+        """
+        Add the args for resizing the images to tiles to a sub-command parser
+        """
+        subparser.add_argument('--resample', dest = 'resample', default = DEFAULT_RESAMPLE, choices = list(RESAMPLE_FILTERS),
+            help = 'Filter used to resize the images, from the fastest to the best looking')
+
+    def add_tile_cache_args(subparser):
+        """
+        Add the args for the persistent tile cache to a sub-command parser
+        """
+        subparser.add_argument('--tile-cache', dest = 'tile_cache_file', default = DEFAULT_TILE_CACHE_FILE,
+            help = 'SQLite file used to keep resized images between runs of thumbnails, collage, and gif; '
+            'with --cache-hash they are matched by a hash of the file contents (default: {})'.format(DEFAULT_TILE_CACHE_FILE))
+        subparser.add_argument('--no-tile-cache', dest = 'tile_cache_file', action = 'store_const', const = None,
+            help = 'Do not read or save cached resized images')
+        subparser.add_argument('--tile-cache-size', dest = 'tile_cache_size', default = DEFAULT_TILE_CACHE_MB, type = int,
+            help = 'Size limit of the tile cache in MB; past it the least recently used images are removed')
+
+    def add_walk_args(subparser):
+        """
+        Add the args that choose which files are used from an input dir to a sub-command parser
+        """
+        subparser.add_argument('--include', dest = 'include', action = 'append', default = None,
+            help = 'Only use files matching this glob pattern; patterns without a / match the file name. Can be given more than once')
+        subparser.add_argument('--exclude', dest = 'exclude', action = 'append', default = None,
+            help = 'Skip files and dirs matching this glob pattern. Can be given more than once')
+        subparser.add_argument('--max-depth', dest = 'max_depth', default = None, type = int,
+            help = 'Number of levels of subdirs to search, 0 is only the files in the input dir')
+        subparser.add_argument('--symlinks', dest = 'symlinks', default = 'follow', choices = SYMLINK_CHOICES,
+            help = "Search symlinked dirs ('follow'), only use symlinked files ('files'), or ignore all symlinks ('skip')")
+        subparser.add_argument('--sniff', dest = 'sniff', action = 'store_true',
+            help = 'Pick image files by their first bytes instead of their file extension')
+        subparser.add_argument('--shard', dest = 'shard', default = None, type = shard_arg,
+            help = 'Only use the files in part I of N (counting from 0) of the input dir, picked by a hash of their path, e.g. 0/4')
+
+    sort_key_help = 'Value to use for sorting output entries, one of {}; several can be given separated by commas'.format(', '.join(SORT_KEYS))
 
     # subparser for printing avg table output
     _print = subparsers.add_parser('print', help = 'Print sorted image data to console')
     _print.add_argument(dest = 'path', help = 'Input path to file or dir to print data for')
     _print.add_argument('--output', dest = 'output_file', default = "-", help = 'The name of the output file')
-    _print.add_argument('--threads', dest = 'threads', default = 4, help = 'Number of files to process in parallel')
+    _print.add_argument('--threads', dest = 'threads', default = 4, type = workers_arg, help = 'Number of files to process in parallel')
     _print.add_argument('--ignore', dest = 'ignore_file', default = None, help = 'File with pixels that should be ignored when calculating averages')
+    _print.add_argument('--ignore-tolerance', dest = 'ignore_tolerance', default = 0, type = int,
+        help = 'Also ignore pixels within this many RGB units (in every channel) of an ignored pixel')
     _print.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
-        choices = sort_key_choices, help = 'Value to use for sorting output entries')
+        type = check_sort_key, help = sort_key_help)
+    _print.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE,
+        choices = ENGINE_CHOICES, help = 'Backend to use for calculating image averages')
+    _print.add_argument('--approx', dest = 'approx', action = 'store_true',
+        help = 'Estimate averages from a reduced-scale decode and a sample of the pixels, and report the estimated error')
+    _print.add_argument('--tolerance', dest = 'tolerance', default = None, type = float,
+        help = 'With --approx, use the full image when the estimated error is larger than this many RGB units')
+    _print.add_argument('--unsorted', dest = 'unsorted', action = 'store_true',
+        help = 'Write each row as soon as its image is finished instead of sorting the output')
+    _print.add_argument('--buffer-size', dest = 'buffer_size', default = 100000, type = int,
+        help = 'Maximum number of rows to hold in memory while sorting; larger outputs are sorted in temporary files')
+    _print.add_argument('--histogram', dest = 'histogram', nargs = '?', default = 0, const = DEFAULT_HISTOGRAM_BINS,
+        type = check_histogram_bins, metavar = 'BINS',
+        help = 'Save a color histogram of each image with BINS bins per channel (default: {}), for use with stats'.format(DEFAULT_HISTOGRAM_BINS))
+    _print.add_argument('--index', dest = 'index_file', default = None,
+        help = 'Also save the table to this binary index file, which thumbnails, collage, and gif can load quickly with --index')
+    add_cache_args(_print)
+    add_walk_args(_print)
+    add_profile_args(_print)
+    add_executor_args(_print)
+    add_error_args(_print)
+    add_prefetch_args(_print)
     _print.set_defaults(func = print_from_path)
     """
     $ ./imagesort.py print assets/ --threads 6 --ignore ignore-pixels-white.jpg
@@ -572,15 +4844,31 @@ def main():
     _thumbnails = subparsers.add_parser('thumbnails', help = 'Create thumbnails which include the average color for each image')
     _thumbnails.add_argument('input_path', help = 'Input path to file or dir to make thumbnails for')
     _thumbnails.add_argument('--csv', dest = 'input_is_csv', action = "store_true", help = 'Input item is a .csv file to load data from')
+    _thumbnails.add_argument('--index', dest = 'input_is_index', action = "store_true", help = 'Input item is a binary index file made by print --index to load data from')
     _thumbnails.add_argument('-o', '--output', dest = 'output_dir', required = True, help = 'The name of the output directory')
-    _thumbnails.add_argument('--threads', dest = 'threads', default = 4, help = 'Number of files to process in parallel')
+    _thumbnails.add_argument('--threads', dest = 'threads', default = 4, type = workers_arg, help = 'Number of files to process in parallel')
     _thumbnails.add_argument('--ignore', dest = 'ignore_file', default = None, help = 'File with pixels that should be ignored when calculating averages')
+    _thumbnails.add_argument('--ignore-tolerance', dest = 'ignore_tolerance', default = 0, type = int,
+        help = 'Also ignore pixels within this many RGB units (in every channel) of an ignored pixel')
     _thumbnails.add_argument('--no-rename', dest = 'rename', action = "store_false", help = 'Do not rename the output files. WARNING: files with the same basename will get overwritten')
     _thumbnails.add_argument('-x', dest = 'x', default = 300, type = int, help = 'Width of output image thumbnail')
     _thumbnails.add_argument('-y', dest = 'y', default = 300, type = int, help = 'Height of output image thumbnail')
     _thumbnails.add_argument('--bar', dest = 'bar_height', default = 50, type = int, help = 'Height of output image average color bar for thumbnail')
     _thumbnails.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
-        choices = sort_key_choices, help = 'Value to use for sorting output entries')
+        type = check_sort_key, help = sort_key_help)
+    _thumbnails.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE,
+        choices = ENGINE_CHOICES, help = 'Backend to use for calculating image averages')
+    _thumbnails.add_argument('--approx', dest = 'approx', action = 'store_true',
+        help = 'Estimate averages from a reduced-scale decode and a sample of the pixels, and report the estimated error')
+    _thumbnails.add_argument('--tolerance', dest = 'tolerance', default = None, type = float,
+        help = 'With --approx, use the full image when the estimated error is larger than this many RGB units')
+    add_cache_args(_thumbnails)
+    add_walk_args(_thumbnails)
+    add_profile_args(_thumbnails)
+    add_executor_args(_thumbnails)
+    add_prefetch_args(_thumbnails)
+    add_resample_args(_thumbnails)
+    add_tile_cache_args(_thumbnails)
     _thumbnails.set_defaults(func = make_thumbnails)
     """
     $ ./imagesort.py thumbnails assets/ --output thumbnail_output/ --threads 6
@@ -590,34 +4878,162 @@ def main():
     _collage = subparsers.add_parser('collage', help = 'Create collage from all images which includes the average color for each image')
     _collage.add_argument('input_path', help = 'Input path to file or dir to make thumbnails for')
     _collage.add_argument('-o', '--output', dest = 'output_file', default = 'collage.jpg', help = 'Output file')
-    _collage.add_argument('--threads', dest = 'threads', default = 4, help = 'Number of files to process in parallel from dir input')
+    _collage.add_argument('--threads', dest = 'threads', default = 4, type = workers_arg, help = 'Number of files to process in parallel from dir input')
     _collage.add_argument('--csv', dest = 'input_is_csv', action = "store_true", help = 'Input item is a .csv file to load data from')
+    _collage.add_argument('--index', dest = 'input_is_index', action = "store_true", help = 'Input item is a binary index file made by print --index to load data from')
     _collage.add_argument('-x', dest = 'x', default = 300, type = int, help = 'Width of output image thumbnail for collage')
     _collage.add_argument('-y', dest = 'y', default = 300, type = int, help = 'Height of output image thumbnail for collage')
     _collage.add_argument('--bar', dest = 'bar_height', default = 50, type = int, help = 'Height of output image average color bar for thumbnail for collage')
     _collage.add_argument('-n', '--ncol', dest = 'ncol', default = 8, type = int, help = 'Number of columns in the collage')
+    _collage.add_argument('--stream', dest = 'stream', action = 'store_true',
+        help = 'Render and write the collage one row at a time to limit memory use; the output must be a .png or .ppm file')
     _collage.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
-        choices = sort_key_choices, help = 'Value to use for sorting output entries')
+        type = check_sort_key, help = sort_key_help)
+    _collage.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE,
+        choices = ENGINE_CHOICES, help = 'Backend to use for calculating image averages')
+    _collage.add_argument('--approx', dest = 'approx', action = 'store_true',
+        help = 'Estimate averages from a reduced-scale decode and a sample of the pixels, and report the estimated error')
+    _collage.add_argument('--tolerance', dest = 'tolerance', default = None, type = float,
+        help = 'With --approx, use the full image when the estimated error is larger than this many RGB units')
+    add_cache_args(_collage)
+    add_walk_args(_collage)
+    add_profile_args(_collage)
+    add_executor_args(_collage)
+    add_prefetch_args(_collage)
+    add_resample_args(_collage)
+    add_tile_cache_args(_collage)
     _collage.set_defaults(func = make_collage)
     """
     $ ./imagesort.py collage assets/ --output collage.jpg --threads 6
     $ ./imagesort.py collage data.csv --output collage.jpg --csv
+    $ ./imagesort.py collage data.csv --output collage.png --csv --stream
     """
 
     _gif = subparsers.add_parser('gif', help = 'Create gif from all images which includes the average color for each image')
     _gif.add_argument('input_path', help = 'Input path to file or dir to make thumbnails for')
     _gif.add_argument('--csv', dest = 'input_is_csv', action = "store_true", help = 'Input item is a .csv file to load data from')
+    _gif.add_argument('--index', dest = 'input_is_index', action = "store_true", help = 'Input item is a binary index file made by print --index to load data from')
     _gif.add_argument('-o', '--output', dest = 'output_file', default = 'image.gif', help = 'Output file')
-    _gif.add_argument('--threads', dest = 'threads', default = 4, help = 'Number of files to process in parallel from dir input')
+    _gif.add_argument('--threads', dest = 'threads', default = 4, type = workers_arg, help = 'Number of files to process in parallel from dir input')
     _gif.add_argument('--ignore', dest = 'ignore_file', default = None, help = 'File with pixels that should be ignored when calculating averages')
+    _gif.add_argument('--ignore-tolerance', dest = 'ignore_tolerance', default = 0, type = int,
+        help = 'Also ignore pixels within this many RGB units (in every channel) of an ignored pixel')
     _gif.add_argument('-x', dest = 'x', default = 300, type = int, help = 'Width of output image thumbnail for gif')
     _gif.add_argument('-y', dest = 'y', default = 300, type = int, help = 'Height of output image thumbnail for gif')
     _gif.add_argument('--bar', dest = 'bar_height', default = 50, type = int, help = 'Height of output image average color bar for thumbnail for gif')
+    _gif.add_argument('--stream', dest = 'stream', action = 'store_true',
+        help = 'Write each frame as soon as it is made to keep memory use flat')
+    _gif.add_argument('--palette', dest = 'palette', default = 'adaptive', choices = ['adaptive', 'global'],
+        help = 'With --stream, give each frame its own palette or share one palette made from the average colors and a sample of frames')
     _gif.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
-        choices = sort_key_choices, help = 'Value to use for sorting output entries')
+        type = check_sort_key, help = sort_key_help)
+    _gif.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE,
+        choices = ENGINE_CHOICES, help = 'Backend to use for calculating image averages')
+    _gif.add_argument('--approx', dest = 'approx', action = 'store_true',
+        help = 'Estimate averages from a reduced-scale decode and a sample of the pixels, and report the estimated error')
+    _gif.add_argument('--tolerance', dest = 'tolerance', default = None, type = float,
+        help = 'With --approx, use the full image when the estimated error is larger than this many RGB units')
+    add_cache_args(_gif)
+    add_walk_args(_gif)
+    add_profile_args(_gif)
+    add_executor_args(_gif)
+    add_prefetch_args(_gif)
+    add_resample_args(_gif)
+    add_tile_cache_args(_gif)
     _gif.set_defaults(func = make_gif)
     """
     $ ./imagesort.py gif assets/ --output image.gif --threads 6
+    $ ./imagesort.py gif assets/ --output image.gif --threads 6 --stream --palette global
+    """
+
+    # subparser for removing stale entries from the cache
+    _prune = subparsers.add_parser('prune', help = 'Remove cached averages for files that were deleted or changed')
+    _prune.add_argument('--cache', dest = 'cache_file', default = DEFAULT_CACHE_FILE, help = 'SQLite cache file to prune')
+    _prune.set_defaults(func = prune_cache)
+    """
+    $ ./imagesort.py prune --cache cache.sqlite
+    """
+
+    # subparser for updating a sorted table with the changes in a dir
+    _update = subparsers.add_parser('update', help = 'Update a sorted csv table from print with the files added, changed, or removed in a dir')
+    _update.add_argument(dest = 'csv_file', help = 'Sorted csv table made by print')
+    _update.add_argument(dest = 'path', help = 'Input dir the table was made from')
+    _update.add_argument('--output', dest = 'output_file', default = None, help = 'The name of the output file (default: replace the input table)')
+    _update.add_argument('--threads', dest = 'threads', default = 4, type = workers_arg, help = 'Number of files to process in parallel')
+    _update.add_argument('--ignore', dest = 'ignore_file', default = None, help = 'File with pixels that should be ignored when calculating averages')
+    _update.add_argument('--ignore-tolerance', dest = 'ignore_tolerance', default = 0, type = int,
+        help = 'Also ignore pixels within this many RGB units (in every channel) of an ignored pixel')
+    _update.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
+        type = check_sort_key, help = 'Value the table is sorted by, see print --key')
+    _update.add_argument('--engine', dest = 'engine', default = DEFAULT_ENGINE,
+        choices = ENGINE_CHOICES, help = 'Backend to use for calculating image averages')
+    _update.add_argument('--approx', dest = 'approx', action = 'store_true',
+        help = 'Estimate averages from a reduced-scale decode and a sample of the pixels, and report the estimated error')
+    _update.add_argument('--tolerance', dest = 'tolerance', default = None, type = float,
+        help = 'With --approx, use the full image when the estimated error is larger than this many RGB units')
+    _update.add_argument('--histogram', dest = 'histogram', nargs = '?', default = None, const = DEFAULT_HISTOGRAM_BINS,
+        type = check_histogram_bins, metavar = 'BINS',
+        help = 'Save a color histogram of each new image, see print --histogram (default: if the table has them)')
+    add_cache_args(_update)
+    add_walk_args(_update)
+    add_profile_args(_update)
+    add_executor_args(_update)
+    add_error_args(_update)
+    add_prefetch_args(_update)
+    _update.set_defaults(func = update_csv)
+    """
+    $ ./imagesort.py update data.csv assets/jpg/
+    """
+
+    # subparser for statistics from saved histograms
+    _stats = subparsers.add_parser('stats', help = 'Work out averages and other statistics again from the histograms in a table from print --histogram')
+    _stats.add_argument(dest = 'csv_file', help = 'Csv table made by print --histogram')
+    _stats.add_argument('--output', dest = 'output_file', default = "-", help = 'The name of the output file')
+    _stats.add_argument('--ignore', dest = 'ignore_file', default = None, help = 'File with pixels that should be ignored when calculating averages')
+    _stats.add_argument('--ignore-tolerance', dest = 'ignore_tolerance', default = 0, type = int,
+        help = 'Also ignore pixels within this many RGB units (in every channel) of an ignored pixel')
+    _stats.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
+        type = check_sort_key, help = 'Value to use for sorting output entries, see print --key')
+    _stats.add_argument('--dominant', dest = 'dominant', default = 3, type = int,
+        help = 'Number of dominant colors to list for each image')
+    _stats.set_defaults(func = histogram_stats)
+    """
+    $ ./imagesort.py print assets/ --histogram --output data.csv
+    $ ./imagesort.py stats data.csv --ignore ignore-pixels-white.jpg --output stats.csv
+    """
+
+    # subparser for finding the images closest to some colors
+    _query = subparsers.add_parser('query', help = 'Find the images with the closest average colors in a table from print')
+    _query.add_argument(dest = 'input_path', help = 'Csv table or binary index (.idx) made by print')
+    _query.add_argument(dest = 'colors', nargs = '*', help = 'Colors to look for, as rrggbb, #rrggbb or red,green,blue')
+    _query.add_argument('--colors-file', dest = 'colors_file', default = None, help = 'File with more colors to look for, one per line')
+    _query.add_argument('--nearest', dest = 'nearest', default = None, type = int,
+        help = 'Number of closest images to find for each color (default: 10, or all within --radius)')
+    _query.add_argument('--radius', dest = 'radius', default = None, type = float,
+        help = 'Only find images within this distance of each color')
+    _query.add_argument('--space', dest = 'space', default = 'lab', choices = COLOR_SPACES,
+        help = 'Color space to measure distances in')
+    _query.add_argument('--tree', dest = 'tree_file', default = None,
+        help = 'File to keep the search tree in (default: next to the input, as <input>.<space>.kdtree)')
+    _query.add_argument('--rebuild', dest = 'rebuild', action = 'store_true', help = 'Build the search tree again even if it is up to date')
+    _query.add_argument('--output', dest = 'output_file', default = "-", help = 'The name of the output file')
+    _query.set_defaults(func = query_colors)
+    """
+    $ ./imagesort.py query data.csv 3a7bd5 '#ff0000' --nearest 50
+    $ ./imagesort.py query data.idx 0,0,0 --radius 10 --space rgb
+    """
+
+    # subparser for merging sorted tables made on several nodes
+    _merge = subparsers.add_parser('merge', help = 'Merge sorted csv tables from print, e.g. one per --shard, into one sorted table')
+    _merge.add_argument(dest = 'input_files', nargs = '+', help = 'Sorted csv tables made by print')
+    _merge.add_argument('--output', dest = 'output_file', default = "-", help = 'The name of the output file')
+    _merge.add_argument('-k', '--key', dest = 'sort_key', default = 'hue',
+        type = check_sort_key, help = 'Value the tables are sorted by, see print --key')
+    _merge.set_defaults(func = merge_csv)
+    """
+    $ ./imagesort.py print assets/ --shard 0/2 --output data.0.csv
+    $ ./imagesort.py print assets/ --shard 1/2 --output data.1.csv
+    $ ./imagesort.py merge data.0.csv data.1.csv --output data.csv
     """
 
     args = parser.parse_args()
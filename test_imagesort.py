@@ -7,12 +7,36 @@ import os
 import unittest
 import shutil
 from tempfile import mkdtemp
+from pathlib import Path
 import colorsys
+from typing import Dict, List
 import hashlib
+import math
+import time
+import itertools
+import csv
+import json
+import pickle
+from unittest import mock
+from PIL import Image
+import numpy as np
+import imagesort
 from imagesort import Avg
 from imagesort import make_thumbnail, make_thumbnails, load_all_pixels, write_csv
-from imagesort import make_collage
-from imagesort import make_gif
+from imagesort import load_tile
+from imagesort import make_collage, imap_ordered, Executor, Prefetcher
+from imagesort import FailureReport, RETRY_ATTEMPTS
+from imagesort import make_gif, make_gif_palette, GIFStreamWriter
+from imagesort import ResultCache, open_cache
+from imagesort import TileCache, open_tile_cache
+from imagesort import external_sort
+from imagesort import IgnoreTable, print_from_path
+from imagesort import find_files, update_csv, merge_csv, shard_arg
+from imagesort import ColorHistogram, histogram_stats
+from imagesort import ColorTree, open_color_tree, query_colors, color_points, parse_color
+from imagesort import AvgIndex, AvgTable, write_index, avg_sort_key
+from imagesort import hilbert_index, color_sort_values, check_sort_key
+import benchmark
 
 # get paths to the fixture image files
 THIS_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -22,6 +46,8 @@ black_jpg = os.path.join(fixtures_dir, "black.jpg")
 green_jpg = os.path.join(fixtures_dir, "green.jpg")
 colors_jpg = os.path.join(fixtures_dir, "colors.jpg")
 red_jpg = os.path.join(fixtures_dir, "red.jpg")
+ignore_white_jpg = os.path.join(THIS_DIR, "ignore-pixels-white.jpg")
+slide_jpg = os.path.join(THIS_DIR, "assets", "jpg", "Bones", "Slide01.jpg")
 
 # these are the expected average values for each image
 colors_expected = {'red': 127, 'green': 127, 'blue': 89, 'pixels_total': 4, 'pixels_counted': 4, 'hue': 0.16666666666666666, 'saturation': 0.2992125984251969, 'value': 127, 'pixels_pcnt': 100.0, 'path': colors_jpg}
@@ -33,6 +59,14 @@ white_expected = {'red': 255, 'green': 255, 'blue': 255, 'pixels_total': 1, 'pix
 green_expected = {'red': 1, 'green': 255, 'blue': 1, 'pixels_total': 1, 'pixels_counted': 1, 'hue': 0.3333333333333333, 'saturation': 0.996078431372549, 'value': 255, 'pixels_pcnt': 100.0, 'path': green_jpg}
 
 
+def double_or_fail(x: int) -> int:
+    """
+    Task for the worker pool tests, fails on the number 3
+    """
+    if x == 3:
+        raise ValueError("bad item")
+    return(x * 2)
+
 def md5_file(filename: str) -> str:
     """
     Get md5sum of a file by reading it in small chunks. This avoids issues with Python memory usage when hashing large files.
@@ -73,6 +107,50 @@ class TestAvg(unittest.TestCase):
         for key in colors_minus_green_expected.keys():
             self.assertEqual(getattr(avg, key), colors_minus_green_expected[key])
 
+    def test_avg_engines(self):
+        """
+        Check that the numpy and python engines return the same values
+        """
+        for ignore_vals in [None, [(1, 255, 2)], load_all_pixels(ignore_white_jpg)]:
+            for path in [colors_jpg, slide_jpg]:
+                python_avg = Avg.get_avg_rgb_hsv(path, ignore_vals = ignore_vals, engine = 'python')
+                numpy_avg = Avg.get_avg_rgb_hsv(path, ignore_vals = ignore_vals, engine = 'numpy')
+                self.assertEqual(python_avg, numpy_avg)
+
+        avg = Avg(path = colors_jpg, ignore_vals = [(1, 255, 2)], engine = 'numpy')
+        for key in colors_minus_green_expected.keys():
+            self.assertEqual(getattr(avg, key), colors_minus_green_expected[key])
+
+    def test_avg_approx(self):
+        """
+        Check that the approximate mode is close to the full averages and falls back to them past the tolerance
+        """
+        ignore_vals = load_all_pixels(ignore_white_jpg)
+        expected = Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = ignore_vals)
+        for engine in ['numpy', 'python']:
+            approx = Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = ignore_vals, engine = engine, approx = True, sample_pixels = 20000)
+            self.assertEqual(approx['pixels_total'], expected['pixels_total'])
+            self.assertTrue(0 < approx['error'] < 3)
+            for key in ['red', 'green', 'blue']:
+                self.assertLessEqual(abs(approx[key] - expected[key]), 3)
+
+        # a tolerance smaller than the estimated error uses all the pixels
+        approx = Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = ignore_vals, approx = True, sample_pixels = 20000, tolerance = 0.1)
+        self.assertEqual(approx.pop('error'), 0.0)
+        self.assertEqual(approx, expected)
+
+        # the fall back does not re-use a supplied image, which has been reduced in size for the sample
+        approx = Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = ignore_vals, approx = True, sample_pixels = 20000, tolerance = 0.1,
+            image = Image.open(slide_jpg))
+        self.assertEqual(approx.pop('error'), 0.0)
+        self.assertEqual(approx, expected)
+
+        # small images are not reduced or sampled
+        avg = Avg(path = colors_jpg, approx = True)
+        for key in colors_expected.keys():
+            self.assertEqual(getattr(avg, key), colors_expected[key])
+        self.assertEqual(avg.to_dict()['error'], 0.0)
+
     def test_from_dict(self):
         """
         Check that Avg objects is instantiated from a dict of values
@@ -92,6 +170,12 @@ class TestAvg(unittest.TestCase):
             for key in e.keys():
                 self.assertEqual(getattr(avgs[i], key), e[key])
 
+        # with the pure python engine
+        avgs = Avg().from_list(paths = paths, sort_key = False, engine = 'python')
+        for i, e in enumerate([colors_expected, green_expected, white_expected]):
+            for key in e.keys():
+                self.assertEqual(getattr(avgs[i], key), e[key])
+
         # with sort key
         # make sure to use  threads = 1 so that list is returned in same order it went in for test case!!
         avgs = Avg().from_list(paths = paths, threads = 1)
@@ -99,6 +183,47 @@ class TestAvg(unittest.TestCase):
             for key in e.keys():
                 self.assertEqual(getattr(avgs[i], key), e[key])
 
+    def test_iter_from_list(self):
+        """
+        Check that Avg objects are yielded for each path, in the input order if requested
+        """
+        paths = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg]
+        avgs = list(Avg.iter_from_list(paths = paths, chunksize = 1, max_in_flight = 2))
+        self.assertEqual(sorted(avg.path for avg in avgs), sorted(paths))
+
+        avgs = list(Avg.iter_from_list(paths = iter(paths), chunksize = 2, ordered = True))
+        self.assertEqual([avg.path for avg in avgs], paths)
+
+    def test_external_sort(self):
+        """
+        Check that sorting with temporary files gives the same order as sorting in memory
+        """
+        paths = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg]
+        expected = Avg.from_list(paths = paths, threads = 1)
+        unsorted = Avg.from_list(paths = paths, threads = 1, sort_key = False)
+        for buffer_size in [1, 2, 10]:
+            avgs = list(external_sort(unsorted, sort_key = 'hue', buffer_size = buffer_size, tmpdir = self.tmpdir))
+            self.assertEqual([avg.to_dict() for avg in avgs], [avg.to_dict() for avg in expected])
+        self.assertEqual(os.listdir(self.tmpdir), [])
+
+    def test_external_sort_path(self):
+        """
+        Check that sorting by path gives the same order for Path objects as for paths read back from temporary files
+        """
+        input_dir = os.path.join(self.tmpdir, "input")
+        paths = []
+        for name in ["a.b/1.jpg", "a/2.jpg", "a-b/3.jpg", "a/b/4.jpg", "b.jpg"]:
+            path = os.path.join(input_dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            shutil.copyfile(colors_jpg, path)
+            paths.append(Path(path))
+        unsorted = Avg.from_list(paths = paths, threads = 1, sort_key = False)
+        expected = [ str(avg.path) for avg in Avg.from_list(paths = paths, threads = 1, sort_key = 'path') ]
+        self.assertEqual(expected, [ str(p) for p in sorted(paths) ])
+        for buffer_size in [1, 2, 10]:
+            avgs = external_sort(unsorted, sort_key = 'path', buffer_size = buffer_size, tmpdir = self.tmpdir)
+            self.assertEqual([ str(avg.path) for avg in avgs ], expected)
+
     def test_from_csv(self):
         """
         Test loading list of Avg's from a csv file
@@ -111,6 +236,1020 @@ class TestAvg(unittest.TestCase):
             for key in e.keys():
                 self.assertEqual(getattr(avgs[i], key), e[key])
 
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.cache_file = os.path.join(self.tmpdir, "cache.sqlite")
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_cache_from_list(self):
+        """
+        Check that results are saved to the cache and loaded back from it for unchanged files
+        """
+        colors_copy = os.path.join(self.tmpdir, "colors.jpg")
+        shutil.copyfile(colors_jpg, colors_copy)
+        paths = [colors_copy, green_jpg]
+        with ResultCache(self.cache_file) as cache:
+            avgs = Avg.from_list(paths = paths, sort_key = False, threads = 1, cache = cache)
+            params = cache.params_key()
+            self.assertEqual(len(cache.get_many(paths, params)), 2)
+            # cached entries are kept separately for each set of ignore pixels
+            self.assertEqual(cache.get_many(paths, cache.params_key(ignore_vals = [(1, 255, 2)])), {})
+
+            cached_avgs = Avg.from_list(paths = paths, sort_key = False, threads = 1, cache = cache)
+            for avg, cached_avg in zip(avgs, cached_avgs):
+                self.assertEqual(avg.to_dict(), cached_avg.to_dict())
+
+            # changing the file invalidates its entry
+            shutil.copyfile(white_jpg, colors_copy)
+            self.assertEqual(list(cache.get_many(paths, params).keys()), [1])
+            avgs = Avg.from_list(paths = paths, sort_key = False, threads = 1, cache = cache)
+            self.assertEqual(avgs[0].red, white_expected['red'])
+
+            # deleted files are removed by pruning
+            os.remove(colors_copy)
+            self.assertEqual(cache.prune(), 1)
+
+    def test_cache_content_hash(self):
+        """
+        Check that a file with a new timestamp but the same contents is a hit when hashing is enabled
+        """
+        colors_copy = os.path.join(self.tmpdir, "colors.jpg")
+        shutil.copyfile(colors_jpg, colors_copy)
+        with ResultCache(self.cache_file, content_hash = True) as cache:
+            Avg.from_list(paths = [colors_copy], threads = 1, cache = cache)
+            stat = os.stat(colors_copy)
+            os.utime(colors_copy, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            found = cache.get_many([colors_copy], cache.params_key())
+            self.assertEqual(found[0]['red'], colors_expected['red'])
+
+    def test_cache_unavailable(self):
+        """
+        Check that a cache file that cannot be created does not stop the averages from being calculated
+        """
+        not_a_dir = os.path.join(self.tmpdir, "file.txt")
+        open(not_a_dir, "w").close()
+        self.assertIsNone(open_cache(os.path.join(not_a_dir, "cache.sqlite")))
+
+        input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(input_dir)
+        shutil.copyfile(colors_jpg, os.path.join(input_dir, "colors.jpg"))
+        output_file = os.path.join(self.tmpdir, "avgs.csv")
+        print_from_path(path = input_dir, output_file = output_file, threads = 1,
+            cache_file = os.path.join(not_a_dir, "cache.sqlite"))
+        with open(output_file) as f:
+            self.assertEqual(int(next(csv.DictReader(f))['red']), colors_expected['red'])
+
+class TestTileCache(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.cache_file = os.path.join(self.tmpdir, "tiles.sqlite")
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_tile_cache(self):
+        """
+        Check that saved tiles are loaded back unchanged, and only for the same file contents and tile parameters
+        """
+        colors_copy = os.path.join(self.tmpdir, "colors.jpg")
+        shutil.copyfile(colors_jpg, colors_copy)
+        palette_png = os.path.join(self.tmpdir, "palette.png")
+        Image.open(slide_jpg).convert('P', palette = Image.ADAPTIVE, colors = 16).save(palette_png)
+        paths = [colors_copy, slide_jpg, palette_png]
+        tiles = [ load_tile(path, img_width = 40, img_height = 30) for path in paths ]
+        self.assertEqual(tiles[2].mode, 'P')
+        with TileCache(self.cache_file) as cache:
+            params = cache.params_key(40, 30)
+            self.assertEqual(cache.get_many(paths, params), {})
+            cache.put_many(list(zip(paths, tiles)), params)
+            found = cache.get_many(paths, params)
+            for i, tile in enumerate(tiles):
+                self.assertEqual(found[i].mode, tile.mode)
+                self.assertEqual(found[i].tobytes(), tile.tobytes())
+            self.assertEqual(found[2].getpalette(), tiles[2].getpalette())
+            # other sizes and filters are kept separately
+            self.assertEqual(cache.get_many(paths, cache.params_key(40, 30, 'nearest')), {})
+            self.assertEqual(cache.get_many(paths, cache.params_key(30, 40)), {})
+
+            # a new timestamp is a miss, unless the tiles are matched by the file contents
+            stat = os.stat(colors_copy)
+            os.utime(colors_copy, ns = (stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            self.assertEqual(list(cache.get_many(paths, params).keys()), [1, 2])
+        with TileCache(self.cache_file, content_hash = True) as cache:
+            cache.put_many([(colors_copy, tiles[0])], params)
+            # a copy of the file shares the same tile
+            other_copy = os.path.join(self.tmpdir, "other.jpg")
+            shutil.copyfile(colors_jpg, other_copy)
+            self.assertEqual(cache.get_many([other_copy], params)[0].tobytes(), tiles[0].tobytes())
+
+        not_a_dir = os.path.join(self.tmpdir, "file.txt")
+        open(not_a_dir, "w").close()
+        self.assertIsNone(open_tile_cache(os.path.join(not_a_dir, "tiles.sqlite")))
+
+    def test_tile_cache_eviction(self):
+        """
+        Check that the least recently used tiles are removed when the cache is over its size limit
+        """
+        paths = []
+        for name in ["a.jpg", "b.jpg", "c.jpg"]:
+            paths.append(os.path.join(self.tmpdir, name))
+            shutil.copyfile(slide_jpg, paths[-1])
+        tile = load_tile(slide_jpg, img_width = 40, img_height = 30)
+        with TileCache(self.cache_file) as cache:
+            params = cache.params_key(40, 30)
+            cache.put_many([(paths[0], tile)], params)
+            time.sleep(0.01)
+            cache.put_many([(paths[1], tile)], params)
+            cache.max_bytes = cache.conn.execute("SELECT SUM(nbytes) FROM tiles").fetchone()[0]
+            # using the first tile makes the second one the least recently used
+            time.sleep(0.01)
+            self.assertEqual(list(cache.find_many(paths[:1], params).keys()), [0])
+            time.sleep(0.01)
+            cache.put_many([(paths[2], tile)], params)
+            self.assertEqual(sorted(cache.get_many(paths, params).keys()), [0, 2])
+            self.assertEqual(cache.evict(), 0)
+
+    def test_tile_cache_commands(self):
+        """
+        Check that thumbnails, collage, and gif make the same output with a cold and a warm tile cache,
+        and that the warm runs do not resize any images
+        """
+        input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(input_dir)
+        for path in [colors_jpg, green_jpg, red_jpg, slide_jpg]:
+            shutil.copyfile(path, os.path.join(input_dir, os.path.basename(path)))
+        output_csv = os.path.join(self.tmpdir, "data.csv")
+        print_from_path(path = input_dir, output_file = output_csv, threads = 1)
+        cache_args = {'tile_cache_file': self.cache_file, 'cache_file': os.path.join(self.tmpdir, "cache.sqlite"), 'executor': 'serial'}
+
+        def render(output_dir: str, **kwargs) -> List[str]:
+            os.makedirs(output_dir)
+            outputs = make_thumbnails(output_dir = output_dir, input_path = output_csv, input_is_csv = True, x = 40, y = 30, **kwargs)
+            outputs += make_thumbnails(output_dir = output_dir, input_path = input_dir, x = 40, y = 30, rename = False, **kwargs)
+            outputs.append(make_collage(input_path = input_dir, output_file = os.path.join(output_dir, "dir.png"), x = 40, y = 30, **kwargs))
+            outputs.append(make_collage(input_path = output_csv, input_is_csv = True, output_file = os.path.join(output_dir, "csv.png"),
+                x = 40, y = 30, **kwargs))
+            outputs.append(make_gif(input_path = output_csv, input_is_csv = True, output_file = os.path.join(output_dir, "csv.gif"),
+                x = 40, y = 30, stream = True, palette = 'global', palette_sample = 2, **kwargs))
+            return([ md5_file(output) for output in outputs ])
+
+        expected = render(os.path.join(self.tmpdir, "none"), executor = 'serial')
+        self.assertEqual(render(os.path.join(self.tmpdir, "cold"), **cache_args), expected)
+        with mock.patch('imagesort.load_tile', side_effect = AssertionError("tile was not cached")):
+            self.assertEqual(render(os.path.join(self.tmpdir, "warm"), **cache_args), expected)
+            self.assertEqual(render(os.path.join(self.tmpdir, "threads"), **dict(cache_args, executor = 'thread')), expected)
+
+class TestIgnoreTable(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_membership(self):
+        """
+        Check that the table holds exactly the ignored colors
+        """
+        table = IgnoreTable.from_pixels([(1, 255, 2), (0, 0, 0), (255, 255, 255), (1, 255, 2)])
+        self.assertEqual(len(table), 3)
+        self.assertTrue(table)
+        for rgb in [(1, 255, 2), (0, 0, 0), (255, 255, 255)]:
+            self.assertIn(rgb, table)
+        for rgb in [(1, 255, 1), (2, 255, 2), (0, 0, 1), (255, 255, 254)]:
+            self.assertNotIn(rgb, table)
+        self.assertFalse(IgnoreTable())
+        self.assertIsNone(IgnoreTable.coerce(IgnoreTable()))
+        self.assertIsNone(IgnoreTable.coerce([]))
+
+        # a copy sent to another process holds the same colors
+        copy = pickle.loads(pickle.dumps(table))
+        self.assertEqual(copy.bitmap, table.bitmap)
+        self.assertEqual(copy.fingerprint(), table.fingerprint())
+
+    def test_expand(self):
+        """
+        Check the tolerance against a brute force search of every color, including colors on the edges of the RGB cube
+        """
+        pixels = [(0, 0, 0), (255, 255, 255), (10, 20, 255), (128, 0, 200), (3, 254, 1)]
+        channel = np.arange(256)
+        for tolerance in [1, 2]:
+            expected = np.zeros((256, 256, 256), dtype = np.bool_)
+            for red, green, blue in pixels:
+                expected |= ((np.abs(channel - red) <= tolerance)[:, None, None]
+                    & (np.abs(channel - green) <= tolerance)[None, :, None]
+                    & (np.abs(channel - blue) <= tolerance)[None, None, :])
+            table = IgnoreTable.from_pixels(pixels, tolerance = tolerance)
+            self.assertTrue(np.array_equal(table.lut, expected.reshape(-1)))
+            self.assertEqual(len(table), int(expected.sum()))
+
+        # a blue of 255 must not spill over into the next green value
+        table = IgnoreTable.from_pixels([(10, 20, 255)], tolerance = 1)
+        self.assertIn((11, 21, 254), table)
+        self.assertNotIn((10, 21, 0), table)
+        self.assertNotIn((10, 20, 0), table)
+        self.assertIs(table.expand(0), table)
+
+    def test_from_file(self):
+        """
+        Check that reading the ignore colors from a file gives the same table with or without numpy
+        """
+        for path in [colors_jpg, ignore_white_jpg]:
+            expected = IgnoreTable.from_pixels(load_all_pixels(path), tolerance = 1)
+            self.assertEqual(IgnoreTable.from_file(path, tolerance = 1).bitmap, expected.bitmap)
+            with mock.patch('imagesort.np', None):
+                self.assertEqual(IgnoreTable.from_file(path, tolerance = 1).bitmap, expected.bitmap)
+
+    def test_table_matches_list(self):
+        """
+        Check that averages with a table of ignore colors are the same as with a plain list of them
+        """
+        for ignore_vals in [[(1, 255, 2)], load_all_pixels(ignore_white_jpg)]:
+            table = IgnoreTable.from_pixels(ignore_vals)
+            for engine in ['numpy', 'python']:
+                for path in [colors_jpg, slide_jpg]:
+                    self.assertEqual(
+                        Avg.get_avg_rgb_hsv(path, ignore_vals = table, engine = engine),
+                        Avg.get_avg_rgb_hsv(path, ignore_vals = ignore_vals, engine = engine))
+
+    def test_print_ignore_tolerance(self):
+        """
+        Check that the ignore tolerance also skips colors close to the ones in the ignore file
+        """
+        input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(input_dir)
+        shutil.copyfile(colors_jpg, os.path.join(input_dir, "colors.jpg"))
+        counted = []
+        for tolerance in [0, 1]:
+            output_file = os.path.join(self.tmpdir, "avgs.{}.csv".format(tolerance))
+            # green.jpg is (1, 255, 1), colors.jpg has (1, 255, 2)
+            print_from_path(path = input_dir, output_file = output_file, threads = 1,
+                ignore_file = green_jpg, ignore_tolerance = tolerance)
+            with open(output_file) as f:
+                rows = list(csv.DictReader(f))
+            counted.append(int(rows[0]['pixels_counted']))
+        self.assertEqual(counted, [4, 3])
+
+class TestFindFiles(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.root = os.path.join(self.tmpdir, "images")
+        for name, source in [
+                ("a.jpg", colors_jpg),
+                ("notes.txt", os.path.join(fixtures_dir, "notes.txt")),
+                ("noext", red_jpg),
+                ("fake.jpg", os.path.join(fixtures_dir, "notes.txt")),
+                ("sub/b.PNG", green_jpg),
+                ("sub/deep/c.jpg", white_jpg),
+                ("skip/d.jpg", black_jpg),
+                ]:
+            path = os.path.join(self.root, name)
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            shutil.copyfile(source, path)
+        os.symlink(os.path.join(self.root, "sub"), os.path.join(self.root, "link"))
+        os.symlink(self.root, os.path.join(self.root, "sub", "loop"))
+        os.symlink(os.path.join(self.root, "a.jpg"), os.path.join(self.root, "sub", "linked.jpg"))
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def find(self, **kwargs) -> List[str]:
+        return([ os.path.relpath(str(p), self.root) for p in find_files(self.root, **kwargs) ])
+
+    def test_find_files(self):
+        """
+        Check that only image files are found, each dir is searched once, and the order matches Path.glob
+        """
+        found = self.find()
+        self.assertEqual(sorted(found), sorted(["a.jpg", "fake.jpg", "sub/b.PNG", "sub/linked.jpg", "sub/deep/c.jpg", "skip/d.jpg"]))
+        expected = [ os.path.relpath(str(p), self.root) for p in Path(self.root).glob('*/**/*.*')
+            if p.is_file() and not p.is_symlink() and 'link' not in p.parts and 'loop' not in p.parts and p.name != 'notes.txt' ]
+        self.assertEqual([ f for f in found if '/' in f and f != 'sub/linked.jpg' ], expected)
+        for threads in [2, 4]:
+            self.assertEqual(self.find(threads = threads), found)
+
+    def test_find_files_options(self):
+        """
+        Check the file sniffing, glob patterns, depth limit, and symlink choices
+        """
+        self.assertEqual(sorted(self.find(sniff = True, max_depth = 0)), ["a.jpg", "noext"])
+        self.assertEqual(sorted(self.find(max_depth = 1)), ["a.jpg", "fake.jpg", "skip/d.jpg", "sub/b.PNG", "sub/linked.jpg"])
+        self.assertEqual(sorted(self.find(exclude = ["skip", "fake.*", "sub/deep"])), ["a.jpg", "sub/b.PNG", "sub/linked.jpg"])
+        self.assertEqual(self.find(include = ["*.PNG"]), ["sub/b.PNG"])
+        self.assertEqual(sorted(self.find(include = ["sub/*"], exclude = ["*/deep"])), ["sub/b.PNG", "sub/linked.jpg"])
+        self.assertEqual(sorted(self.find(symlinks = 'files', exclude = ["sub"])), ["a.jpg", "fake.jpg", "skip/d.jpg"])
+        self.assertEqual(sorted(self.find(symlinks = 'skip')), ["a.jpg", "fake.jpg", "skip/d.jpg", "sub/b.PNG", "sub/deep/c.jpg"])
+        # a symlinked dir is searched when the real dir is excluded
+        self.assertEqual(sorted(self.find(exclude = ["sub", "fake.jpg", "skip"])),
+            ["a.jpg", "link/b.PNG", "link/deep/c.jpg", "link/linked.jpg"])
+        with self.assertRaises(ValueError):
+            self.find(symlinks = 'sometimes')
+
+    def test_print_skips_other_files(self):
+        """
+        Check that files that are not images do not stop a dir from being processed
+        """
+        output_file = os.path.join(self.tmpdir, "avgs.csv")
+        print_from_path(path = self.root, output_file = output_file, threads = 2, exclude = ["fake.jpg"], sort_key = 'path')
+        with open(output_file) as f:
+            paths = [ os.path.relpath(row['path'], self.root) for row in csv.DictReader(f) ]
+        self.assertEqual(paths, ["a.jpg", "skip/d.jpg", "sub/b.PNG", "sub/deep/c.jpg", "sub/linked.jpg"])
+
+class TestUpdate(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(self.input_dir)
+        for source in [colors_jpg, green_jpg, white_jpg]:
+            shutil.copy(source, self.input_dir)
+        self.csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        print_from_path(path = self.input_dir, output_file = self.csv_file, threads = 1)
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def read_rows(self, csv_file: str) -> List[Dict]:
+        with open(csv_file) as f:
+            return(list(csv.DictReader(f)))
+
+    def touch(self, path: str, seconds: int):
+        """
+        Move the modification time of a file from the time the table was written
+        """
+        mtime_ns = os.stat(self.csv_file).st_mtime_ns + seconds * 10 ** 9
+        os.utime(path, ns = (mtime_ns, mtime_ns))
+
+    def test_update_csv(self):
+        """
+        Check that an updated table is the same as a new table made from the changed dir
+        """
+        shutil.copy(red_jpg, self.input_dir)
+        os.remove(os.path.join(self.input_dir, "white.jpg"))
+        shutil.copyfile(black_jpg, os.path.join(self.input_dir, "green.jpg"))
+        self.touch(os.path.join(self.input_dir, "green.jpg"), 10)
+        self.touch(os.path.join(self.input_dir, "red.jpg"), -10)
+
+        counts = update_csv(self.csv_file, self.input_dir, threads = 1)
+        self.assertEqual(counts, {'added': 1, 'modified': 1, 'removed': 1, 'kept': 1})
+        expected_file = os.path.join(self.tmpdir, "expected.csv")
+        print_from_path(path = self.input_dir, output_file = expected_file, threads = 1)
+        self.assertEqual(self.read_rows(self.csv_file), self.read_rows(expected_file))
+        self.assertTrue(os.path.exists(self.csv_file + '.manifest'))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["avgs.csv", "avgs.csv.manifest", "expected.csv", "input"])
+
+        # after the first update, changes are found from the sizes and times saved in the manifest
+        counts = update_csv(self.csv_file, self.input_dir, threads = 1)
+        self.assertEqual(counts, {'added': 0, 'modified': 0, 'removed': 0, 'kept': 3})
+        shutil.copyfile(white_jpg, os.path.join(self.input_dir, "colors.jpg"))
+        self.touch(os.path.join(self.input_dir, "colors.jpg"), -10)
+        output_file = os.path.join(self.tmpdir, "updated.csv")
+        counts = update_csv(self.csv_file, self.input_dir, output_file = output_file, threads = 1)
+        self.assertEqual(counts, {'added': 0, 'modified': 1, 'removed': 0, 'kept': 2})
+        rows = self.read_rows(output_file)
+        self.assertEqual([ int(row['red']) for row in rows if row['path'].endswith('colors.jpg') ], [white_expected['red']])
+
+    def test_update_csv_unsorted(self):
+        """
+        Check that a table which is not sorted by the key is left as it was
+        """
+        with open(self.csv_file) as f:
+            before = f.read()
+        shutil.copy(red_jpg, self.input_dir)
+        with self.assertRaises(ValueError):
+            update_csv(self.csv_file, self.input_dir, threads = 1, sort_key = 'path')
+        with open(self.csv_file) as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["avgs.csv", "input"])
+
+class TestShard(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(os.path.join(self.input_dir, "sub"))
+        for source in [colors_jpg, green_jpg, white_jpg]:
+            shutil.copy(source, self.input_dir)
+        for source in [red_jpg, black_jpg, slide_jpg]:
+            shutil.copy(source, os.path.join(self.input_dir, "sub"))
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def read_rows(self, csv_file: str) -> List[Dict]:
+        with open(csv_file) as f:
+            return(list(csv.DictReader(f)))
+
+    def test_shard_arg(self):
+        self.assertEqual(shard_arg("0/4"), (0, 4))
+        self.assertEqual(shard_arg("3/4"), (3, 4))
+        for value in ["4/4", "-1/4", "0/0", "1", "a/b", "1/2/3"]:
+            with self.assertRaises(ValueError):
+                shard_arg(value)
+
+    def test_find_files_shard(self):
+        """
+        Check that the shards of a dir hold each file once, and pick the same files wherever the dir is
+        """
+        all_files = sorted(find_files(self.input_dir))
+        for count in [1, 2, 3, 7]:
+            shards = [ sorted(find_files(self.input_dir, shard = (index, count))) for index in range(count) ]
+            self.assertEqual(sorted( file for shard in shards for file in shard ), all_files)
+            self.assertEqual(sum( len(shard) for shard in shards ), len(all_files))
+        moved_dir = os.path.join(self.tmpdir, "moved")
+        shutil.copytree(self.input_dir, moved_dir)
+        for index in range(3):
+            self.assertEqual(
+                [ os.path.relpath(file, self.input_dir) for file in find_files(self.input_dir, shard = (index, 3)) ],
+                [ os.path.relpath(file, moved_dir) for file in find_files(moved_dir, threads = 4, shard = (index, 3)) ])
+
+    def test_merge_shards(self):
+        """
+        Check that merging the tables of every shard gives the same table as one print of the whole dir
+        (rows with equal keys are in shard order, so each key ends with path to make the order the same)
+        """
+        for sort_key in ['path', 'hue,path', 'red,green,blue,path']:
+            expected_file = os.path.join(self.tmpdir, "expected.csv")
+            print_from_path(path = self.input_dir, output_file = expected_file, threads = 1, sort_key = sort_key)
+            shard_files = []
+            for index in range(3):
+                shard_file = os.path.join(self.tmpdir, "shard.{}.csv".format(index))
+                print_from_path(path = self.input_dir, output_file = shard_file, threads = 1, sort_key = sort_key,
+                    shard = (index, 3))
+                shard_files.append(shard_file)
+            output_file = os.path.join(self.tmpdir, "merged.csv")
+            rows = merge_csv(shard_files, output_file = output_file, sort_key = sort_key)
+            self.assertEqual(rows, 6)
+            self.assertEqual(self.read_rows(output_file), self.read_rows(expected_file))
+
+    def test_merge_unsorted(self):
+        """
+        Check that a table which is not sorted by the key is refused and no output is left behind
+        """
+        csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        print_from_path(path = self.input_dir, output_file = csv_file, threads = 1)
+        output_file = os.path.join(self.tmpdir, "merged.csv")
+        with self.assertRaises(ValueError):
+            merge_csv([csv_file], output_file = output_file, sort_key = 'path')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["avgs.csv", "input"])
+
+class TestHistogram(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_histogram(self):
+        """
+        Check that the histograms are the same from both engines, survive encoding, and give back the exact averages
+        """
+        for path in [colors_jpg, slide_jpg]:
+            for bins in [1, 8, 64]:
+                python_avg = Avg.get_avg_rgb_hsv(path, histogram_bins = bins, engine = 'python')
+                numpy_avg = Avg.get_avg_rgb_hsv(path, histogram_bins = bins, engine = 'numpy')
+                self.assertEqual(python_avg, numpy_avg)
+                hist = ColorHistogram.decode(numpy_avg['histogram'])
+                self.assertEqual(hist.bins, bins)
+                self.assertEqual(hist.encode(), numpy_avg['histogram'])
+                expected = Avg.get_avg_rgb_hsv(path)
+                del expected['path']
+                self.assertEqual(hist.avg(), expected)
+        with self.assertRaises(ValueError):
+            Avg.get_avg_rgb_hsv(colors_jpg, histogram_bins = 8, approx = True)
+        with self.assertRaises(ValueError):
+            ColorHistogram(bins = 3)
+
+    def test_histogram_ignore(self):
+        """
+        Check that ignoring colors that fill whole cells of the histogram gives the same averages as ignoring them in the image
+        """
+        hist = ColorHistogram.decode(Avg.get_avg_rgb_hsv(colors_jpg, histogram_bins = 8)['histogram'])
+        avg = hist.avg([(1, 255, 2)])
+        for key in colors_minus_green_expected.keys():
+            if key != 'path':
+                self.assertEqual(avg[key], colors_minus_green_expected[key])
+
+        # every color of the brightest cell of an 8 x 8 x 8 histogram
+        ignore = IgnoreTable.from_pixels(itertools.product(range(224, 256), repeat = 3))
+        hist = ColorHistogram.decode(Avg.get_avg_rgb_hsv(slide_jpg, histogram_bins = 8)['histogram'])
+        expected = Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = ignore)
+        del expected['path']
+        self.assertEqual(hist.avg(ignore), expected)
+
+    def test_histogram_stats(self):
+        """
+        Check that stats on a table with histograms gives the same averages as print with the same ignore file,
+        since the ignored white background is one of the peak colors of each image, along with the added columns
+        """
+        input_dir = os.path.join(THIS_DIR, "assets", "jpg", "Bones")
+        csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        expected_file = os.path.join(self.tmpdir, "expected.csv")
+        print_from_path(path = input_dir, output_file = csv_file, threads = 1, histogram = 8, sort_key = 'red')
+        print_from_path(path = input_dir, output_file = expected_file, threads = 1, ignore_file = ignore_white_jpg)
+        stats_file = os.path.join(self.tmpdir, "stats.csv")
+        histogram_stats(csv_file, output_file = stats_file, ignore_file = ignore_white_jpg)
+        with open(expected_file) as f:
+            expected = list(csv.DictReader(f))
+        with open(stats_file) as f:
+            rows = list(csv.DictReader(f))
+        hues = [ float(row['hue']) for row in rows ]
+        self.assertEqual(hues, sorted(hues))
+        expected = { row['path']: row for row in expected }
+        self.assertEqual(sorted( row['path'] for row in rows ), sorted(expected))
+        for row in rows:
+            self.assertEqual({ key: row[key] for key in expected[row['path']] }, expected[row['path']])
+            self.assertTrue(row['histogram'])
+            self.assertEqual(len(row['dominant'].split()), 3)
+            self.assertTrue(0 <= float(row['saturation_p10']) <= float(row['saturation_p50']) <= float(row['saturation_p90']) <= 1)
+
+        # a table without histograms
+        with self.assertRaises(ValueError):
+            histogram_stats(expected_file, output_file = stats_file)
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        self.index_file = os.path.join(self.tmpdir, "avgs.idx")
+        print_from_path(path = os.path.join(THIS_DIR, "assets", "jpg", "Bones"), output_file = self.csv_file,
+            threads = 1, index_file = self.index_file)
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def brute_force(self, table: AvgTable, space: str, rgb: tuple) -> List[tuple]:
+        """
+        (squared distance, row) of every row of a table to a color, closest first
+        """
+        point = color_points(space, *rgb)
+        found = []
+        for row, avg in enumerate(table):
+            other = color_points(space, avg.red, avg.green, avg.blue, avg.hue, avg.saturation, avg.value)
+            found.append((sum( (a - b) ** 2 for a, b in zip(point, other) ), row))
+        return(sorted(found))
+
+    def test_color_tree(self):
+        """
+        Check that the tree finds the same matches as comparing with every row, with or without numpy, and after saving it
+        """
+        colors = [(0, 0, 0), (255, 255, 255), (58, 123, 213), (200, 150, 120)]
+        for numpy in [np, None]:
+            with mock.patch('imagesort.np', numpy):
+                table = AvgTable.from_csv(self.csv_file)
+                for space in ['rgb', 'lab', 'hsv']:
+                    tree = ColorTree.build(table, space = space, leaf_size = 2)
+                    tree_file = tree.save(os.path.join(self.tmpdir, "tree"))
+                    with ColorTree.load(tree_file) as loaded:
+                        for rgb in colors:
+                            expected = self.brute_force(table, space, rgb)
+                            for t in [tree, loaded]:
+                                matches = t.nearest(color_points(space, *rgb), k = 5)
+                                self.assertEqual([ int(t.rows[i]) for d2, i in matches ], [ row for d2, row in expected[:5] ])
+                                radius = math.sqrt(expected[10][0]) + 1e-6
+                                matches = t.nearest(color_points(space, *rgb), radius = radius)
+                                self.assertEqual(sorted( int(t.rows[i]) for d2, i in matches ),
+                                    sorted( row for d2, row in expected if d2 <= radius * radius ))
+                        match = loaded.query([colors[2]], k = 1)[0][0]
+                        self.assertEqual(match['path'], table.get_value('path', match['row']))
+                        self.assertEqual(match['red'], table.get_value('red', match['row']))
+
+    def test_open_color_tree(self):
+        """
+        Check that a saved tree is used again until the table changes
+        """
+        tree_file = os.path.join(self.tmpdir, "avgs.csv.lab.kdtree")
+        open_color_tree(self.csv_file).close()
+        self.assertTrue(os.path.exists(tree_file))
+        with mock.patch('imagesort.ColorTree.build') as build:
+            open_color_tree(self.csv_file).close()
+            build.assert_not_called()
+        # a different space has its own tree
+        open_color_tree(self.csv_file, space = 'rgb').close()
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "avgs.csv.rgb.kdtree")))
+        # the table changed
+        with open(self.csv_file) as f:
+            lines = f.readlines()
+        with open(self.csv_file, "w") as f:
+            f.writelines(lines[:10])
+        with open_color_tree(self.csv_file) as tree:
+            self.assertEqual(len(tree), 9)
+
+    def test_query_colors(self):
+        """
+        Check the query table for a batch of colors, from a csv table and from a binary index
+        """
+        colors_file = os.path.join(self.tmpdir, "colors.txt")
+        with open(colors_file, "w") as f:
+            f.write("0,0,0\n\n")
+        output_file = os.path.join(self.tmpdir, "matches.csv")
+        for input_path in [self.csv_file, self.index_file]:
+            results = query_colors(input_path, colors = ['#3a7bd5', 'ffffff'], colors_file = colors_file,
+                nearest = 3, output_file = output_file)
+            self.assertEqual([ len(matches) for matches in results ], [3, 3, 3])
+            with open(output_file) as f:
+                rows = list(csv.DictReader(f))
+            self.assertEqual([ row['query'] for row in rows ], ['#3a7bd5'] * 3 + ['#ffffff'] * 3 + ['#000000'] * 3)
+            self.assertEqual([ row['rank'] for row in rows ], ['1', '2', '3'] * 3)
+            self.assertEqual([ row['path'] for row in rows ], [ match['path'] for matches in results for match in matches ])
+            distances = [ float(row['distance']) for row in rows[:3] ]
+            self.assertEqual(distances, sorted(distances))
+
+    def test_parse_color(self):
+        self.assertEqual(parse_color('#3a7bd5'), (58, 123, 213))
+        self.assertEqual(parse_color('3A7BD5'), (58, 123, 213))
+        self.assertEqual(parse_color('58,123,213'), (58, 123, 213))
+        for text in ['#3a7bd', 'red', '1,2', '1,2,256']:
+            with self.assertRaises(ValueError):
+                parse_color(text)
+
+class TestIndex(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.index_file = os.path.join(self.tmpdir, "avgs.idx")
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_index(self):
+        """
+        Check that an index file gives back the same values, with or without numpy, and sorts like a list
+        """
+        avgs = Avg.from_list(paths = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg], threads = 1, sort_key = False)
+        avgs.append(Avg(slide_jpg, approx = True))
+        write_index(avgs, self.index_file)
+        for numpy in [np, None]:
+            with mock.patch('imagesort.np', numpy):
+                with AvgIndex(self.index_file) as index:
+                    self.assertEqual(len(index), len(avgs))
+                    self.assertEqual([ int(v) for v in index.columns['red'] ], [ avg.red for avg in avgs ])
+                    self.assertEqual([ a.to_dict() for a in index.iter_avgs() ], [ avg.to_dict() for avg in avgs ])
+                    for sort_key in ['hue', 'red', 'pixels_total', 'path']:
+                        expected = sorted(avgs, key = avg_sort_key(sort_key))
+                        self.assertEqual([ index.get_path(row) for row in index.argsort(sort_key) ], [ str(avg.path) for avg in expected ])
+                self.assertEqual([ a.to_dict() for a in Avg.from_index(self.index_file, sort_key = 'hue') ],
+                    [ avg.to_dict() for avg in sorted(avgs, key = avg_sort_key('hue')) ])
+
+        # an empty table can be saved too
+        write_index([], self.index_file)
+        self.assertEqual(Avg.from_index(self.index_file), [])
+        with self.assertRaises(ValueError):
+            AvgIndex(colors_jpg)
+
+    def test_index_collage(self):
+        """
+        Check that print writes an index that makes the same collage as its csv output
+        """
+        input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(input_dir)
+        for source in [colors_jpg, green_jpg, white_jpg]:
+            shutil.copy(source, input_dir)
+        csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        print_from_path(path = input_dir, output_file = csv_file, threads = 1, index_file = self.index_file)
+        csv_avgs = Avg.from_csv(csv_file)
+        self.assertEqual([ a.to_dict() for a in Avg.from_index(self.index_file) ], [ a.to_dict() for a in csv_avgs ])
+        outputs = []
+        for kwargs in [{'input_is_csv': True, 'input_path': csv_file}, {'input_is_index': True, 'input_path': self.index_file}]:
+            output_file = os.path.join(self.tmpdir, "collage{}.jpg".format(len(outputs)))
+            outputs.append(md5_file(make_collage(output_file = output_file, x = 30, y = 20, bar_height = 5, **kwargs)))
+        self.assertEqual(outputs[0], outputs[1])
+
+class TestAvgTable(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.avgs = Avg.from_list(paths = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg], threads = 1, sort_key = False)
+        self.avgs.append(Avg(slide_jpg, approx = True))
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_avg_slots(self):
+        """
+        Check that Avg objects have no per-instance dict and still copy between processes
+        """
+        avg = self.avgs[-1]
+        self.assertFalse(hasattr(avg, '__dict__'))
+        with self.assertRaises(AttributeError):
+            avg.other = 1
+        self.assertEqual(pickle.loads(pickle.dumps(avg)).to_dict(), avg.to_dict())
+
+    def test_table(self):
+        """
+        Check that table rows act like the Avg objects they were made from, and sort the same way, with or without numpy
+        """
+        expected = [ avg.to_dict() for avg in self.avgs ]
+        for numpy in [np, None]:
+            with mock.patch('imagesort.np', numpy):
+                table = AvgTable.from_avgs(self.avgs)
+                self.assertEqual(len(table), len(self.avgs))
+                self.assertEqual([ row.to_dict() for row in table ], expected)
+                self.assertEqual(table[-1].error, self.avgs[-1].error)
+                self.assertIsNone(table[0].error)
+                self.assertEqual([ row.path for row in table[1:3] ], [green_jpg, white_jpg])
+                for sort_key in ['hue', 'red', 'pixels_total', 'path']:
+                    sorted_avgs = sorted(self.avgs, key = avg_sort_key(sort_key))
+                    self.assertEqual([ row.to_dict() for row in table.sorted(sort_key) ], [ avg.to_dict() for avg in sorted_avgs ])
+                    # a selection of a sorted table
+                    self.assertEqual([ row.path for row in table.sorted(sort_key).take([4, 0]) ], [ sorted_avgs[4].path, sorted_avgs[0].path ])
+                with self.assertRaises(IndexError):
+                    table[len(self.avgs)]
+
+    def test_table_files(self):
+        """
+        Check that tables loaded from a csv file or index file hold the same rows
+        """
+        csv_file = os.path.join(self.tmpdir, "avgs.csv")
+        index_file = os.path.join(self.tmpdir, "avgs.idx")
+        write_csv([ avg.to_dict() for avg in self.avgs[:-1] ], csv_file)
+        write_index(self.avgs, index_file)
+        self.assertEqual([ row.to_dict() for row in AvgTable.from_csv(csv_file) ], [ avg.to_dict() for avg in self.avgs[:-1] ])
+        table = AvgTable.from_index(index_file)
+        self.assertEqual([ row.to_dict() for row in table.sorted('hue') ],
+            [ avg.to_dict() for avg in sorted(self.avgs, key = avg_sort_key('hue')) ])
+        table.close()
+
+class TestSortKeys(unittest.TestCase):
+    def test_hilbert_index(self):
+        """
+        Check that the Hilbert curve visits every point of the cube once, always stepping to a neighboring point
+        """
+        for bits in [1, 2, 4]:
+            size = 2 ** bits
+            points = [ (x, y, z) for x in range(size) for y in range(size) for z in range(size) ]
+            indexes = [ hilbert_index(list(point), bits = bits) for point in points ]
+            self.assertEqual(sorted(indexes), list(range(size ** 3)))
+            path = [ point for index, point in sorted(zip(indexes, points)) ]
+            for a, b in zip(path, path[1:]):
+                self.assertEqual(sum(abs(i - j) for i, j in zip(a, b)), 1)
+
+    def test_color_sort_values(self):
+        """
+        Check that color keys calculated for whole arrays match the ones calculated one color at a time
+        """
+        random = np.random.RandomState(0)
+        red, green, blue = random.randint(0, 256, size = (3, 500))
+        for sort_key in ['hilbert', 'lab', 'lightness']:
+            values = color_sort_values(sort_key, red, green, blue)
+            expected = [ color_sort_values(sort_key, int(r), int(g), int(b)) for r, g, b in zip(red, green, blue) ]
+            self.assertTrue(np.allclose(values, expected))
+        greys = [ color_sort_values('lightness', v, v, v) for v in [0, 1, 10, 128, 255] ]
+        self.assertEqual(greys, sorted(greys))
+        self.assertAlmostEqual(greys[0], 0)
+        self.assertAlmostEqual(greys[-1], 100, places = 3)
+
+    def test_table_sort_keys(self):
+        """
+        Check that sorting a table by color keys and by several keys matches sorting Avg objects, with or without numpy
+        """
+        avgs = Avg.from_list(paths = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg], threads = 1, sort_key = False)
+        for numpy in [np, None]:
+            with mock.patch('imagesort.np', numpy):
+                table = AvgTable.from_avgs(avgs)
+                for sort_key in ['hilbert', 'lab', 'lightness', 'value,hue', 'lightness,path', 'pixels_total,lab']:
+                    expected = [ avg.path for avg in sorted(avgs, key = avg_sort_key(sort_key)) ]
+                    self.assertEqual([ row.path for row in table.sorted(sort_key) ], expected)
+        self.assertEqual([ avg.path for avg in sorted(avgs, key = avg_sort_key('lightness')) ][0], black_jpg)
+        self.assertEqual([ avg.path for avg in sorted(avgs, key = avg_sort_key('lightness')) ][-1], white_jpg)
+        with self.assertRaises(ValueError):
+            check_sort_key('value,foo')
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_make_corpus(self):
+        """
+        Check that the synthetic corpus is the same every time it is made
+        """
+        paths = benchmark.make_corpus(os.path.join(self.tmpdir, "a"), 3, 64, 48)
+        again = benchmark.make_corpus(os.path.join(self.tmpdir, "b"), 3, 64, 48)
+        self.assertEqual(len(paths), 3)
+        for path, other in zip(paths, again):
+            self.assertEqual(Image.open(path).size, (64, 48))
+            self.assertEqual(hashlib.md5(Path(path).read_bytes()).hexdigest(), hashlib.md5(Path(other).read_bytes()).hexdigest())
+
+    def test_run_and_compare(self):
+        """
+        Check that each stage gives a result, and that a slower result is flagged as a regression
+        """
+        results = benchmark.run_benchmarks(sizes = [(64, 48)], counts = [4], threads = [1], repeat = 1,
+            corpus_dir = self.tmpdir, _verbose = False)
+        self.assertEqual([ result['stage'] for result in results['results'] ], benchmark.STAGES)
+        for result in results['results']:
+            self.assertEqual(len(result['times']), 1)
+            self.assertEqual(result['images'], 4)
+        slower = json.loads(json.dumps(results))
+        slower['results'][0]['median'] = results['results'][0]['median'] * 2
+        slower['results'][1]['median'] = results['results'][1]['median'] / 2
+        statuses = [ c['status'] for c in benchmark.compare_results(results, slower, threshold = 0.1) ]
+        self.assertEqual(statuses, ['regression', 'improvement'] + ['ok'] * (len(benchmark.STAGES) - 2))
+
+class TestProfile(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(self.input_dir)
+        for path in [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg]:
+            shutil.copy(path, self.input_dir)
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def read_profile(self, profile_file: str) -> List[Dict]:
+        with open(profile_file) as f:
+            return([ json.loads(line) for line in f ])
+
+    def test_avg_profile(self):
+        """
+        Check that the time spent on each step is only recorded when asked for
+        """
+        self.assertNotIn('profile', Avg.get_avg_rgb_hsv(colors_jpg))
+        record = Avg.get_avg_rgb_hsv(colors_jpg, _profile = True)['profile']
+        self.assertEqual(list(record['stages']), ['open', 'decode', 'convert', 'sum'])
+        image = Image.open(colors_jpg)
+        self.assertEqual(record['pixels'], image.size[0] * image.size[1])
+        self.assertEqual(record['bytes'], os.path.getsize(colors_jpg))
+        self.assertAlmostEqual(record['total'], sum(record['stages'].values()))
+        record = Avg.get_avg_rgb_hsv(slide_jpg, approx = True, _profile = True)['profile']
+        self.assertEqual(list(record['stages']), ['open', 'sample'])
+
+    def test_print_profile(self):
+        """
+        Check that print saves a line for each image and a summary, without changing the output or the cached results
+        """
+        expected_file = os.path.join(self.tmpdir, "expected.csv")
+        print_from_path(path = self.input_dir, output_file = expected_file, threads = 1)
+        cache_file = os.path.join(self.tmpdir, "cache.sqlite")
+        for run in range(2):
+            for threads in [1, 2]:
+                output_file = os.path.join(self.tmpdir, "avgs.csv")
+                profile_file = os.path.join(self.tmpdir, "profile.jsonl")
+                print_from_path(path = self.input_dir, output_file = output_file, threads = threads,
+                    cache_file = cache_file, profile_file = profile_file, metrics = True, slowest = 2)
+                self.assertEqual(Path(output_file).read_text(), Path(expected_file).read_text())
+                records = self.read_profile(profile_file)
+                summary = records.pop()
+                self.assertEqual(sorted( os.path.basename(r['path']) for r in records ),
+                    ['black.jpg', 'colors.jpg', 'green.jpg', 'red.jpg', 'white.jpg'])
+                self.assertEqual(summary['type'], 'summary')
+                self.assertEqual(summary['images'], 5)
+                self.assertEqual(len(summary['slowest']), 2 if summary['computed'] else 0)
+                self.assertIn('scan', summary['run_stages'])
+            # the first run fills the cache, so the rest only load the results
+            self.assertEqual(summary['cached'], 5)
+        with ResultCache(cache_file) as cache:
+            results = [ json.loads(row[0]) for row in cache.conn.execute("SELECT result FROM results") ]
+        self.assertEqual(len(results), 5)
+        for result in results:
+            self.assertNotIn('profile', result)
+
+    def test_collage_profile(self):
+        """
+        Check that the tiles are timed along with the averages, and the rendering is timed for the whole run
+        """
+        make_collage(input_path = self.input_dir, output_file = os.path.join(self.tmpdir, "collage.jpg"), threads = 2,
+            x = 10, y = 10, bar_height = 2, profile_file = os.path.join(self.tmpdir, "profile.jsonl"))
+        records = self.read_profile(os.path.join(self.tmpdir, "profile.jsonl"))
+        summary = records.pop()
+        self.assertEqual(summary['computed'], 5)
+        self.assertIn('render', summary['run_stages'])
+        for record in records:
+            self.assertIn('tile', record['stages'])
+            self.assertIn('sum', record['stages'])
+
+class TestPrefetch(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(self.input_dir)
+        for path in [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg, slide_jpg]:
+            shutil.copy(path, self.input_dir)
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_prefetch(self):
+        """
+        Check that files are handed on in order with their contents, reading no more than depth files ahead
+        """
+        paths = sorted( os.path.join(self.input_dir, name) for name in os.listdir(self.input_dir) ) * 3
+        pulled = []
+        def source():
+            for path in paths:
+                pulled.append(path)
+                yield(path)
+        with Prefetcher(depth = 4, readers = 2) as prefetcher:
+            for i, (path, data) in enumerate(prefetcher.prefetch(source())):
+                self.assertEqual(path, paths[i])
+                self.assertEqual(data, [Path(path).read_bytes()])
+                self.assertLessEqual(len(pulled) - i, 4)
+            stats = prefetcher.stats()
+        self.assertEqual(stats['files'], len(paths))
+        self.assertAlmostEqual(stats['megabytes'], sum( os.path.getsize(path) for path in paths ) / 1e6)
+        # several files for each item, and a memory limit smaller than one file still reads one item at a time
+        with Prefetcher(depth = 4, memory = 1) as prefetcher:
+            items = list(prefetcher.prefetch([ paths[:2], paths[2:3] ], paths = lambda item: item))
+        self.assertEqual([ len(data) for item, data in items ], [2, 1])
+
+    def test_prefetch_avgs(self):
+        """
+        Check that averages decoded from prefetched contents are the same as from the files, with each backend
+        """
+        paths = sorted( os.path.join(self.input_dir, name) for name in os.listdir(self.input_dir) )
+        self.assertEqual(Avg.get_avg_rgb_hsv(slide_jpg, data = Path(slide_jpg).read_bytes(), approx = True, tolerance = 0),
+            Avg.get_avg_rgb_hsv(slide_jpg, approx = True, tolerance = 0))
+        expected = [ Avg.get_avg_rgb_hsv(path) for path in paths ]
+        for backend in ['process', 'thread', 'serial']:
+            with Executor(backend, workers = 2) as executor, Prefetcher(depth = 3) as prefetcher:
+                avgs = Avg.iter_from_list(paths, ordered = True, executor = executor, prefetcher = prefetcher)
+                self.assertEqual([ avg.to_dict() for avg in avgs ], expected)
+                avgs = Avg.iter_with_tiles(paths, img_width = 10, img_height = 10, executor = executor, prefetcher = prefetcher)
+                self.assertEqual([ avg.to_dict() for avg, tile in avgs ], expected)
+
+    def test_print_prefetch(self):
+        """
+        Check that print gives the same table with prefetching, and reports the reads in the profile summary
+        """
+        expected_file = os.path.join(self.tmpdir, "expected.csv")
+        print_from_path(path = self.input_dir, output_file = expected_file, threads = 2)
+        output_file = os.path.join(self.tmpdir, "avgs.csv")
+        profile_file = os.path.join(self.tmpdir, "profile.jsonl")
+        print_from_path(path = self.input_dir, output_file = output_file, threads = 2, prefetch = 2,
+            profile_file = profile_file)
+        self.assertEqual(Path(output_file).read_text(), Path(expected_file).read_text())
+        with open(profile_file) as f:
+            summary = json.loads(f.readlines()[-1])
+        self.assertEqual(summary['prefetch']['files'], 6)
+        self.assertEqual(summary['prefetch']['depth'], 2)
+
 class TestMisc(unittest.TestCase):
     def test_load_pixels(self):
         pixels = load_all_pixels(red_jpg)
@@ -165,6 +1304,40 @@ class TestThumbnails(unittest.TestCase):
         expected = ['83a42111ab98bf1d5b472f5df3b6ef9d', '842d20107511fe23c0d8510bb7cde137']
         self.assertEqual(md5s, expected)
 
+    def test_iter_with_tiles(self):
+        """
+        Test that the averages and tiles from a single decode match the ones made separately
+        """
+        paths = [colors_jpg, green_jpg, slide_jpg]
+        cache = ResultCache(os.path.join(self.tmpdir, "cache.sqlite"))
+        # the second pass gets the averages from the cache
+        for i in range(2):
+            results = list(Avg.iter_with_tiles(paths, img_width = 40, img_height = 30, threads = 1, cache = cache))
+            self.assertEqual([ avg.path for avg, tile in results ], paths)
+            for avg, tile in results:
+                self.assertEqual(avg.to_dict(), Avg(avg.path).to_dict())
+                self.assertEqual(tile.tobytes(), load_tile(avg.path, img_width = 40, img_height = 30).tobytes())
+        cache.close()
+
+    def test_load_tile_resample(self):
+        """
+        Test that tiles from a reduced-scale decode look the same as resizing the full image, for each resample filter
+        """
+        big_jpg = os.path.join(self.tmpdir, "big.jpg")
+        Image.open(slide_jpg).resize((1600, 1200), Image.BICUBIC).save(big_jpg, quality = 95)
+        full = np.asarray(Image.open(big_jpg).resize((100, 80), Image.LANCZOS), dtype = np.int16)
+        # mean difference per pixel and channel, in RGB units
+        for resample, mean_diff in [('lanczos', 1), ('bicubic', 2), ('bilinear', 4), ('nearest', 8)]:
+            tile = load_tile(big_jpg, img_width = 100, img_height = 80, resample = resample)
+            self.assertEqual(tile.size, (100, 80))
+            self.assertTrue(np.abs(np.asarray(tile, dtype = np.int16) - full).mean() <= mean_diff)
+            # the tiles made along with the averages are the same
+            avg, tile_with_avg = next(Avg.iter_with_tiles([big_jpg], img_width = 100, img_height = 80, threads = 1, resample = resample))
+            self.assertEqual(tile_with_avg.tobytes(), tile.tobytes())
+            self.assertEqual(avg.to_dict(), Avg(big_jpg).to_dict())
+        with self.assertRaises(ValueError):
+            load_tile(big_jpg, resample = 'antialias')
+
     def test_make_thumbnails_from_avgs_ignore(self):
         """
         Test that thumbnails can be made with an ignore file, should given different output
@@ -175,6 +1348,253 @@ class TestThumbnails(unittest.TestCase):
         expected = ['2ec251d19e47649db78db1cfa239908e', '842d20107511fe23c0d8510bb7cde137']
         self.assertEqual(md5s, expected)
 
+class TestThreads(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def test_imap_ordered(self):
+        """
+        Check that results come back in order for any limit on the items in flight, including limits below the chunk size
+        """
+        items = [ x for x in range(40) if x != 3 ]
+        expected = [ x * 2 for x in items ]
+        for max_in_flight in [None, 1, 2, 3, 5, 100]:
+            results = list(imap_ordered(double_or_fail, items, threads = 2, chunksize = 4, max_in_flight = max_in_flight))
+            self.assertEqual(results, expected)
+
+    def test_imap_ordered_error(self):
+        """
+        Check that an error in a worker is raised in the caller instead of hanging, and that stopping early does not hang
+        """
+        for threads in [1, 2]:
+            for max_in_flight in [None, 2]:
+                with self.assertRaises(ValueError):
+                    list(imap_ordered(double_or_fail, range(40), threads = threads, max_in_flight = max_in_flight))
+
+        results = imap_ordered(double_or_fail, range(4, 40), threads = 2, max_in_flight = 2)
+        self.assertEqual(next(results), 8)
+        results.close()
+
+    def test_threads_same_output(self):
+        """
+        Check that rendering in the worker pool gives the same files as rendering with a single thread
+        """
+        input_files = [colors_jpg, green_jpg, white_jpg, red_jpg, black_jpg]
+        input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(input_dir)
+        for input_file in input_files:
+            shutil.copy(input_file, input_dir)
+        md5s = {}
+        for threads in [1, 3]:
+            output_dir = os.path.join(self.tmpdir, str(threads))
+            os.makedirs(output_dir)
+            outputs = make_thumbnails(output_dir = output_dir, input_path = input_dir, threads = threads)
+            outputs.append(make_collage(input_path = input_dir, threads = threads,
+                output_file = os.path.join(output_dir, "collage.jpg")))
+            outputs.append(make_gif(input_path = input_dir, threads = threads,
+                output_file = os.path.join(output_dir, "image.gif")))
+            md5s[threads] = [ (os.path.basename(o), md5_file(o)) for o in outputs ]
+        self.assertEqual(len(md5s[1]), len(input_files) + 2)
+        self.assertEqual(md5s[1], md5s[3])
+
+    def test_worker_avg_args(self):
+        """
+        Check that the ignore pixels installed in the workers at startup give the same averages as sending them with each task
+        """
+        table = IgnoreTable.from_file(ignore_white_jpg)
+        with mock.patch('imagesort._worker_avg_args', ((), {})):
+            imagesort.init_avg_worker((), {'ignore_vals': table})
+            self.assertEqual(imagesort.avg_chunk([slide_jpg]), imagesort.avg_chunk([slide_jpg], (), {'ignore_vals': table}))
+            avg, tile, is_new = imagesort.avg_tile_task((slide_jpg, None), img_width = 10, img_height = 10)
+            self.assertEqual(avg, Avg.get_avg_rgb_hsv(slide_jpg, ignore_vals = table))
+        paths = [slide_jpg, colors_jpg, red_jpg, green_jpg, black_jpg]
+        expected = [ Avg.get_avg_rgb_hsv(path, ignore_vals = table) for path in paths ]
+        avgs = Avg.iter_from_list(paths, threads = 2, chunksize = 2, ordered = True, ignore_vals = table)
+        self.assertEqual([ avg.to_dict() for avg in avgs ], expected)
+        avgs = Avg.iter_with_tiles(paths, img_width = 10, img_height = 10, threads = 2, ignore_vals = table)
+        self.assertEqual([ avg.to_dict() for avg, tile in avgs ], expected)
+
+    def test_executor_backends(self):
+        """
+        Check that each backend gives the same results, and that a held executor keeps its pool between calls
+        """
+        paths = [slide_jpg, colors_jpg, red_jpg, green_jpg, black_jpg]
+        expected = [ Avg.get_avg_rgb_hsv(path) for path in paths ]
+        table = IgnoreTable.from_file(ignore_white_jpg)
+        for backend in ['process', 'thread', 'serial']:
+            with Executor(backend, workers = 2) as executor:
+                self.assertEqual([ avg.to_dict() for avg in Avg.from_list(paths, sort_key = False, executor = executor) ], expected)
+                pool = executor.pool
+                self.assertEqual([ avg.to_dict() for avg in Avg.from_list(paths, sort_key = False, executor = executor) ], expected)
+                self.assertIs(executor.pool, pool)
+                # tasks that do not need the args installed in the workers use the same pool
+                self.assertEqual(list(imap_ordered(double_or_fail, [0, 1, 2], executor = executor)), [0, 2, 4])
+                self.assertIs(executor.pool, pool)
+                # other args need new workers
+                avgs = Avg.from_list(paths, sort_key = False, executor = executor, ignore_vals = table)
+                self.assertEqual([ avg.to_dict() for avg in avgs ], [ Avg.get_avg_rgb_hsv(path, ignore_vals = table) for path in paths ])
+                if backend == 'serial':
+                    self.assertIsNone(executor.pool)
+                else:
+                    self.assertIsNot(executor.pool, pool)
+                with self.assertRaises(ValueError):
+                    list(imap_ordered(double_or_fail, [1, 3, 2], executor = executor))
+            self.assertIsNone(executor.pool)
+
+    def test_executor_auto(self):
+        """
+        Check the choice of backend, number of workers, and chunk size
+        """
+        self.assertEqual(Executor('auto', workers = 1).backend, 'serial')
+        self.assertEqual(Executor('auto', workers = 3).backend, 'process')
+        self.assertEqual(Executor('auto', workers = 'auto').workers, imagesort.cpu_count())
+        self.assertEqual(Executor('serial', workers = 4).workers, 1)
+        with self.assertRaises(ValueError):
+            Executor('fork')
+        with self.assertRaises(ValueError):
+            Executor('process', workers = 0)
+        executor = Executor('thread', workers = 2)
+        self.assertEqual(executor.chunk_size(), 1)
+        executor.record_cost(imagesort.CHUNK_SECONDS, 10)
+        self.assertEqual(executor.chunk_size(), 10)
+        executor.record_cost(0, 10)
+        self.assertEqual(executor.chunk_size(), 12)
+        self.assertEqual(Executor('thread', chunksize = 5).chunk_size(), 5)
+
+class TestErrors(unittest.TestCase):
+    def setUp(self):
+        """this gets run for each test case"""
+        self.preserve = False # save the tmpdir
+        self.tmpdir = mkdtemp() # dir = THIS_DIR
+        self.input_dir = os.path.join(self.tmpdir, "input")
+        os.makedirs(self.input_dir)
+        self.paths = []
+        for path in [colors_jpg, slide_jpg, green_jpg]:
+            self.paths.append(os.path.join(self.input_dir, os.path.basename(path)))
+            shutil.copyfile(path, self.paths[-1])
+        # a file that was cut off part way
+        self.truncated_jpg = os.path.join(self.input_dir, "truncated.jpg")
+        with open(slide_jpg, "rb") as fin, open(self.truncated_jpg, "wb") as fout:
+            fout.write(fin.read(20000))
+
+    def tearDown(self):
+        """this gets run for each test case"""
+        if not self.preserve:
+            # remove the tmpdir upon test completion
+            shutil.rmtree(self.tmpdir)
+
+    def read_failed(self, failed_csv: str) -> List[Dict]:
+        with open(failed_csv) as f:
+            return(list(csv.DictReader(f)))
+
+    def test_on_error(self):
+        """
+        Check that an image that can not be decoded stops the run, or is left out and listed, depending on on_error
+        """
+        paths = self.paths[:1] + [self.truncated_jpg] + self.paths[1:]
+        failed_csv = os.path.join(self.tmpdir, "failed.csv")
+        for executor in ['serial', 'process']:
+            with self.assertRaises(OSError):
+                Avg.from_list(paths, sort_key = False, threads = 2, executor = executor)
+            for on_error, attempts in [('skip', 1), ('retry', 1 + RETRY_ATTEMPTS)]:
+                for chunksize in [None, 2]:
+                    with FailureReport(failed_csv) as failures:
+                        avgs = Avg.from_list(paths, sort_key = False, threads = 2, executor = executor, chunksize = chunksize,
+                            on_error = on_error, failures = failures)
+                    self.assertEqual([ avg.path for avg in avgs ], self.paths)
+                    self.assertEqual(avgs[1].to_dict(), Avg(self.paths[1]).to_dict())
+                    failed = self.read_failed(failed_csv)
+                    self.assertEqual([ row['path'] for row in failed ], [self.truncated_jpg])
+                    self.assertIn('truncated', failed[0]['error'])
+                    self.assertEqual(int(failed[0]['attempts']), attempts)
+        with self.assertRaises(ValueError):
+            Avg.from_list(paths, threads = 1, on_error = 'ignore')
+
+    def test_limits(self):
+        """
+        Check that images over the pixel and file size limits are turned down, also when read by a Prefetcher
+        """
+        with Prefetcher(depth = 2) as prefetcher:
+            for limits in [{'max_pixels': 100000}, {'max_file_mb': 0.01}]:
+                for prefetch in [None, prefetcher]:
+                    with FailureReport() as failures:
+                        avgs = Avg.from_list(self.paths, sort_key = False, threads = 1, on_error = 'skip', failures = failures,
+                            prefetcher = prefetch, **limits)
+                    self.assertEqual([ avg.path for avg in avgs ], [self.paths[0], self.paths[2]])
+                    self.assertEqual(failures.count, 1)
+                # the limits are checked from the header, before the image is decoded
+                with mock.patch('PIL.ImageFile.ImageFile.load', side_effect = AssertionError("image was decoded")):
+                    with self.assertRaises(ValueError):
+                        Avg.get_avg_rgb_hsv(self.paths[1], **limits)
+
+    def test_timeout_and_retry(self):
+        """
+        Check that an image that takes too long is given up on, and that an image that failed once is tried again
+        """
+        sum_pixels = imagesort.sum_pixels_numpy
+        def slow_slide(image, *args, **kwargs):
+            if image.size == Image.open(slide_jpg).size:
+                time.sleep(5)
+            return(sum_pixels(image, *args, **kwargs))
+
+        start = time.time()
+        with mock.patch('imagesort.sum_pixels_numpy', side_effect = slow_slide):
+            with FailureReport() as failures:
+                avgs = Avg.from_list(self.paths, sort_key = False, threads = 1, engine = 'numpy', on_error = 'skip',
+                    failures = failures, timeout = 0.5)
+        self.assertTrue(time.time() - start < 5)
+        self.assertEqual([ avg.path for avg in avgs ], [self.paths[0], self.paths[2]])
+        self.assertEqual(failures.count, 1)
+
+        for on_error, expected in [('skip', 2), ('retry', 3)]:
+            calls = itertools.count()
+            def flaky(image, *args, **kwargs):
+                if next(calls) == 1:
+                    raise OSError("flaky read")
+                return(sum_pixels(image, *args, **kwargs))
+            with mock.patch('imagesort.sum_pixels_numpy', side_effect = flaky):
+                avgs = Avg.from_list(self.paths, sort_key = False, threads = 1, engine = 'numpy', on_error = on_error)
+            self.assertEqual(len(avgs), expected)
+
+    def test_print_and_update(self):
+        """
+        Check that print and update list the images they left out next to the output, and that update tries them again
+        """
+        output_csv = os.path.join(self.tmpdir, "data.csv")
+        print_from_path(path = self.input_dir, output_file = output_csv, threads = 2, on_error = 'skip')
+        with open(output_csv) as f:
+            self.assertEqual(sorted( row['path'] for row in csv.DictReader(f) ), sorted(self.paths))
+        self.assertEqual([ row['path'] for row in self.read_failed(output_csv + '.failed.csv') ], [self.truncated_jpg])
+
+        for i in range(2):
+            counts = update_csv(output_csv, self.input_dir, threads = 1, on_error = 'skip')
+            self.assertEqual(counts['skipped'], 1)
+            self.assertEqual(counts['kept'], 3)
+
+    def test_executor_recycle(self):
+        """
+        Check that the worker processes are replaced after max_tasks tasks or when they use more than max_memory MB,
+        without losing any results
+        """
+        items = list(range(4, 40))
+        expected = [ x * 2 for x in items ]
+        with Executor('process', 2, max_memory = 1) as executor:
+            results = list(imap_ordered(double_or_fail, items, executor = executor, chunksize = 2, max_in_flight = 4))
+            self.assertEqual(results, expected)
+            self.assertTrue(executor.recycled > 0)
+        with Executor('process', 2, max_tasks = 1) as executor:
+            self.assertEqual(list(imap_ordered(double_or_fail, items, executor = executor, chunksize = 2)), expected)
+            avgs = Avg.from_list(self.paths, sort_key = False, executor = executor)
+            self.assertEqual([ avg.to_dict() for avg in avgs ], [ Avg(path).to_dict() for path in self.paths ])
+
 class TestCollage(unittest.TestCase):
     def setUp(self):
         """this gets run for each test case"""
@@ -225,6 +1645,31 @@ class TestCollage(unittest.TestCase):
         expected = '67d1e4971ab259ee868aef35740648c8'
         self.assertEqual(md5, expected)
 
+    def test_collage_stream(self):
+        """
+        Test that a collage streamed one row at a time has the same pixels as one made in memory
+        """
+        input_avgs = [Avg(colors_jpg), Avg(green_jpg), Avg(red_jpg)]
+        for ext in ['.png', '.ppm']:
+            output_file = os.path.join(self.tmpdir, "collage" + ext)
+            streamed_file = os.path.join(self.tmpdir, "streamed" + ext)
+            make_collage(input_avgs = input_avgs, output_file = output_file, ncol = 2, x = 30, y = 20, bar_height = 5)
+            make_collage(input_avgs = input_avgs, output_file = streamed_file, ncol = 2, x = 30, y = 20, bar_height = 5, stream = True)
+            expected = Image.open(output_file)
+            streamed = Image.open(streamed_file)
+            self.assertEqual(streamed.size, (60, 50))
+            self.assertEqual(streamed.tobytes(), expected.tobytes())
+
+        # the output type is checked before any images are loaded; the fixtures dir also holds .txt files
+        with self.assertRaises(ValueError):
+            make_collage(input_path = fixtures_dir, output_file = os.path.join(self.tmpdir, "collage.jpg"), stream = True)
+
+        # the output file is closed when an input image can not be loaded
+        streamed_file = os.path.join(self.tmpdir, "failed.png")
+        with self.assertRaises(OSError):
+            make_collage(input_avgs = input_avgs + [Avg().from_dict(dict(Avg(colors_jpg).to_dict(), path = os.path.join(fixtures_dir, "notes.txt")))],
+                output_file = streamed_file, ncol = 2, x = 30, y = 20, bar_height = 5, stream = True, threads = 2)
+
 class TestGIF(unittest.TestCase):
     def setUp(self):
         """this gets run for each test case"""
@@ -248,6 +1693,59 @@ class TestGIF(unittest.TestCase):
         expected = '17e91ee6398c06f038c4f94584c4d8a2'
         self.assertEqual(md5, expected)
 
+    def test_make_gif_stream(self):
+        """
+        Test that a gif can be written one frame at a time, with per-frame or shared palettes
+        """
+        input_avgs = [Avg(colors_jpg), Avg(green_jpg), Avg(white_jpg)]
+        for palette in ['adaptive', 'global']:
+            output_file = os.path.join(self.tmpdir, palette + ".gif")
+            make_gif(input_avgs = input_avgs, output_file = output_file, x = 30, y = 20, bar_height = 5,
+                stream = True, palette = palette)
+            gif = Image.open(output_file)
+            self.assertEqual(gif.n_frames, 3)
+            self.assertEqual(gif.size, (30, 25))
+            self.assertEqual(gif.info['loop'], 0)
+            self.assertEqual(gif.info['duration'], 100)
+            # the last frame is all white
+            gif.seek(2)
+            self.assertEqual(gif.convert('RGB').getcolors(), [(30 * 25, (255, 255, 255))])
+
+        # the frames sampled for the global palette are only made once
+        input_avgs = input_avgs * 4
+        with mock.patch('imagesort.thumbnail_canvas_task', wraps = imagesort.thumbnail_canvas_task) as task:
+            make_gif(input_avgs = input_avgs, output_file = os.path.join(self.tmpdir, "sampled.gif"), x = 30, y = 20, bar_height = 5,
+                stream = True, palette = 'global', palette_sample = 4, threads = 1)
+        self.assertEqual(task.call_count, len(input_avgs))
+        self.assertEqual(Image.open(os.path.join(self.tmpdir, "sampled.gif")).n_frames, len(input_avgs))
+
+    def test_gif_stream_writer(self):
+        """
+        Check that each frame of a streamed gif decodes to the same pixels as the frame quantized on its own
+        """
+        slide = Image.open(slide_jpg).convert('RGB')
+        frames = [ slide.resize((40, 30)), slide.crop((0, 0, 400, 300)).resize((40, 30)), Image.new('RGB', (40, 30), (10, 200, 30)) ]
+        palette = make_gif_palette([(10, 200, 30)], frames)
+        sizes = []
+        for frame_palette in [None, palette]:
+            output_file = os.path.join(self.tmpdir, "frames.gif")
+            writer = GIFStreamWriter(output_file, (40, 30), palette = frame_palette)
+            for frame in frames:
+                writer.write(frame)
+            writer.close()
+
+            gif = Image.open(output_file)
+            for i, frame in enumerate(frames):
+                gif.seek(i)
+                if frame_palette is None:
+                    expected = frame.quantize(256, method = Image.FASTOCTREE)
+                else:
+                    expected = frame.quantize(palette = frame_palette)
+                self.assertEqual(gif.convert('RGB').tobytes(), expected.convert('RGB').tobytes())
+            sizes.append(os.path.getsize(output_file))
+        # frames that use the global palette do not repeat it in their own color tables
+        self.assertLess(sizes[1], sizes[0])
+
 
 if __name__ == "__main__":
     unittest.main()